@@ -0,0 +1,493 @@
+"""
+Precomputed aggregates for the dashboard.
+
+Every statistic plotted by app.py & explore.py is computed once from integer ids (no merged string columns),
+then rolled up to aisle / department through the small products lookup table. The store is a star schema: the
+count cube & the statistics hold only ids, the aisle / department names live in their dimension tables and are
+resolved by dimension_names at presentation time, for the rows a figure actually draws. The order tables are streamed
+in chunks into running counters, so peak memory does not grow with their number of rows. The results are
+persisted as a tiny aggregate store which the dashboard loads instead of the raw order tables. Every rebuild is
+written to a new generation directory & published by atomically replacing meta.json, so running dashboard
+workers switch to it on their next request (see refresh.py).
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+from data_loader import CACHE_DIR, CHUNK_SIZE, count_row_groups, iter_table, load_table, pq, source_signature
+from metrics import span, timed
+from store import create_generation, publish_meta, read_meta
+
+
+AGGREGATE_DIR = os.path.join(CACHE_DIR, "aggregates")
+
+# Source tables the aggregates are computed from, a change in any of them invalidates the store
+SOURCE_TABLES = ["orders", "order_products__prior", "products", "aisles", "departments"]
+
+# Bump when the set or shape of the aggregates changes so existing stores are rebuilt
+STORE_FORMAT_VERSION = 5
+
+DAYS = 7
+HOURS = 24
+
+# Columns of the order tables read by the accumulators
+ORDER_COLUMNS = ["order_id", "user_id", "eval_set", "order_number", "order_dow", "order_hour_of_day", "days_since_prior_order"]
+ORDER_PRODUCT_COLUMNS = ["order_id", "product_id", "reordered"]
+
+# Dimension -> (dimension table of the store, id column), the name column is named after the dimension
+DIMENSIONS = {
+    "aisle": ("aisles", "aisle_id"),
+    "department": ("departments", "department_id"),
+}
+
+# Number of processes aggregating partitions of the order tables in parallel
+WORKERS = int(os.environ.get("AGGREGATE_WORKERS", 1))
+
+
+def dataset_signature() -> dict:
+    """
+    Function to return the signature of every source table of the aggregate store
+    """
+    return {name: source_signature(name) for name in SOURCE_TABLES}
+
+
+def dataset_version(signature: dict = None) -> str:
+    """
+    Function to return a short version string identifying the current source data
+    """
+    if signature is None:
+        signature = dataset_signature()
+    return hashlib.sha1(json.dumps(signature, sort_keys = True).encode()).hexdigest()[:12]
+
+
+# Accumulators ###########################################################################################################
+def grow_array(array: np.ndarray, size: int, fill = 0) -> np.ndarray:
+    """
+    Function to return the array extended to at least size elements, new elements set to fill
+    """
+    if size <= len(array):
+        return array
+    grown = np.full(max(size, 2 * len(array)), fill, dtype = array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def add_counts(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """
+    Function to sum two counter arrays of possibly different lengths
+    """
+    if len(left) < len(right):
+        left, right = right, left
+    total = left.copy()
+    total[:len(right)] += right
+    return total
+
+
+class OrderAccumulator:
+    """
+    Running counters over chunks of the orders table.
+    Memory is bounded by the chunk plus dense per user / per order lookups, never by the number of rows read.
+    """
+    def __init__(self) -> None:
+        self.max_order_number = np.zeros(0, dtype = np.int16)
+        self.dow_hour_counts = np.zeros(DAYS * HOURS, dtype = np.int64)
+        self.days_since_prior_counts = np.zeros(0, dtype = np.int64)
+        self.first_order_count = 0
+        self.eval_set_counts = {}
+        self.eval_set_users = {}
+        # Day / hour slot of every order, used to place order products in the count cube
+        self.order_slot = np.zeros(0, dtype = np.int16)
+
+    def update(self, orders_df: pd.DataFrame) -> None:
+        if len(orders_df) == 0:
+            return
+        user_ids = orders_df["user_id"].to_numpy()
+        order_ids = orders_df["order_id"].to_numpy()
+        slot = orders_df["order_dow"].to_numpy().astype(np.int16) * HOURS + orders_df["order_hour_of_day"].to_numpy()
+
+        self.max_order_number = grow_array(self.max_order_number, user_ids.max() + 1)
+        np.maximum.at(self.max_order_number, user_ids, orders_df["order_number"].to_numpy().astype(np.int16))
+
+        self.order_slot = grow_array(self.order_slot, order_ids.max() + 1, fill = -1)
+        self.order_slot[order_ids] = slot
+
+        self.dow_hour_counts += np.bincount(slot, minlength = DAYS * HOURS)
+
+        days_since_prior = orders_df["days_since_prior_order"].to_numpy()
+        first_orders = np.isnan(days_since_prior)
+        self.first_order_count += int(first_orders.sum())
+        self.days_since_prior_counts = add_counts(self.days_since_prior_counts, np.bincount(days_since_prior[~first_orders].astype(np.int64)))
+
+        eval_sets = orders_df["eval_set"].astype(str).to_numpy()
+        for eval_set in np.unique(eval_sets):
+            in_eval_set = eval_sets == eval_set
+            self.eval_set_counts[eval_set] = self.eval_set_counts.get(eval_set, 0) + int(in_eval_set.sum())
+            users = grow_array(self.eval_set_users.get(eval_set, np.zeros(0, dtype = bool)), user_ids.max() + 1, fill = False)
+            users[user_ids[in_eval_set]] = True
+            self.eval_set_users[eval_set] = users
+
+    def merge(self, other: "OrderAccumulator") -> "OrderAccumulator":
+        """
+        Function to fold the counters of another (partial) accumulator into this one
+        """
+        self.max_order_number = grow_array(self.max_order_number, len(other.max_order_number))
+        self.max_order_number[:len(other.max_order_number)] = np.maximum(self.max_order_number[:len(other.max_order_number)], other.max_order_number)
+
+        self.order_slot = grow_array(self.order_slot, len(other.order_slot), fill = -1)
+        known = np.flatnonzero(other.order_slot >= 0)
+        self.order_slot[known] = other.order_slot[known]
+
+        self.dow_hour_counts += other.dow_hour_counts
+        self.days_since_prior_counts = add_counts(self.days_since_prior_counts, other.days_since_prior_counts)
+        self.first_order_count += other.first_order_count
+
+        for eval_set, count in other.eval_set_counts.items():
+            self.eval_set_counts[eval_set] = self.eval_set_counts.get(eval_set, 0) + count
+            users = grow_array(self.eval_set_users.get(eval_set, np.zeros(0, dtype = bool)), len(other.eval_set_users[eval_set]), fill = False)
+            users[:len(other.eval_set_users[eval_set])] |= other.eval_set_users[eval_set]
+            self.eval_set_users[eval_set] = users
+        return self
+
+    def results(self) -> dict:
+        max_order_number = self.max_order_number[self.max_order_number > 0]
+        max_order_number_counts = np.bincount(max_order_number)
+        order_numbers = np.flatnonzero(max_order_number_counts)
+
+        dow_hour_counts = self.dow_hour_counts.reshape(DAYS, HOURS)
+        dow, hour = np.divmod(np.arange(DAYS * HOURS), HOURS)
+        days_since_prior = np.flatnonzero(self.days_since_prior_counts)
+        eval_sets = sorted(self.eval_set_counts)
+
+        return {
+            "max_order_number_counts": pd.DataFrame({
+                "order_number": order_numbers.astype(np.int16),
+                "count": max_order_number_counts[order_numbers],
+            }).sort_values("count", ascending = False, ignore_index = True),
+            "dow_counts": pd.DataFrame({
+                "order_dow": np.arange(DAYS, dtype = np.int8),
+                "count": dow_hour_counts.sum(axis = 1),
+            }).sort_values("count", ascending = False, ignore_index = True),
+            "hour_counts": pd.DataFrame({
+                "order_hour_of_day": np.arange(HOURS, dtype = np.int8),
+                "count": dow_hour_counts.sum(axis = 0),
+            }),
+            "dow_hour_counts": pd.DataFrame({
+                "order_dow": dow.astype(np.int8),
+                "order_hour_of_day": hour.astype(np.int8),
+                "count": self.dow_hour_counts,
+            })[self.dow_hour_counts > 0].reset_index(drop = True),
+            # First orders have no prior order, they are counted under a NaN interval
+            "days_since_prior_counts": pd.DataFrame({
+                "days_since_prior_order": np.append(days_since_prior.astype(np.float32), np.nan),
+                "count": np.append(self.days_since_prior_counts[days_since_prior], self.first_order_count),
+            }),
+            "eval_set_counts": pd.DataFrame({
+                "eval_set": eval_sets,
+                "count": [self.eval_set_counts[eval_set] for eval_set in eval_sets],
+                "user_count": [int(self.eval_set_users[eval_set].sum()) for eval_set in eval_sets],
+            }),
+        }
+
+
+class OrderProductAccumulator:
+    """
+    Running per product counters & count cube over chunks of an order products table.
+    Products are mapped to their department / aisle group through a dense lookup indexed by product_id.
+    """
+    def __init__(self, products_df: pd.DataFrame) -> None:
+        self.n_aisles = int(products_df["aisle_id"].max()) + 1
+        self.n_departments = int(products_df["department_id"].max()) + 1
+        self.product_group = np.full(products_df["product_id"].max() + 1, -1, dtype = np.int32)
+        self.product_group[products_df["product_id"].to_numpy()] = products_df["department_id"].to_numpy().astype(np.int32) * self.n_aisles + products_df["aisle_id"].to_numpy()
+
+        self.order_count = np.zeros(0, dtype = np.int64)
+        self.reorder_sum = np.zeros(0, dtype = np.int64)
+        self.cube_order_count = np.zeros(DAYS * HOURS * self.n_groups, dtype = np.int64)
+        self.cube_reorder_sum = np.zeros(DAYS * HOURS * self.n_groups, dtype = np.int64)
+
+    @property
+    def n_groups(self) -> int:
+        return self.n_departments * self.n_aisles
+
+    def update(self, order_products_df: pd.DataFrame, order_slot: np.ndarray) -> None:
+        if len(order_products_df) == 0:
+            return
+        order_ids = order_products_df["order_id"].to_numpy()
+        product_ids = order_products_df["product_id"].to_numpy()
+        reordered = order_products_df["reordered"].to_numpy()
+
+        self.order_count = add_counts(self.order_count, np.bincount(product_ids))
+        self.reorder_sum = add_counts(self.reorder_sum, np.bincount(product_ids, weights = reordered).astype(np.int64))
+
+        # Day / hour slot of each order & department / aisle group of each product, looked up by integer id
+        known = (order_ids < len(order_slot)) & (product_ids < len(self.product_group))
+        slot = order_slot[order_ids[known]]
+        group = self.product_group[product_ids[known]]
+        known_cells = (slot >= 0) & (group >= 0)
+
+        cell = slot[known_cells].astype(np.int64) * self.n_groups + group[known_cells]
+        self.cube_order_count += np.bincount(cell, minlength = len(self.cube_order_count))
+        self.cube_reorder_sum += np.bincount(cell, weights = reordered[known][known_cells], minlength = len(self.cube_reorder_sum)).astype(np.int64)
+
+    def merge(self, other: "OrderProductAccumulator") -> "OrderProductAccumulator":
+        """
+        Function to fold the counters of another (partial) accumulator into this one
+        """
+        self.order_count = add_counts(self.order_count, other.order_count)
+        self.reorder_sum = add_counts(self.reorder_sum, other.reorder_sum)
+        self.cube_order_count += other.cube_order_count
+        self.cube_reorder_sum += other.cube_reorder_sum
+        return self
+
+    def results(self) -> dict:
+        product_ids = np.flatnonzero(self.order_count)
+
+        # Only the non empty cells are kept, so the cube stays small enough to be sliced on every interaction
+        cells = np.flatnonzero(self.cube_order_count)
+        slot, group = np.divmod(cells, self.n_groups)
+
+        return {
+            "product_stats": pd.DataFrame({
+                "product_id": product_ids.astype(np.int32),
+                "order_count": self.order_count[product_ids],
+                "reorder_sum": self.reorder_sum[product_ids],
+            }),
+            # Ordered products & reorders per day of week x hour of day x department x aisle
+            "count_cube": pd.DataFrame({
+                "order_dow": (slot // HOURS).astype(np.int8),
+                "order_hour_of_day": (slot % HOURS).astype(np.int8),
+                "department_id": (group // self.n_aisles).astype(np.int16),
+                "aisle_id": (group % self.n_aisles).astype(np.int16),
+                "order_count": self.cube_order_count[cells],
+                "reorder_sum": self.cube_reorder_sum[cells],
+            }),
+        }
+
+
+# Aggregations ###########################################################################################################
+def rollup_product_aggregates(product_stats: pd.DataFrame, products_df: pd.DataFrame,
+                              aisles_df: pd.DataFrame, departments_df: pd.DataFrame) -> dict:
+    """
+    Function to roll the per product counts up to aisles & departments through the lookup tables, the names are
+    stored once in the aisles / departments dimension tables
+    """
+    product_stats = product_stats.merge(products_df[["product_id", "aisle_id", "department_id"]], on = "product_id", how = "inner")
+
+    aisle_stats = product_stats.groupby("aisle_id")[["order_count", "reorder_sum"]].sum().reset_index()
+    aisle_stats = aisle_stats[aisle_stats["aisle_id"].isin(aisles_df["aisle_id"])].reset_index(drop = True)
+
+    department_stats = product_stats.groupby("department_id")[["order_count", "reorder_sum"]].sum().reset_index()
+    department_stats = department_stats[department_stats["department_id"].isin(departments_df["department_id"])].reset_index(drop = True)
+
+    return {
+        "aisle_stats": aisle_stats,
+        "department_stats": department_stats,
+        "aisles": aisles_df[["aisle_id", "aisle"]],
+        "departments": departments_df[["department_id", "department"]],
+    }
+
+
+def dimension_names(aggregates: dict, dimension: str, ids) -> np.ndarray:
+    """
+    Function to resolve aisle / department ids to their names through the dimension table, unknown ids as ""
+    """
+    table, id_column = DIMENSIONS[dimension]
+    names = aggregates[table].set_index(id_column)[dimension].astype(str)
+    return names.reindex(np.asarray(ids)).fillna("").to_numpy()
+
+
+def slice_count_cube(count_cube: pd.DataFrame, days: list = None, hours: tuple = None, department_ids: list = None) -> pd.DataFrame:
+    """
+    Function to restrict the count cube to the given days of week, (first, last) hour range & departments
+    """
+    mask = np.ones(len(count_cube), dtype = bool)
+    if days:
+        mask &= count_cube["order_dow"].isin(days).to_numpy()
+    if hours is not None:
+        mask &= count_cube["order_hour_of_day"].between(hours[0], hours[1]).to_numpy()
+    if department_ids:
+        mask &= count_cube["department_id"].isin(department_ids).to_numpy()
+    return count_cube[mask]
+
+
+def rollup_count_cube(count_cube: pd.DataFrame, by: list) -> pd.DataFrame:
+    """
+    Function to sum the order counts & reorders of the (sliced) cube over the given dimensions
+    """
+    return count_cube.groupby(by)[["order_count", "reorder_sum"]].sum().reset_index()
+
+
+# Partitions of the order tables are aggregated by pool processes, the lookups they share are set once per process
+_worker_state = {}
+
+# Pool processes are spawned, not forked: the parent already runs threads (pyarrow's allocator, the dashboard server
+# & store refresher) & a forked child can deadlock on a lock one of them held
+POOL_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def _init_worker(chunk_size: int, products_df: pd.DataFrame = None, order_slot: np.ndarray = None) -> None:
+    _worker_state.update(chunk_size = chunk_size, products_df = products_df, order_slot = order_slot)
+
+
+def _accumulate_orders(row_groups: list) -> OrderAccumulator:
+    accumulator = OrderAccumulator()
+    for orders_df in iter_table("orders", ORDER_COLUMNS, _worker_state["chunk_size"], row_groups):
+        accumulator.update(orders_df)
+    return accumulator
+
+
+def _accumulate_order_products(row_groups: list) -> OrderProductAccumulator:
+    accumulator = OrderProductAccumulator(_worker_state["products_df"])
+    for order_products_df in iter_table("order_products__prior", ORDER_PRODUCT_COLUMNS, _worker_state["chunk_size"], row_groups):
+        accumulator.update(order_products_df, _worker_state["order_slot"])
+    return accumulator
+
+
+def _partition_row_groups(name: str, workers: int) -> list:
+    """
+    Function to split the row groups of a cached table into at most workers contiguous partitions
+    """
+    row_groups = np.arange(count_row_groups(name))
+    return [partition.tolist() for partition in np.array_split(row_groups, min(workers, len(row_groups))) if len(partition)]
+
+
+def _accumulate_partitions(name: str, accumulate, workers: int, initargs: tuple):
+    """
+    Function to aggregate the partitions of a table in a process pool & merge the partial accumulators
+    """
+    with ProcessPoolExecutor(max_workers = workers, mp_context = POOL_CONTEXT, initializer = _init_worker, initargs = initargs) as executor:
+        return reduce(lambda left, right: left.merge(right), executor.map(accumulate, _partition_row_groups(name, workers)))
+
+
+@timed("aggregate.build", memory = True)
+def build_aggregates(chunk_size: int = CHUNK_SIZE, workers: int = WORKERS) -> dict:
+    """
+    Function to compute every aggregate of the store, streaming the order tables chunk_size rows at a time.
+    With several workers the row groups of the cached order tables are split between processes.
+    """
+    products_df = load_table("products", columns = ["product_id", "aisle_id", "department_id"])
+
+    # Partitioning needs the parquet cache, without pyarrow the tables are streamed in this process
+    parallel = workers > 1 and count_row_groups("orders") > 0 and count_row_groups("order_products__prior") > 0
+
+    if parallel:
+        with span("aggregate.orders", workers = workers, memory = True):
+            order_accumulator = _accumulate_partitions("orders", _accumulate_orders, workers, (chunk_size,))
+        with span("aggregate.order_products", workers = workers, memory = True):
+            order_product_accumulator = _accumulate_partitions(
+                "order_products__prior",
+                _accumulate_order_products,
+                workers,
+                (chunk_size, products_df, order_accumulator.order_slot)
+            )
+    else:
+        with span("aggregate.orders", workers = 1, memory = True):
+            order_accumulator = OrderAccumulator()
+            for orders_df in iter_table("orders", ORDER_COLUMNS, chunk_size):
+                order_accumulator.update(orders_df)
+
+        with span("aggregate.order_products", workers = 1, memory = True):
+            order_product_accumulator = OrderProductAccumulator(products_df)
+            for order_products_df in iter_table("order_products__prior", ORDER_PRODUCT_COLUMNS, chunk_size):
+                order_product_accumulator.update(order_products_df, order_accumulator.order_slot)
+
+    with span("aggregate.rollup", memory = True):
+        aggregates = order_accumulator.results()
+        aggregates.update(order_product_accumulator.results())
+        aggregates.update(rollup_product_aggregates(
+            aggregates["product_stats"],
+            products_df,
+            load_table("aisles"),
+            load_table("departments"),
+        ))
+    return aggregates
+
+
+# Store ##################################################################################################################
+def _aggregate_path(meta: dict, name: str) -> str:
+    return os.path.join(AGGREGATE_DIR, meta["generation"], f"{name}.parquet")
+
+
+def save_aggregates(aggregates: dict, signature: dict) -> None:
+    """
+    Function to persist the aggregates into a new generation directory, then atomically point meta.json at it
+    (the previous generation is kept for the workers still reading it)
+    """
+    os.makedirs(AGGREGATE_DIR, exist_ok = True)
+    generation, generation_dir = create_generation(AGGREGATE_DIR)
+    with span("aggregate.save", memory = True):
+        for name, df in aggregates.items():
+            df.to_parquet(os.path.join(generation_dir, f"{name}.parquet"), engine = "pyarrow", index = False)
+
+    meta = {
+        "version": dataset_version(signature),
+        "format_version": STORE_FORMAT_VERSION,
+        "signature": signature,
+        "generation": generation,
+        "tables": sorted(aggregates),
+    }
+    publish_meta(AGGREGATE_DIR, meta, keep_generations = 2)
+
+
+def read_store_meta() -> dict:
+    """
+    Function to read the meta data of the persisted store, empty if there is none
+    """
+    return read_meta(AGGREGATE_DIR)
+
+
+def is_store_fresh(meta: dict, signature: dict = None) -> bool:
+    """
+    Function to check whether a store was built from the current source data (any complete store without a signature)
+    """
+    if meta.get("format_version") != STORE_FORMAT_VERSION:
+        return False
+    return signature is None or meta.get("signature") == signature
+
+
+def refresh_aggregates(chunk_size: int = CHUNK_SIZE, workers: int = WORKERS) -> bool:
+    """
+    Function to rebuild & publish the aggregate store when the source csv files changed, returns whether it was rebuilt
+    """
+    signature = dataset_signature()
+    if is_store_fresh(read_store_meta(), signature):
+        return False
+    save_aggregates(build_aggregates(chunk_size, workers), signature)
+    return True
+
+
+def open_aggregates(meta: dict) -> dict:
+    """
+    Function to read the aggregates of a published store generation, memory mapped so every worker process reads
+    the same pages of the OS cache
+    """
+    with span("aggregate.open", memory = True):
+        return {name: pd.read_parquet(_aggregate_path(meta, name), engine = "pyarrow", memory_map = True) for name in meta["tables"]}
+
+
+def load_aggregates(chunk_size: int = CHUNK_SIZE, workers: int = WORKERS) -> dict:
+    """
+    Function to load the aggregate store, (re)building it when missing or stale
+    """
+    if pq is None:
+        return build_aggregates(chunk_size, workers)
+
+    refresh_aggregates(chunk_size, workers)
+    return open_aggregates(read_store_meta())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Build the dashboard aggregate store")
+    parser.add_argument("--chunk-size", type = int, default = CHUNK_SIZE, help = "rows of the order tables held in memory at once")
+    parser.add_argument("--workers", type = int, default = WORKERS, help = "processes aggregating partitions of the order tables")
+    args = parser.parse_args()
+
+    save_aggregates(build_aggregates(args.chunk_size, args.workers), dataset_signature())
+    print(f"Aggregate store built: {AGGREGATE_DIR} (version {read_store_meta()['version']})")
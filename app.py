@@ -1,39 +1,92 @@
-from re import L
-import pandas as pd
 import numpy as np
+import os
+import json
+from functools import partial
 import dash
 from dash import dcc 
 from dash import html
+from dash.dependencies import Input, Output, State
 import plotly.graph_objects as go
 import plotly.express as px
 
+from aggregates import dimension_names, is_store_fresh, open_aggregates, read_store_meta, rollup_count_cube, slice_count_cube
+from associations import is_index_fresh, open_associations, read_association_meta
+from figure_cache import FigureCache
+from figure_payload import compact_figure, compress_responses
+from metrics import register_metrics_endpoint, span, timed
+from refresh import refresh_stores, start_background_refresh
+
 # Initializing colors & stylesheets
 colors = ['hsl('+str(h)+',70%'+',70%)' for h in np.linspace(0, 360, 20)]
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
-# Importing csv
-order_products_prior_df = pd.read_csv("instacart-market-basket-analysis/order_products__prior.csv")
-orders_df = pd.read_csv("instacart-market-basket-analysis/orders.csv")
-products_df = pd.read_csv("instacart-market-basket-analysis/products.csv")
-aisles_df = pd.read_csv("instacart-market-basket-analysis/aisles.csv")
-departments_df = pd.read_csv("instacart-market-basket-analysis/departments.csv")
+# 0 = Saturday, 1 = Sunday, ..
+day_names = ['Sat', 'Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri']
+all_hours = [0, 23]
+
+# Precomputed aggregates are loaded lazily, on the first figure requested for a store generation. New generations
+# are built off the request path by the background refresh & picked up on the next request
+loaded_aggregates = {}
+
+# Compactly serialized figures, optionally shared between gunicorn workers through FIGURE_CACHE_DIR
+figure_cache = FigureCache(
+    max_entries = int(os.environ.get("FIGURE_CACHE_SIZE", 32)),
+    cache_dir = os.environ.get("FIGURE_CACHE_DIR"),
+    serializer = compact_figure,
+    max_disk_entries = int(os.environ.get("FIGURE_CACHE_DISK_SIZE", 256))
+)
+
+
+def store_meta():
+    # Current generation of the aggregate store, only built on the request path when there is no store yet
+    start_background_refresh()
+    meta = read_store_meta()
+    if not is_store_fresh(meta):
+        refresh_stores()
+        meta = read_store_meta()
+    return meta
+
+def get_aggregates(meta):
+    if loaded_aggregates.get('generation') != meta['generation']:
+        loaded_aggregates.clear()
+        loaded_aggregates.update(generation = meta['generation'], aggregates = open_aggregates(meta))
+    return loaded_aggregates['aggregates']
 
-# Merging Dataframes
-order_products_prior_df = pd.merge(order_products_prior_df, products_df, on='product_id', how='left')
-order_products_prior_df = pd.merge(order_products_prior_df, aisles_df, on='aisle_id', how='left')
-order_products_prior_df = pd.merge(order_products_prior_df, departments_df, on='department_id', how='left')
+# Co-purchase index, loaded lazily like the aggregates
+loaded_associations = {}
+
+# "Frequently bought with" figures (one per product & metric) are kept apart, in memory only, so browsing products
+# neither evicts the dashboard figures nor fills FIGURE_CACHE_DIR
+association_figure_cache = FigureCache(
+    max_entries = int(os.environ.get("ASSOCIATION_FIGURE_CACHE_SIZE", 64)),
+    serializer = compact_figure
+)
+
+
+def association_meta():
+    start_background_refresh()
+    meta = read_association_meta()
+    if not is_index_fresh(meta):
+        refresh_stores()
+        meta = read_association_meta()
+    return meta
+
+def get_associations(meta):
+    if loaded_associations.get('generation') != meta['generation']:
+        loaded_associations.clear()
+        loaded_associations.update(generation = meta['generation'], associations = open_associations(meta))
+    return loaded_associations['associations']
 
 
 # Plots ####################################################################################################################
-def bar_max_order_num(orders_df):
-    # Groupby user_id, take max order_number for each user_id (max num of orders for user_id)
-    max_orders_each_user = orders_df.groupby("user_id")["order_number"].aggregate(np.max).reset_index()
-    # Number of times all user orders
-    order_number_count = max_orders_each_user.order_number.value_counts()
+@timed('figure.build', figure = 'bar_max_order_num')
+def bar_max_order_num(max_order_number_counts):
+    # Number of times each maximum order number (max num of orders for user_id) occurs
+    order_number_count = max_order_number_counts.sort_values("count", ascending = False)
 
     bar_fig = go.Figure(data = [go.Bar(
-        x = order_number_count.index,
-        y = order_number_count.values,
+        x = order_number_count["order_number"].values,
+        y = order_number_count["count"].values,
     )],
     layout = dict(
         title = {'text': 'Number Of Occurrences For Maximum Order Of Customers'},
@@ -45,9 +98,10 @@ def bar_max_order_num(orders_df):
     ))
     return bar_fig
 
-def count_orders_day(orders_df):
+@timed('figure.build', figure = 'count_orders_day')
+def count_orders_day(dow_counts):
     count_fig = go.Figure(data = [go.Bar(
-        x = orders_df['order_dow'].value_counts(),
+        x = dow_counts.sort_values("count", ascending = False)["count"].values,
         marker_color = colors,
     )],
     layout = dict(
@@ -57,25 +111,28 @@ def count_orders_day(orders_df):
     ))
     return count_fig
 
-def heat_map_orders_day_hour(orders_df):
+@timed('figure.build', figure = 'heat_map_orders_day_hour')
+def heat_map_orders_day_hour(dow_hour_counts, color_label = "Number Of Orders"):
     # Combine the day of week and hour of day to see the distribution
-    grouped_df = orders_df.groupby(["order_dow", "order_hour_of_day"])["order_number"].agg("count").reset_index()
-    grouped_pivot_df = grouped_df.pivot('order_dow', 'order_hour_of_day', 'order_number')
+    grouped_pivot_df = dow_hour_counts.pivot(index = 'order_dow', columns = 'order_hour_of_day', values = 'count')
+    if grouped_pivot_df.empty:
+        return go.Figure(layout = dict(title = {'text': 'No Orders For The Selected Filters'}))
 
     heat_fig = px.imshow(grouped_pivot_df,
-        labels=dict(x="Hour Of Day", y="Day Of Week", color="Number Of Orders"),
-        x=['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16', '17', '18', '19', '20', '21', '22', '23'],
-        y=['Sat', 'Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri']
+        labels=dict(x="Hour Of Day", y="Day Of Week", color=color_label),
+        x=[str(hour) for hour in grouped_pivot_df.columns],
+        y=[day_names[dow] for dow in grouped_pivot_df.index]
     )
     return heat_fig
 
-def bar_top_aisle(order_products_prior_df):
-    # Obtain top important aisles
-    count_srs = order_products_prior_df['aisle'].value_counts().head(15)
+@timed('figure.build', figure = 'bar_top_aisle')
+def bar_top_aisle(aisle_stats, aisle_names):
+    # Obtain top important aisles, only their names are looked up
+    count_srs = aisle_stats.nlargest(15, "order_count")
 
     bar_fig = go.Figure(data = [go.Bar(
-        x = count_srs.index,
-        y = count_srs.values,
+        x = aisle_names(count_srs["aisle_id"]),
+        y = count_srs["order_count"].values,
         marker_color = colors,
     )],
     layout = dict(
@@ -85,13 +142,14 @@ def bar_top_aisle(order_products_prior_df):
     ))
     return bar_fig
 
-def scatter_department_reorder_ratio(order_products_prior_df):
+@timed('figure.build', figure = 'scatter_department_reorder_ratio')
+def scatter_department_reorder_ratio(department_stats, department_names):
     # Reorder ratio of each department
-    grouped_df = order_products_prior_df.groupby(["department"])["reordered"].agg("mean").reset_index()
+    grouped_df = department_stats.assign(department = department_names(department_stats["department_id"])).sort_values("department")
 
     scatter_fig = go.Figure(data = [go.Scatter(
         x = grouped_df['department'].values,
-        y = grouped_df['reordered'].values,
+        y = (grouped_df['reorder_sum'] / grouped_df['order_count']).values,
         mode='lines+markers'
     )],
     layout = dict(
@@ -101,31 +159,172 @@ def scatter_department_reorder_ratio(order_products_prior_df):
     ))
     return scatter_fig
 
+@timed('figure.build', figure = 'bar_frequently_bought_with')
+def bar_frequently_bought_with(partners_df, product_name, metric = "lift"):
+    # Products most associated with the selected one, hover shows every association measure
+    partners_df = partners_df.iloc[::-1]
+
+    bar_fig = go.Figure(data = [go.Bar(
+        x = partners_df[metric].values,
+        y = partners_df["partner_name"].values,
+        orientation = 'h',
+        marker_color = colors[12],
+        customdata = partners_df[["pair_count", "confidence", "lift"]].values,
+        hovertemplate = "%{y}<br>Orders together: %{customdata[0]}<br>Confidence: %{customdata[1]:.1%}<br>Lift: %{customdata[2]:.2f}<extra></extra>",
+    )],
+    layout = dict(
+        title = {'text': f'Frequently Bought With {product_name}'},
+        xaxis = {'title': metric.capitalize()},
+        yaxis = {'title': 'Product', 'automargin': True},
+        height = 500
+    ))
+    return bar_fig
+
+def filtered_figure(graph_id, aggregates, days, hours, department_ids):
+    # Answer filtered views from the precomputed count cube instead of the raw orders
+    count_cube = slice_count_cube(aggregates['count_cube'], days, hours, department_ids)
+
+    if graph_id == 'heat_map_orders_day_hour':
+        if not department_ids:
+            return heat_map_orders_day_hour(slice_count_cube(aggregates['dow_hour_counts'], days, hours))
+        dow_hour_counts = rollup_count_cube(count_cube, ['order_dow', 'order_hour_of_day']).rename(columns = {'order_count': 'count'})
+        return heat_map_orders_day_hour(dow_hour_counts, color_label = "Number Of Products Ordered")
+
+    if graph_id == 'top_aisle':
+        return bar_top_aisle(rollup_count_cube(count_cube, ['aisle_id']), partial(dimension_names, aggregates, 'aisle'))
+
+    department_stats = rollup_count_cube(count_cube, ['department_id'])
+    return scatter_department_reorder_ratio(department_stats, partial(dimension_names, aggregates, 'department'))
+
 
 # App ####################################################################################################################
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 server = app.server
 
+# Figures & javascript bundles are gzip / brotli compressed for remote browsers
+compress_responses(server)
+
+# Request latencies per route / callback output & the spans of loads and figure builders, on /metrics
+register_metrics_endpoint(server)
+
 app.title = 'Market Basket Analysis'
 
 app.layout = html.Div(children = [
 
+    dcc.Location(id = 'url'),
+
     html.H2(style = {'textAlign': 'center', 'fontFamily': "Sans-Serif"},
     children = "Market Basket Analysis"),
 
-    html.Div([ dcc.Graph(id = 'bar_max_order_num', figure = bar_max_order_num(orders_df)) ]),
+    html.Div([ dcc.Graph(id = 'bar_max_order_num') ]),
 
     html.Div([
-        html.Div([ dcc.Graph(id = 'count_orders_day', figure = count_orders_day(orders_df)) ], className = "six columns"),
-        html.Div([ dcc.Graph(id = 'heat_map_orders_day_hour', figure = heat_map_orders_day_hour(orders_df)) ], className = "six columns")
+        html.Div([ dcc.Dropdown(id = 'day_filter', multi = True, placeholder = 'Day of week',
+            options = [{'label': name, 'value': dow} for dow, name in enumerate(day_names)]) ], className = "three columns"),
+        html.Div([ dcc.RangeSlider(id = 'hour_filter', min = 0, max = 23, step = 1, value = all_hours,
+            marks = {hour: str(hour) for hour in range(0, 24, 3)}) ], className = "five columns"),
+        html.Div([ dcc.Dropdown(id = 'department_filter', multi = True, placeholder = 'Department') ], className = "four columns"),
     ], className = "row"),
 
-    html.Div([ dcc.Graph(id = 'top_aisle', figure = bar_top_aisle(order_products_prior_df)) ]),
+    html.Div([
+        html.Div([ dcc.Graph(id = 'count_orders_day') ], className = "six columns"),
+        html.Div([ dcc.Graph(id = 'heat_map_orders_day_hour') ], className = "six columns")
+    ], className = "row"),
+
+    html.Div([ dcc.Graph(id = 'top_aisle') ]),
+
+    html.Div([ dcc.Graph(id = 'scatter_department_reorder_ratio') ]),
+
+    html.Div([
+        html.Div([ dcc.Dropdown(id = 'product_search', placeholder = 'Search a product') ], className = "eight columns"),
+        html.Div([ dcc.RadioItems(id = 'association_metric', value = 'lift', inline = True,
+            options = [{'label': 'Lift', 'value': 'lift'}, {'label': 'Confidence', 'value': 'confidence'}]) ], className = "four columns"),
+    ], className = "row"),
 
-    html.Div([ dcc.Graph(id = 'scatter_department_reorder_ratio', figure = scatter_department_reorder_ratio(order_products_prior_df)) ]),
+    html.Div([ dcc.Graph(id = 'frequently_bought_with') ]),
 
 ])
 
+# Graph id -> (figure function, aggregate it is built from, dimension whose names it draws)
+figure_builders = {
+    'bar_max_order_num': (bar_max_order_num, 'max_order_number_counts', None),
+    'count_orders_day': (count_orders_day, 'dow_counts', None),
+    'heat_map_orders_day_hour': (heat_map_orders_day_hour, 'dow_hour_counts', None),
+    'top_aisle': (bar_top_aisle, 'aisle_stats', 'aisle'),
+    'scatter_department_reorder_ratio': (scatter_department_reorder_ratio, 'department_stats', 'department'),
+}
+
+
+# Graphs which follow the day / hour / department filters
+filterable_graphs = ['heat_map_orders_day_hour', 'top_aisle', 'scatter_department_reorder_ratio']
+filter_inputs = [Input('day_filter', 'value'), Input('hour_filter', 'value'), Input('department_filter', 'value')]
+
+
+def build_figure(figure_function, aggregates, aggregate_name, dimension):
+    # Figures get the id only aggregate & resolve the names they draw through the dimension table
+    if dimension is None:
+        return figure_function(aggregates[aggregate_name])
+    return figure_function(aggregates[aggregate_name], partial(dimension_names, aggregates, dimension))
+
+def register_figure_callback(graph_id, figure_function, aggregate_name, dimension):
+    # One callback per graph so the page fills in incrementally
+    def cached_figure():
+        meta = store_meta()
+        figure_json = figure_cache.get_or_build(
+            graph_id,
+            meta['version'],
+            lambda: build_figure(figure_function, get_aggregates(meta), aggregate_name, dimension)
+        )
+        return json.loads(figure_json)
+
+    if graph_id not in filterable_graphs:
+        @app.callback(Output(graph_id, 'figure'), Input('url', 'pathname'))
+        def render_figure(pathname):
+            return cached_figure()
+        return
+
+    @app.callback(Output(graph_id, 'figure'), Input('url', 'pathname'), *filter_inputs)
+    def render_filtered_figure(pathname, days, hours, department_ids):
+        if not days and hours in (None, all_hours) and not department_ids:
+            return cached_figure()
+        with span('figure.filtered', figure = graph_id):
+            return json.loads(compact_figure(filtered_figure(graph_id, get_aggregates(store_meta()), days, hours, department_ids)))
+
+
+for graph_id, (figure_function, aggregate_name, dimension) in figure_builders.items():
+    register_figure_callback(graph_id, figure_function, aggregate_name, dimension)
+
+
+@app.callback(Output('department_filter', 'options'), Input('url', 'pathname'))
+def department_filter_options(pathname):
+    departments = get_aggregates(store_meta())['departments'].astype({'department': str}).sort_values('department')
+    return [{'label': row.department, 'value': int(row.department_id)} for row in departments.itertuples()]
+
+@app.callback(Output('product_search', 'options'), Input('product_search', 'search_value'), State('product_search', 'value'))
+def product_search_options(search_value, product_id):
+    # Options are searched server side, the product list is too long to ship to the browser
+    associations = get_associations(association_meta())
+    options = [{'label': row.product_name, 'value': int(row.product_id)} for row in associations.search_products(search_value).itertuples()]
+    if product_id is not None and all(option['value'] != product_id for option in options):
+        options.append({'label': associations.product_name(product_id), 'value': product_id})
+    return options
+
+
+@app.callback(Output('frequently_bought_with', 'figure'), Input('product_search', 'value'), Input('association_metric', 'value'))
+def frequently_bought_with(product_id, metric):
+    meta = association_meta()
+    associations = get_associations(meta)
+    if product_id is None:
+        product_id = int(associations.products['product_id'].iloc[0])
+
+    # The generation changes with every rebuild, the build parameters are part of the key all the same
+    figure_json = association_figure_cache.get_or_build(
+        f'frequently_bought_with-{product_id}-{metric}',
+        f"{meta['generation']}-{meta['min_pair_count']}-{meta['max_partners']}",
+        lambda: bar_frequently_bought_with(associations.frequently_bought_with(product_id, by = metric), associations.product_name(product_id), metric)
+    )
+    return json.loads(figure_json)
+
 if __name__ == "__main__":
     app.run_server()
\ No newline at end of file
@@ -0,0 +1,326 @@
+"""
+Co-purchase (association rule) index over the prior order products.
+
+Baskets are integer encoded as a sparse orders x items matrix B, one chunk of orders at a time, and pair counts
+are accumulated as the upper triangle of B.T @ B. Only products in at least min_pair_count orders can form a pair
+that frequent (a-priori pruning), so the pair matrix stays bounded by the frequent products. Support, confidence
+& lift of the product pairs (top max_partners per product) & of all aisle pairs are persisted next to the
+aggregate store, and served by AssociationIndex with a binary search per query.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from aggregates import add_counts, dataset_signature, dataset_version
+from data_loader import CACHE_DIR, CHUNK_SIZE, iter_table, load_table, pq
+from metrics import timed
+from store import create_generation, publish_meta, read_meta
+
+
+ASSOCIATION_DIR = os.path.join(CACHE_DIR, "associations")
+
+# Bump when the tables below change so existing indexes are rebuilt
+ASSOCIATION_FORMAT_VERSION = 2
+
+# Pairs bought together in fewer orders are not indexed (also the a-priori threshold of single products)
+MIN_PAIR_COUNT = int(os.environ.get("ASSOCIATION_MIN_PAIR_COUNT", 10))
+
+# Partners indexed per product, the most often bought together first
+MAX_PARTNERS = int(os.environ.get("ASSOCIATION_MAX_PARTNERS", 100))
+
+BASKET_COLUMNS = ["order_id", "product_id"]
+
+
+def iter_baskets(chunk_size: int = CHUNK_SIZE):
+    """
+    Generator to read the prior order products in chunks of whole baskets: the trailing order of a chunk is held
+    back until the next one, as the rows of an order are contiguous in the Instacart files
+    """
+    pending = None
+    for order_products_df in iter_table("order_products__prior", BASKET_COLUMNS, chunk_size):
+        if pending is not None:
+            order_products_df = pd.concat([pending, order_products_df], ignore_index = True)
+        if len(order_products_df) == 0:
+            continue
+
+        order_ids = order_products_df["order_id"].to_numpy()
+        other_orders = np.flatnonzero(order_ids != order_ids[-1])
+        trailing_start = other_orders[-1] + 1 if len(other_orders) else 0
+        pending = order_products_df.iloc[trailing_start:]
+        if trailing_start > 0:
+            yield order_products_df.iloc[:trailing_start]
+
+    if pending is not None and len(pending) > 0:
+        yield pending
+
+
+def basket_matrix(order_ids: np.ndarray, item_ids: np.ndarray, n_items: int) -> sparse.csr_matrix:
+    """
+    Function to return the binary orders x items matrix of a chunk of baskets (an item counted once per order)
+    """
+    order_index = np.unique(order_ids, return_inverse = True)[1]
+    baskets = sparse.csr_matrix(
+        (np.ones(len(order_index), dtype = np.int32), (order_index, item_ids)),
+        shape = (order_index.max() + 1 if len(order_index) else 0, n_items)
+    )
+    baskets.sum_duplicates()
+    baskets.data[:] = 1
+    return baskets
+
+
+class PairAccumulator:
+    """
+    Running pair counts (upper triangle of B.T @ B) & single item counts of dense item indices over chunks of baskets
+    """
+    def __init__(self, n_items: int) -> None:
+        self.n_items = n_items
+        self.item_counts = np.zeros(n_items, dtype = np.int64)
+        self.pair_counts = sparse.csr_matrix((n_items, n_items), dtype = np.int64)
+
+    def update(self, order_ids: np.ndarray, item_ids: np.ndarray) -> None:
+        if len(order_ids) == 0:
+            return
+        baskets = basket_matrix(order_ids, item_ids, self.n_items)
+        self.item_counts += np.asarray(baskets.sum(axis = 0)).ravel()
+        self.pair_counts = self.pair_counts + sparse.triu(baskets.T @ baskets, k = 1, format = "csr").astype(np.int64)
+
+    def merge(self, other: "PairAccumulator") -> "PairAccumulator":
+        """
+        Function to fold the counts of another (partial) accumulator into this one
+        """
+        self.item_counts += other.item_counts
+        self.pair_counts = self.pair_counts + other.pair_counts
+        return self
+
+    def pairs(self, min_pair_count: int = 1) -> tuple:
+        """
+        Function to return the (item_a, item_b, pair_count) arrays of the pairs bought together at least min_pair_count times
+        """
+        pair_counts = self.pair_counts.tocoo()
+        frequent = pair_counts.data >= min_pair_count
+        return pair_counts.row[frequent], pair_counts.col[frequent], pair_counts.data[frequent]
+
+
+def pair_metrics(item_a: np.ndarray, item_b: np.ndarray, pair_count: np.ndarray, item_counts: np.ndarray, order_count: int) -> dict:
+    """
+    Function to return both directions (a -> b & b -> a) of the pairs with their support, confidence & lift
+    """
+    antecedent = np.concatenate([item_a, item_b])
+    consequent = np.concatenate([item_b, item_a])
+    pair_count = np.concatenate([pair_count, pair_count])
+
+    return {
+        "antecedent": antecedent,
+        "consequent": consequent,
+        "pair_count": pair_count,
+        "support": (pair_count / order_count).astype(np.float32),
+        "confidence": (pair_count / item_counts[antecedent]).astype(np.float32),
+        "lift": (pair_count * order_count / (item_counts[antecedent] * item_counts[consequent].astype(np.float64))).astype(np.float32),
+    }
+
+
+def top_partners(metrics: dict, max_partners: int) -> dict:
+    """
+    Function to keep the max_partners most frequent consequents of every antecedent, sorted by antecedent
+    """
+    order = np.lexsort((-metrics["pair_count"], metrics["antecedent"]))
+    antecedent = metrics["antecedent"][order]
+    group_start = np.searchsorted(antecedent, antecedent, side = "left")
+    keep = order[np.arange(len(order)) - group_start < max_partners]
+    return {name: values[keep] for name, values in metrics.items()}
+
+
+@timed("associations.build", memory = True)
+def build_associations(chunk_size: int = CHUNK_SIZE, min_pair_count: int = MIN_PAIR_COUNT, max_partners: int = MAX_PARTNERS) -> dict:
+    """
+    Function to compute the product pair & aisle pair tables from two streaming passes over the prior order products
+    """
+    products_df = load_table("products", columns = ["product_id", "product_name", "aisle_id"])
+    aisle_of_product = np.zeros(products_df["product_id"].max() + 1, dtype = np.int32)
+    aisle_of_product[products_df["product_id"].to_numpy()] = products_df["aisle_id"].to_numpy()
+    n_aisles = int(products_df["aisle_id"].max()) + 1
+
+    # First pass: orders per product & number of baskets, to find the products frequent enough to pair
+    order_count = 0
+    product_counts = np.zeros(0, dtype = np.int64)
+    for baskets_df in iter_baskets(chunk_size):
+        order_count += baskets_df["order_id"].nunique()
+        product_counts = add_counts(product_counts, np.bincount(baskets_df.drop_duplicates()["product_id"].to_numpy()))
+
+    frequent_products = np.flatnonzero(product_counts >= min_pair_count)
+    dense_product = np.full(len(product_counts), -1, dtype = np.int32)
+    dense_product[frequent_products] = np.arange(len(frequent_products), dtype = np.int32)
+
+    # Second pass: pair counts of the frequent products & of the aisles
+    product_pairs = PairAccumulator(len(frequent_products))
+    aisle_pairs = PairAccumulator(n_aisles)
+    for baskets_df in iter_baskets(chunk_size):
+        order_ids = baskets_df["order_id"].to_numpy()
+        product_ids = baskets_df["product_id"].to_numpy()
+
+        frequent = dense_product[product_ids] >= 0
+        product_pairs.update(order_ids[frequent], dense_product[product_ids[frequent]])
+        aisle_ids = aisle_of_product[np.minimum(product_ids, len(aisle_of_product) - 1)]
+        known = (product_ids < len(aisle_of_product)) & (aisle_ids > 0)
+        aisle_pairs.update(order_ids[known], aisle_ids[known])
+
+    item_a, item_b, pair_count = product_pairs.pairs(min_pair_count)
+    product_metrics = top_partners(
+        pair_metrics(frequent_products[item_a], frequent_products[item_b], pair_count, product_counts, order_count),
+        max_partners
+    )
+    aisle_metrics = pair_metrics(*aisle_pairs.pairs(), aisle_pairs.item_counts, order_count)
+
+    product_ids = np.flatnonzero(product_counts)
+    product_names = products_df.set_index("product_id")["product_name"].reindex(product_ids)
+    return {
+        "product_pairs": pd.DataFrame({
+            "product_id": product_metrics.pop("antecedent").astype(np.int32),
+            "partner_id": product_metrics.pop("consequent").astype(np.int32),
+            **product_metrics,
+        }),
+        "aisle_pairs": pd.DataFrame({
+            "aisle_id": aisle_metrics.pop("antecedent").astype(np.int16),
+            "partner_id": aisle_metrics.pop("consequent").astype(np.int16),
+            **aisle_metrics,
+        }).sort_values(["aisle_id", "lift"], ascending = [True, False], ignore_index = True),
+        "products": pd.DataFrame({
+            "product_id": product_ids.astype(np.int32),
+            "product_name": product_names.fillna("").to_numpy(),
+            "order_count": product_counts[product_ids],
+        }),
+        "order_count": order_count,
+    }
+
+
+class AssociationIndex:
+    """
+    Query side of the association tables: partners of a product are a contiguous, binary searched slice
+    """
+    def __init__(self, product_pairs: pd.DataFrame, aisle_pairs: pd.DataFrame, products: pd.DataFrame, order_count: int) -> None:
+        self.product_pairs = product_pairs
+        self.aisle_pairs = aisle_pairs
+        self.products = products.sort_values("order_count", ascending = False, ignore_index = True)
+        self.order_count = order_count
+
+        # Plain arrays, a query only slices & sorts a product's few partners
+        self._pair_columns = {name: product_pairs[name].to_numpy() for name in product_pairs.columns}
+        self._product_names = pd.Series(self.products["product_name"].to_numpy(), index = self.products["product_id"].to_numpy())
+
+    def product_name(self, product_id: int) -> str:
+        return self._product_names.get(product_id, str(product_id))
+
+    def frequently_bought_with(self, product_id: int, n: int = 15, by: str = "lift") -> pd.DataFrame:
+        """
+        Function to return the n products most associated with the given one, ranked by lift, confidence or pair_count
+        """
+        start, end = np.searchsorted(self._pair_columns["product_id"], [product_id, product_id + 1])
+        top = start + np.argsort(-self._pair_columns[by][start:end], kind = "stable")[:n]
+        partners = pd.DataFrame({name: values[top] for name, values in self._pair_columns.items()})
+        partners["partner_name"] = self._product_names.reindex(partners["partner_id"]).to_numpy()
+        return partners
+
+    def aisles_bought_with(self, aisle_id: int, n: int = 15, by: str = "lift") -> pd.DataFrame:
+        return self.aisle_pairs[self.aisle_pairs["aisle_id"] == aisle_id].nlargest(n, by).reset_index(drop = True)
+
+    def search_products(self, text: str = None, limit: int = 50) -> pd.DataFrame:
+        """
+        Function to return the most ordered products whose name contains the text (case insensitive)
+        """
+        products = self.products
+        if text:
+            products = products[products["product_name"].str.contains(text, case = False, regex = False)]
+        return products.head(limit)
+
+
+# Store ##################################################################################################################
+def _association_path(meta: dict, name: str) -> str:
+    return os.path.join(ASSOCIATION_DIR, meta["generation"], f"{name}.parquet")
+
+
+def save_associations(associations: dict, signature: dict, min_pair_count: int = MIN_PAIR_COUNT, max_partners: int = MAX_PARTNERS) -> None:
+    """
+    Function to persist the association tables into a new generation directory, then atomically point meta.json at it
+    """
+    os.makedirs(ASSOCIATION_DIR, exist_ok = True)
+    generation, generation_dir = create_generation(ASSOCIATION_DIR)
+    tables = {name: df for name, df in associations.items() if isinstance(df, pd.DataFrame)}
+    for name, df in tables.items():
+        df.to_parquet(os.path.join(generation_dir, f"{name}.parquet"), engine = "pyarrow", index = False)
+
+    meta = {
+        "version": dataset_version(signature),
+        "format_version": ASSOCIATION_FORMAT_VERSION,
+        "signature": signature,
+        "generation": generation,
+        "min_pair_count": min_pair_count,
+        "max_partners": max_partners,
+        "order_count": associations["order_count"],
+        "tables": sorted(tables),
+    }
+    publish_meta(ASSOCIATION_DIR, meta, keep_generations = 2)
+
+
+def read_association_meta() -> dict:
+    """
+    Function to read the meta data of the persisted index, empty if there is none
+    """
+    return read_meta(ASSOCIATION_DIR)
+
+
+def is_index_fresh(meta: dict, signature: dict = None, min_pair_count: int = MIN_PAIR_COUNT, max_partners: int = MAX_PARTNERS) -> bool:
+    """
+    Function to check whether an index was built with these thresholds from the current source data (from any
+    source data without a signature)
+    """
+    expected = {"format_version": ASSOCIATION_FORMAT_VERSION, "min_pair_count": min_pair_count, "max_partners": max_partners}
+    if signature is not None:
+        expected["signature"] = signature
+    return all(meta.get(name) == value for name, value in expected.items())
+
+
+def refresh_associations(chunk_size: int = CHUNK_SIZE, min_pair_count: int = MIN_PAIR_COUNT, max_partners: int = MAX_PARTNERS) -> bool:
+    """
+    Function to rebuild & publish the index when the source csv files or thresholds changed, returns whether it was rebuilt
+    """
+    signature = dataset_signature()
+    if is_index_fresh(read_association_meta(), signature, min_pair_count, max_partners):
+        return False
+    save_associations(build_associations(chunk_size, min_pair_count, max_partners), signature, min_pair_count, max_partners)
+    return True
+
+
+@timed("associations.open", memory = True)
+def open_associations(meta: dict) -> AssociationIndex:
+    """
+    Function to read the index of a published generation
+    """
+    tables = {name: pd.read_parquet(_association_path(meta, name), engine = "pyarrow", memory_map = True) for name in meta["tables"]}
+    return AssociationIndex(tables["product_pairs"], tables["aisle_pairs"], tables["products"], meta["order_count"])
+
+
+def load_associations(chunk_size: int = CHUNK_SIZE, min_pair_count: int = MIN_PAIR_COUNT, max_partners: int = MAX_PARTNERS) -> AssociationIndex:
+    """
+    Function to load the association index, (re)building it when missing, stale or built with other thresholds
+    """
+    if pq is None:
+        associations = build_associations(chunk_size, min_pair_count, max_partners)
+        return AssociationIndex(associations["product_pairs"], associations["aisle_pairs"], associations["products"], associations["order_count"])
+
+    refresh_associations(chunk_size, min_pair_count, max_partners)
+    return open_associations(read_association_meta())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Build the co-purchase (association rule) index")
+    parser.add_argument("--chunk-size", type = int, default = CHUNK_SIZE, help = "rows of order products held in memory at once")
+    parser.add_argument("--min-pair-count", type = int, default = MIN_PAIR_COUNT, help = "orders a pair must appear in to be indexed")
+    parser.add_argument("--max-partners", type = int, default = MAX_PARTNERS, help = "partners indexed per product")
+    args = parser.parse_args()
+
+    associations = build_associations(args.chunk_size, args.min_pair_count, args.max_partners)
+    save_associations(associations, dataset_signature(), args.min_pair_count, args.max_partners)
+    print(f"Association index built: {ASSOCIATION_DIR} ({len(associations['product_pairs'])} product pairs, version {read_association_meta()['version']})")
@@ -0,0 +1,111 @@
+"""
+Benchmark of the card description parser over a synthetic corpus of templated & free text descriptions.
+
+    python benchmarks/bench_description_parser.py --cards 50000
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from description_parser import DESCRIPTION_FIELDS, parse_description, parse_descriptions
+
+
+def synthetic_descriptions(count: int, structured_ratio: float = 0.8, seed: int = 0) -> list:
+    """
+    Function to generate card descriptions shaped like the team's request template
+    """
+    rng = random.Random(seed)
+    teams = ["Finance", "Marketing", "Operations", "Sales", "Data"]
+    requirements = ["Dashboard", "Ad-hoc analysis", "Data extract", "Bug fix"]
+
+    descriptions = []
+    for i in range(count):
+        if rng.random() > structured_ratio:
+            descriptions.append(f"Please look into request {i}\nThanks!")
+            continue
+        values = {
+            'Reporting Team': rng.choice(teams),
+            'Requestor email': f"requestor{i}@example.com",
+            'Reporting manager email': f"manager{i % 97}@example.com",
+            'Type of requirement': rng.choice(requirements),
+        }
+        sections = [f"###{key}###\n{value}\n" for key, value in values.items() if rng.random() > 0.1]
+        sections.append("###Details###\n" + "Some longer free text line. " * rng.randint(1, 10) + "\n")
+        if rng.random() > 0.7:
+            sections.append("Attachment: https://example.com/file.xlsx\n###Ignored")
+        descriptions.append("".join(sections))
+    return descriptions
+
+
+def legacy_process_description(description: str):
+    """
+    The previous Helper.process_description (minus its print), kept as the baseline
+    """
+    if description.find("###") != -1:
+        data_arr = description.split("Attachment", 1)[0].split("###")
+        for i in range(len(data_arr)):
+            data_arr[i] = data_arr[i].replace("\n", "")
+            data_arr[i] = data_arr[i].strip()
+        data_arr = [string for string in data_arr if string]
+
+        keys = []
+        values = []
+        for i in range(len(data_arr)):
+            if i % 2 == 0:
+                keys.append(data_arr[i])
+            else:
+                values.append(data_arr[i])
+
+        data_dict = {}
+        for i in range(len(keys)):
+            data_dict[keys[i]] = values[i]
+        return data_dict
+    return description
+
+
+def legacy_with_print(description: str):
+    result = legacy_process_description(description)
+    print(result)
+    return result
+
+
+def time_it(function, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cards", type = int, default = 50000)
+    parser.add_argument("--repeat", type = int, default = 3)
+    args = parser.parse_args()
+
+    descriptions = synthetic_descriptions(args.cards)
+    assert [legacy_process_description(d) for d in descriptions] == [parse_description(d) for d in descriptions]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        legacy_printing = time_it(lambda: [legacy_with_print(d) for d in descriptions], args.repeat)
+    results = {
+        "cards": args.cards,
+        "legacy_with_print_s": legacy_printing,
+        "legacy_s": time_it(lambda: [legacy_process_description(d) for d in descriptions], args.repeat),
+        "parse_description_s": time_it(lambda: [parse_description(d) for d in descriptions], args.repeat),
+        "parse_descriptions_batch_s": time_it(lambda: parse_descriptions(descriptions), args.repeat),
+        "fields": list(DESCRIPTION_FIELDS.values()),
+    }
+    print(json.dumps(results, indent = 2))
+
+
+if __name__ == "__main__":
+    main()
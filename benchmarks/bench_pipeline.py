@@ -0,0 +1,219 @@
+"""
+Benchmark of the dashboard pipeline (table loading, aggregation, co-purchase index, feature store,
+figure construction) over synthetic
+Instacart-shaped datasets, each stage timed & memory profiled. Results are written as json so runs of
+different commits can be compared.
+
+    python benchmarks/bench_pipeline.py --scales 1 10 --output results.json
+    python benchmarks/bench_pipeline.py --scales 1 10 --compare results.json
+
+Every scale runs in its own process (the data directory is read by data_loader at import), on a dataset
+generated once under --data-root & reused by later runs.
+"""
+import argparse
+import gzip
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from synthetic_instacart import write_dataset
+
+
+class StageTimer:
+    """
+    Collects the wall time, peak traced memory (python & numpy allocations) & process max rss of named stages
+    """
+    def __init__(self, trace_memory: bool = True) -> None:
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def run(self, name: str, function, repeat: int = 1):
+        best = float("inf")
+        peak = 0
+        for _ in range(repeat):
+            gc.collect()
+            if self.trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            result = function()
+            best = min(best, time.perf_counter() - start)
+            if self.trace_memory:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+        self.stages[name] = {
+            "seconds": round(best, 6),
+            "peak_traced_mb": round(peak / 2 ** 20, 3) if self.trace_memory else None,
+            "max_rss_mb": round(max_rss_mb(), 3),
+        }
+        return result
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd = REPO_DIR, text = True, stderr = subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def data_dir_for(data_root: str, scale: float, seed: int) -> str:
+    return os.path.join(data_root, f"scale-{scale:g}-seed-{seed}")
+
+
+def run_scale(data_dir: str, workers: int, repeat: int, trace_memory: bool) -> dict:
+    """
+    Function to benchmark every stage on the dataset of data_dir (INSTACART_DATA_DIR must point at it before the
+    pipeline modules are imported)
+    """
+    import data_loader
+    import aggregates
+    import app
+    import associations
+    import features
+    import figure_payload
+
+    timer = StageTimer(trace_memory)
+    tables = list(data_loader.TABLE_DTYPES)
+
+    # Loading: csv -> parquet cache conversion, then column selective reads of the cache
+    for name in tables:
+        timer.run(f"load.build_cache.{name}", lambda: data_loader.build_cache(name))
+    for name in ["orders", "order_products__prior"]:
+        timer.run(f"load.cached.{name}", lambda: data_loader.load_table(name), repeat)
+    timer.run("load.csv.order_products__prior", lambda: data_loader.read_csv_typed("order_products__prior"))
+
+    # Aggregation: streaming build, persisted store & warm store reads
+    built = timer.run("aggregate.build", lambda: aggregates.build_aggregates(workers = 1))
+    if workers > 1:
+        timer.run(f"aggregate.build_workers_{workers}", lambda: aggregates.build_aggregates(workers = workers))
+    signature = aggregates.dataset_signature()
+    timer.run("aggregate.save_store", lambda: aggregates.save_aggregates(built, signature))
+    loaded = timer.run("aggregate.load_store", aggregates.load_aggregates, repeat)
+
+    # Co-purchase index: streaming build & "frequently bought with" queries
+    built_associations = timer.run("associations.build", associations.build_associations)
+    associations.save_associations(built_associations, signature)
+    association_index = timer.run("associations.load", associations.load_associations, repeat)
+    top_products = association_index.products["product_id"].head(100).tolist()
+    timer.run("associations.query_100", lambda: [association_index.frequently_bought_with(product_id) for product_id in top_products], repeat)
+
+    # Feature store: streaming build, memory mapped load & candidate lookups
+    feature_store = timer.run("features.build", features.FeatureStore.build)
+    features.save_features(feature_store, signature)
+    feature_store = timer.run("features.load", features.load_features, repeat)
+    user_ids = np.flatnonzero(np.asarray(feature_store.users["order_count"]))[:100]
+    timer.run("features.user_candidates_100", lambda: [feature_store.user_product_features(user_id) for user_id in user_ids], repeat)
+
+    # Figures: every dashboard figure from the loaded aggregates, plus its serialized size (plain, compact & gzipped)
+    payload_bytes = {}
+    for graph_id, (figure_function, aggregate_name, dimension) in app.figure_builders.items():
+        figure = timer.run(f"figure.{graph_id}", lambda: app.build_figure(figure_function, loaded, aggregate_name, dimension), repeat)
+        figure_json = timer.run(f"figure_json.{graph_id}", figure.to_json, repeat)
+        compact_json = timer.run(f"figure_compact.{graph_id}", lambda: figure_payload.compact_figure(figure), repeat)
+        payload_bytes[graph_id] = {
+            "json": len(figure_json),
+            "compact": len(compact_json),
+            "compact_gzip": len(gzip.compress(compact_json.encode())),
+        }
+
+    department_ids = loaded["department_stats"]["department_id"].head(3).tolist()
+    for graph_id in app.filterable_graphs:
+        timer.run(f"figure_filtered.{graph_id}", lambda: app.filtered_figure(graph_id, loaded, [0, 1], [8, 18], department_ids), repeat)
+
+    return {
+        "rows": {name: data_loader.pq.ParquetFile(data_loader.cache_path(name)).metadata.num_rows for name in tables},
+        "stages": timer.stages,
+        "figure_payload_bytes": payload_bytes,
+        "max_rss_mb": round(max_rss_mb(), 3),
+    }
+
+
+def run_scale_subprocess(args: argparse.Namespace, scale: float) -> dict:
+    data_dir = data_dir_for(args.data_root, scale, args.seed)
+    if not os.path.exists(os.path.join(data_dir, "orders.csv")):
+        print(f"Generating scale {scale:g} dataset in {data_dir}", file = sys.stderr)
+        write_dataset(data_dir, scale, seed = args.seed)
+
+    command = [sys.executable, os.path.abspath(__file__), "--run-scale", data_dir, "--workers", str(args.workers), "--repeat", str(args.repeat)]
+    if not args.trace_memory:
+        command.append("--no-trace-memory")
+    output = subprocess.check_output(command, env = dict(os.environ, INSTACART_DATA_DIR = data_dir), cwd = REPO_DIR, text = True)
+    return dict(json.loads(output), scale = scale)
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """
+    Function to print the time ratio (current / baseline) of every stage measured in both runs
+    """
+    baseline_scales = {run["scale"]: run for run in baseline["runs"]}
+    print(f"{'scale':>6} {'stage':<55} {'baseline s':>11} {'current s':>11} {'ratio':>7}")
+    for run in results["runs"]:
+        if run["scale"] not in baseline_scales:
+            continue
+        baseline_stages = baseline_scales[run["scale"]]["stages"]
+        for stage, measure in run["stages"].items():
+            if stage not in baseline_stages:
+                continue
+            before = baseline_stages[stage]["seconds"]
+            ratio = measure["seconds"] / before if before else float("nan")
+            print(f"{run['scale']:>6g} {stage:<55} {before:>11.4f} {measure['seconds']:>11.4f} {ratio:>7.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type = float, nargs = "+", default = [1, 10], help = "dataset sizes, 1 is ~1/100 of Instacart")
+    parser.add_argument("--data-root", default = os.path.join(tempfile.gettempdir(), "instacart-benchmark"))
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--workers", type = int, default = 1, help = "also time the aggregate build with this many processes")
+    parser.add_argument("--repeat", type = int, default = 3, help = "repetitions of the quick stages, the best time is kept")
+    parser.add_argument("--no-trace-memory", dest = "trace_memory", action = "store_false", help = "skip tracemalloc (slows python heavy stages)")
+    parser.add_argument("--output", help = "json file to write the results to (printed otherwise)")
+    parser.add_argument("--compare", help = "json results of a previous run to compare against")
+    parser.add_argument("--run-scale", help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scale is not None:
+        print(json.dumps(run_scale(args.run_scale, args.workers, args.repeat, args.trace_memory)))
+        return
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "runs": [run_scale_subprocess(args, scale) for scale in args.scales],
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2)
+    else:
+        print(json.dumps(results, indent = 2))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Benchmark of the Trello exporters against a local fake Trello server (benchmarks/fake_trello.py), reporting
+for each exporter its wall time, peak traced memory, requests received by the server (per route & status)
+& rows exported.
+
+    python benchmarks/bench_trello_export.py --cards 1000 --latency 0.01 --throttle-every 300 --output results.json
+
+The server runs in its own process so its work is neither timed nor traced. Requests are not rate limited
+by default, --rate 10 reproduces Trello's 100 requests per 10 seconds.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import requests
+from trello import TrelloClient
+
+from fake_trello import RedirectedSession, add_board_arguments
+from metrics import METRICS
+from trello_api import RateLimiter, TrelloApi
+from trello_cache import ResponseCache
+from trello_playground import Board, Helper, Member
+
+API_KEY = "benchmark-key"
+TOKEN = "benchmark-token"
+
+
+class FakeTrelloProcess:
+    """
+    Fake Trello server started in a subprocess, for the duration of a with block
+    """
+    def __init__(self, server_args: list) -> None:
+        self.server_args = server_args
+
+    def __enter__(self) -> "FakeTrelloProcess":
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(BENCHMARK_DIR, "fake_trello.py")] + self.server_args,
+            stdout = subprocess.PIPE,
+            text = True
+        )
+        started = json.loads(self.process.stdout.readline())
+        self.base_url = started["base_url"]
+        self.board_id = started["board_id"]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.process.terminate()
+        self.process.wait()
+
+    def stats(self) -> dict:
+        return requests.get(self.base_url.rsplit("/", 1)[0] + "/_stats").json()
+
+    def move_cards(self, count: int) -> list:
+        return requests.post(self.base_url.rsplit("/", 1)[0] + "/_move_cards", params = {"count": count}).json()
+
+
+def stats_difference(before: dict, after: dict) -> dict:
+    """
+    Function to return the requests received between two /_stats snapshots
+    """
+    def difference(name: str) -> dict:
+        counts = {key: value - before[name].get(key, 0) for key, value in after[name].items()}
+        return {key: value for key, value in counts.items() if value}
+
+    return {
+        "requests": after["requests"] - before["requests"],
+        "requests_by_route": difference("requests_by_route"),
+        "responses_by_status": difference("responses_by_status"),
+    }
+
+
+def count_rows(path: str) -> int:
+    with open(path) as f:
+        return sum(1 for _ in f) - 1
+
+
+def time_breakdown(snapshot: dict) -> dict:
+    """
+    Function to sum the seconds spent in http requests (all threads), row building & writing of an export
+    """
+    breakdown = {
+        "http": sum(histogram["sum"] for histogram in snapshot["histograms"] if histogram["name"] == "trello_request_seconds"),
+        "rate_limit_wait": sum(histogram["sum"] for histogram in snapshot["histograms"] if histogram["name"] == "trello_rate_limit_wait_seconds"),
+    }
+    for name in ["export.build_rows", "export.write"]:
+        breakdown[name.split(".")[1]] = sum(span["seconds"] for span in snapshot["spans"] if span["name"] == name)
+    return {name: round(seconds, 4) for name, seconds in breakdown.items()}
+
+
+def measure(server: FakeTrelloProcess, export, path: str, trace_memory: bool = True) -> dict:
+    """
+    Function to run an export once, timed & memory traced, with the requests the server received meanwhile
+    & the time the exporter spent in http requests, row building & writing (its metrics spans).
+    A failed export (e.g. py-trello does not retry 429s) is reported with its error instead of rows.
+    """
+    before = server.stats()
+    METRICS.reset()
+    error = None
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        export()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - start
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "seconds": round(seconds, 4),
+        "peak_traced_mb": round(peak / 2 ** 20, 3) if trace_memory else None,
+        "rows": count_rows(path) if error is None else None,
+        "error": error,
+        "breakdown_seconds": time_breakdown(METRICS.snapshot()),
+        **stats_difference(before, server.stats()),
+    }
+
+
+def run_exports(server: FakeTrelloProcess, args: argparse.Namespace, output_dir: str) -> dict:
+    board_id = server.board_id
+
+    def create_api(cache: ResponseCache = None) -> TrelloApi:
+        return TrelloApi(API_KEY, TOKEN, base_url = server.base_url, rate_limiter = RateLimiter(rate = args.rate, capacity = args.capacity),
+                         backoff = 0.05, cache = cache, pool_size = max(10, args.workers))
+
+    def output_path(name: str) -> str:
+        return os.path.join(output_dir, f"{name}.csv")
+
+    def measure_export(export, path: str) -> dict:
+        return measure(server, export, path, args.trace_memory)
+
+    results = {}
+
+    def per_card() -> None:
+        trello_client = TrelloClient(api_key = API_KEY, api_secret = TOKEN, token = TOKEN, http_service = RedirectedSession(server.base_url))
+        board = Board(trello_client).get_ad_hoc_board()
+        Helper.export_cards_to_csv(board, Member(board), create_api(), output_path("per_card"))
+
+    if not args.skip_per_card:
+        results["per_card"] = measure_export(per_card, output_path("per_card"))
+
+    results["concurrent"] = measure_export(
+        lambda: Helper.export_board_to_csv_concurrent(create_api(), board_id, args.workers, output_path("concurrent")),
+        output_path("concurrent")
+    )
+    results["board_wide"] = measure_export(
+        lambda: Helper.export_board_to_csv(create_api(), board_id, output_path("board_wide")),
+        output_path("board_wide")
+    )
+
+    # Second export through a cache whose entries are all stale: every response is revalidated with its ETag
+    revalidating_api = create_api(ResponseCache(ttls = {name: 0 for name in ResponseCache.DEFAULT_TTLS}))
+    Helper.export_board_to_csv(revalidating_api, board_id, output_path("board_wide_revalidated"))
+    results["board_wide_revalidated"] = measure_export(
+        lambda: Helper.export_board_to_csv(revalidating_api, board_id, output_path("board_wide_revalidated")),
+        output_path("board_wide_revalidated")
+    )
+
+    # Incremental export after a few cards moved since the full one
+    incremental_path = output_path("incremental")
+    Helper.export_board_incremental(create_api(), board_id, incremental_path)
+    server.move_cards(args.moved_cards)
+    results["incremental"] = measure_export(
+        lambda: Helper.export_board_incremental(create_api(), board_id, incremental_path),
+        incremental_path
+    )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    add_board_arguments(parser)
+    parser.add_argument("--workers", type = int, default = 8, help = "threads of the concurrent export")
+    parser.add_argument("--rate", type = float, default = 1e6, help = "requests per second allowed by the client rate limiter")
+    parser.add_argument("--capacity", type = int, default = 100, help = "burst size of the client rate limiter")
+    parser.add_argument("--moved-cards", type = int, default = 20, help = "cards moved before the incremental export")
+    parser.add_argument("--skip-per-card", action = "store_true", help = "skip the (slow) card by card py-trello export")
+    parser.add_argument("--no-trace-memory", dest = "trace_memory", action = "store_false", help = "skip tracemalloc (slows python heavy exports)")
+    parser.add_argument("--output", help = "json file to write the results to (printed otherwise)")
+    args = parser.parse_args()
+
+    server_args = []
+    for name in ["lists", "cards", "members", "labels", "moves_per_card", "seed", "latency", "throttle_every", "retry_after"]:
+        server_args += ["--" + name.replace("_", "-"), str(getattr(args, name))]
+
+    with FakeTrelloProcess(server_args) as server, tempfile.TemporaryDirectory() as output_dir:
+        results = {
+            "board": {name: getattr(args, name) for name in ["lists", "cards", "members", "labels", "moves_per_card", "seed"]},
+            "server": {name: getattr(args, name) for name in ["latency", "throttle_every", "retry_after"]},
+            "client": {name: getattr(args, name) for name in ["workers", "rate", "capacity"]},
+            "exports": run_exports(server, args, output_dir),
+        }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2)
+    else:
+        print(json.dumps(results, indent = 2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+"""
+Local fake of the Trello REST API serving a synthetic board, for exercising the exporters without network access.
+
+Serves the endpoints used by trello_playground (py-trello & TrelloApi): boards, lists, cards, members, labels
+& paginated actions, with optional latency, injected 429 responses & ETag revalidation. Request counters are
+exposed at /_stats, /_move_cards moves random cards between lists (new updateCard:idList actions).
+
+    python benchmarks/fake_trello.py --cards 2000 --latency 0.02 --throttle-every 200
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+
+TRELLO_BASE_URL = "https://api.trello.com/1"
+
+# Largest page of the actions endpoints & the page size when no limit is given
+MAX_ACTIONS_LIMIT = 1000
+DEFAULT_ACTIONS_LIMIT = 50
+
+# Boards created on 1 Jan 2022, one card every 10 minutes, moves spread over the following days
+BOARD_START = int(datetime(2022, 1, 1, tzinfo = timezone.utc).timestamp())
+
+
+def trello_date(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class FakeBoard:
+    """
+    Synthetic board shaped like the REST API's json: lists, members, labels, cards (templated & free text
+    descriptions, some archived) & a newest first history of createCard / updateCard:idList actions
+    """
+    def __init__(self, lists: int = 8, cards: int = 500, members: int = 12, labels: int = 6,
+                 moves_per_card: float = 4.0, archived_ratio: float = 0.1, seed: int = 0) -> None:
+        self.rng = random.Random(seed)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self.id = self.make_id(BOARD_START)
+        self.board = {"id": self.id, "name": "Ad-hoc Requests", "desc": "", "closed": False, "url": f"https://trello.com/b/{self.id}"}
+        self.lists = [
+            {"id": self.make_id(BOARD_START), "name": f"{i + 1}. Stage {i + 1} ({'Done' if i == lists - 1 else 'WIP'})",
+             "closed": False, "pos": 16384 * (i + 1), "idBoard": self.id}
+            for i in range(lists)
+        ]
+        self.members = [
+            {"id": self.make_id(BOARD_START), "fullName": f"Member {i + 1}", "username": f"member{i + 1}"}
+            for i in range(members)
+        ]
+        self.labels = [
+            {"id": self.make_id(BOARD_START), "idBoard": self.id, "name": f"Label {i + 1}", "color": "green"}
+            for i in range(labels)
+        ]
+
+        self.cards = {}
+        self.actions = []
+        for i in range(cards):
+            self._add_card(i, moves_per_card, archived_ratio)
+        self.actions.sort(key = lambda action: action["id"], reverse = True)
+
+        # Actions of every card, newest first, so card queries don't scan the whole board history
+        self.card_actions = {card_id: [] for card_id in self.cards}
+        for action in self.actions:
+            self.card_actions[action["data"]["card"]["id"]].append(action)
+
+    def make_id(self, timestamp: float) -> str:
+        """
+        Function to return a new object id, which like Trello's starts with its creation time as 8 hex digits
+        """
+        with self._lock:
+            self._next_id += 1
+            return f"{int(timestamp):08x}{self._next_id:016x}"
+
+    def description(self, index: int) -> str:
+        if self.rng.random() < 0.2:
+            return f"Could someone look into request {index}?\nThanks!"
+        return (
+            f"###Reporting Team###\nTeam {index % 7}\n"
+            f"###Requestor email###\nrequestor{index}@example.com\n"
+            f"###Reporting manager email###\nmanager{index % 13}@example.com\n"
+            f"###Type of requirement###\n{self.rng.choice(['Dashboard', 'Data extract', 'Ad-hoc analysis'])}\n"
+            "###Details###\n" + "Some more context on the request. " * self.rng.randint(1, 8)
+        )
+
+    def _add_card(self, index: int, moves_per_card: float, archived_ratio: float) -> None:
+        created = BOARD_START + index * 600
+        card_id = self.make_id(created)
+        trello_list = self.lists[0]
+        self.cards[card_id] = {
+            "id": card_id,
+            "name": f"Request {index + 1}",
+            "desc": self.description(index),
+            "idBoard": self.id,
+            "idList": trello_list["id"],
+            "idMembers": [member["id"] for member in self.rng.sample(self.members, self.rng.randint(0, 2))],
+            "labels": self.rng.sample(self.labels, self.rng.randint(0, 2)),
+            "closed": self.rng.random() < archived_ratio,
+            "dueComplete": False,
+            "due": None,
+            "pos": 16384 * (index + 1),
+            "idShort": index + 1,
+            "url": f"https://trello.com/c/{card_id}",
+            "shortUrl": f"https://trello.com/c/{card_id[-8:]}",
+            "badges": {"checkItems": 0, "comments": 0, "attachments": 0},
+            "idChecklists": [],
+            "dateLastActivity": trello_date(created),
+        }
+        self.cards[card_id]["idLabels"] = [label["id"] for label in self.cards[card_id]["labels"]]
+        self.actions.append(self._action("createCard", created, card_id, {"list": {"id": trello_list["id"], "name": trello_list["name"]}}))
+
+        moved = created
+        for _ in range(int(self.rng.expovariate(1 / moves_per_card)) if moves_per_card > 0 else 0):
+            moved += self.rng.randint(60, 3 * 86400)
+            self.actions.append(self._move(card_id, self.rng.choice(self.lists), moved))
+
+    def _action(self, action_type: str, timestamp: float, card_id: str, data: dict) -> dict:
+        card = self.cards[card_id]
+        return {
+            "id": self.make_id(timestamp),
+            "type": action_type,
+            "date": trello_date(timestamp),
+            "idMemberCreator": self.members[0]["id"],
+            "data": dict(data, card = {"id": card_id, "name": card["name"], "idShort": card["idShort"]}, board = {"id": self.id}),
+        }
+
+    def _move(self, card_id: str, destination: dict, timestamp: float) -> dict:
+        card = self.cards[card_id]
+        source = next(trello_list for trello_list in self.lists if trello_list["id"] == card["idList"])
+        card["idList"] = destination["id"]
+        card["dateLastActivity"] = trello_date(timestamp)
+        return self._action("updateCard", timestamp, card_id, {
+            "listBefore": {"id": source["id"], "name": source["name"]},
+            "listAfter": {"id": destination["id"], "name": destination["name"]},
+            "old": {"idList": source["id"]},
+        })
+
+    def move_cards(self, count: int) -> list:
+        """
+        Function to move random open cards to another list now, returns the new actions (newest first)
+        """
+        open_cards = [card_id for card_id, card in self.cards.items() if not card["closed"]]
+        actions = [self._move(card_id, self.rng.choice(self.lists), time.time()) for card_id in self.rng.sample(open_cards, min(count, len(open_cards)))]
+        actions.reverse()
+        self.actions[:0] = actions
+        for action in reversed(actions):
+            self.card_actions[action["data"]["card"]["id"]].insert(0, action)
+        return actions
+
+    @staticmethod
+    def matches_filter(action: dict, action_filter: str) -> bool:
+        """
+        Function to check an action against a filter like 'createCard,updateCard:idList' (type or type:changed field)
+        """
+        for name in filter(None, action_filter.split(",")):
+            action_type, _, field = name.partition(":")
+            if action["type"] == action_type and (not field or field in action["data"].get("old", {})):
+                return True
+        return action_filter == "all"
+
+    def query_actions(self, card_id: str = None, action_filter: str = "all", since: str = None, before: str = None, limit: int = DEFAULT_ACTIONS_LIMIT) -> list:
+        """
+        Function to return a page of actions, newest first, since / before being exclusive action ids or dates
+        """
+        def bound(value: str) -> str:
+            # Ids start with their timestamp, compare dates as the smallest id of that second
+            if re.fullmatch(r"[0-9a-f]{24}", value):
+                return value
+            return f"{int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()):08x}{0:016x}"
+
+        since, before = (bound(value) if value else None for value in (since, before))
+        page = []
+        for action in (self.actions if card_id is None else self.card_actions[card_id]):
+            if before is not None and action["id"] >= before:
+                continue
+            if since is not None and action["id"] <= since:
+                break
+            if self.matches_filter(action, action_filter):
+                page.append(action)
+                if len(page) == limit:
+                    break
+        return page
+
+
+class FakeTrelloHandler(BaseHTTPRequestHandler):
+    # Keep alive connections, like the real API (without Nagle's delay between the headers & body writes)
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    ROUTES = [
+        (re.compile(r"/members/me/boards"), "boards"),
+        (re.compile(r"/boards/(?P<id>\w+)"), "board"),
+        (re.compile(r"/boards/(?P<id>\w+)/lists"), "board_lists"),
+        (re.compile(r"/boards/(?P<id>\w+)/cards(?:/(?P<filter>\w+))?"), "board_cards"),
+        (re.compile(r"/boards/(?P<id>\w+)/members"), "board_members"),
+        (re.compile(r"/boards/(?P<id>\w+)/labels"), "board_labels"),
+        (re.compile(r"/boards/(?P<id>\w+)/actions"), "board_actions"),
+        (re.compile(r"/lists/(?P<id>\w+)/cards"), "list_cards"),
+        (re.compile(r"/cards/(?P<id>\w+)"), "card"),
+        (re.compile(r"/cards/(?P<id>\w+)/actions"), "card_actions"),
+    ]
+
+    def log_message(self, format, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status: int, body, headers: dict = None) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != "/_move_cards":
+            self.send_json(404, {"message": "not found"})
+            return
+        count = int(parse_qs(url.query).get("count", ["1"])[0])
+        self.send_json(200, self.server.board.move_cards(count))
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        path = "/" + url.path.strip("/")
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+        if path == "/_stats":
+            self.send_json(200, self.server.stats())
+            return
+
+        if not path.startswith("/1/"):
+            self.send_json(404, {"message": "not found"})
+            return
+        path = path[2:]
+
+        route, match = next(((name, pattern.fullmatch(path)) for pattern, name in self.ROUTES if pattern.fullmatch(path)), (None, None))
+        status = self.server.count_request(route)
+
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if status == 429:
+            self.send_json(429, {"message": "API_TOKEN_LIMIT_EXCEEDED"}, {"Retry-After": str(self.server.retry_after)})
+            return
+        # Key & token as query parameters (REST clients) or an OAuth header (py-trello)
+        if not (params.get("key") and params.get("token")) and not self.headers.get("Authorization"):
+            self.send_json(401, {"message": "invalid key"})
+            return
+        if route is None:
+            self.send_json(404, {"message": "not found"})
+            return
+
+        body = self.resolve(route, match.groupdict(), params)
+        if body is None:
+            self.server.count_status(404)
+            self.send_json(404, {"message": "The requested resource was not found."})
+            return
+
+        etag = f'W/"{hashlib.sha1(json.dumps(body).encode()).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.server.count_status(304)
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_json(200, body, {"ETag": etag})
+
+    def resolve(self, route: str, path_params: dict, params: dict):
+        """
+        Function to return the json body of a route, None for unknown ids
+        """
+        board = self.server.board
+        object_id = path_params.get("id")
+        if route not in ("boards", "list_cards", "card", "card_actions") and object_id != board.id:
+            return None
+
+        limit = min(int(params.get("limit", DEFAULT_ACTIONS_LIMIT)), MAX_ACTIONS_LIMIT)
+        action_query = dict(action_filter = params.get("filter", "all"), since = params.get("since"), before = params.get("before"), limit = limit)
+
+        if route == "boards":
+            return [board.board]
+        if route == "board":
+            return board.board
+        if route == "board_lists":
+            return [trello_list for trello_list in board.lists if params.get("filter", "open") == "all" or not trello_list["closed"]]
+        if route == "board_cards":
+            return self.select_fields(self.filter_cards(board.cards.values(), path_params.get("filter") or params.get("filter", "visible")), params)
+        if route == "board_members":
+            return self.select_fields(board.members, params)
+        if route == "board_labels":
+            return board.labels
+        if route == "board_actions":
+            return board.query_actions(**action_query)
+        if route == "list_cards":
+            cards = [card for card in board.cards.values() if card["idList"] == object_id]
+            return self.select_fields(self.filter_cards(cards, params.get("filter", "open")), params)
+        if object_id not in board.cards:
+            return None
+        if route == "card":
+            return self.select_fields([board.cards[object_id]], params)[0]
+        return board.query_actions(card_id = object_id, **action_query)
+
+    @staticmethod
+    def filter_cards(cards, card_filter: str) -> list:
+        if card_filter in ("open", "visible"):
+            return [card for card in cards if not card["closed"]]
+        if card_filter == "closed":
+            return [card for card in cards if card["closed"]]
+        return list(cards)
+
+    @staticmethod
+    def select_fields(objects: list, params: dict) -> list:
+        """
+        Function to keep only the requested 'fields' (plus id) of every object, like the real API
+        """
+        fields = params.get("fields", "all")
+        if fields == "all":
+            return list(objects)
+        names = set(fields.split(",")) | {"id"}
+        return [{name: value for name, value in obj.items() if name in names} for obj in objects]
+
+
+class FakeTrelloServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, board: FakeBoard, port: int = 0, latency: float = 0.0, throttle_every: int = 0,
+                 retry_after: float = 1.0, verbose: bool = False) -> None:
+        super().__init__(("127.0.0.1", port), FakeTrelloHandler)
+        self.board = board
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.verbose = verbose
+
+        self.requests_by_route = Counter()
+        self.responses_by_status = Counter()
+        self._request_count = 0
+        self._stats_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/1"
+
+    def count_request(self, route: str) -> int:
+        """
+        Function to count an API request, returns 429 when it is throttled else 200
+        """
+        with self._stats_lock:
+            self._request_count += 1
+            self.requests_by_route[route or "unknown"] += 1
+            status = 429 if self.throttle_every and self._request_count % self.throttle_every == 0 else 200
+            self.responses_by_status[status] += 1
+            return status
+
+    def count_status(self, status: int) -> None:
+        # Requests answered with something else than the 200 counted on arrival
+        with self._stats_lock:
+            self.responses_by_status[200] -= 1
+            self.responses_by_status[status] += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "requests": self._request_count,
+                "requests_by_route": dict(self.requests_by_route),
+                "responses_by_status": {str(status): count for status, count in self.responses_by_status.items()},
+            }
+
+    def start(self) -> "FakeTrelloServer":
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+        return self
+
+
+class RedirectedSession(requests.Session):
+    """
+    requests session sending calls made to the real API (e.g. by py-trello, whose base url is fixed) to the fake one,
+    pass as TrelloClient(http_service = RedirectedSession(server.base_url))
+    """
+    def __init__(self, base_url: str) -> None:
+        super().__init__()
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(TRELLO_BASE_URL):
+            url = self.base_url + url[len(TRELLO_BASE_URL):]
+        return super().request(method, url, *args, **kwargs)
+
+
+def add_board_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--lists", type = int, default = 8)
+    parser.add_argument("--cards", type = int, default = 500)
+    parser.add_argument("--members", type = int, default = 12)
+    parser.add_argument("--labels", type = int, default = 6)
+    parser.add_argument("--moves-per-card", type = float, default = 4.0)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--latency", type = float, default = 0.0, help = "seconds added to every response")
+    parser.add_argument("--throttle-every", type = int, default = 0, help = "answer every n-th request with a 429")
+    parser.add_argument("--retry-after", type = float, default = 1.0, help = "Retry-After of the 429 responses")
+
+
+def board_from_arguments(args: argparse.Namespace) -> FakeBoard:
+    return FakeBoard(lists = args.lists, cards = args.cards, members = args.members, labels = args.labels,
+                     moves_per_card = args.moves_per_card, seed = args.seed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    add_board_arguments(parser)
+    parser.add_argument("--port", type = int, default = 0, help = "0 picks a free port")
+    parser.add_argument("--verbose", action = "store_true")
+    args = parser.parse_args()
+
+    board = board_from_arguments(args)
+    server = FakeTrelloServer(board, args.port, args.latency, args.throttle_every, args.retry_after, args.verbose)
+    # First line of output, read by the benchmark
+    print(json.dumps({"base_url": server.base_url, "board_id": board.id}), flush = True)
+    print(f"Serving board {board.id} ({len(board.cards)} cards, {len(board.actions)} actions) on {server.base_url}", file = sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Generator of synthetic, Instacart-shaped csv files (same files, columns & value ranges) for offline benchmarks.
+
+Scale 1 is about a hundredth of the real dataset (2,062 users, ~34k orders, ~320k prior order products),
+scale 100 is about its full size.
+
+    python benchmarks/synthetic_instacart.py /tmp/instacart --scale 10
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Sizes of the real dataset
+USERS = 206_209
+PRODUCTS = 49_688
+AISLES = 134
+DEPARTMENTS = 21
+
+
+def scaled_sizes(scale: float, users: int = None, products: int = None) -> dict:
+    """
+    Function to return the number of users / products generated for a scale, overridable one by one
+    """
+    return {
+        "users": users if users is not None else max(10, int(USERS * scale / 100)),
+        "products": products if products is not None else max(AISLES, int(PRODUCTS * min(scale, 100) / 100)),
+    }
+
+
+def generate_tables(users: int, products: int, mean_basket: float = 10.0, seed: int = 0) -> dict:
+    """
+    Function to generate the six Instacart tables as data frames, vectorized so 100x scale stays quick to generate
+    """
+    rng = np.random.default_rng(seed)
+
+    aisles = pd.DataFrame({"aisle_id": np.arange(1, AISLES + 1), "aisle": [f"aisle {i}" for i in range(1, AISLES + 1)]})
+    departments = pd.DataFrame({
+        "department_id": np.arange(1, DEPARTMENTS + 1),
+        "department": [f"department {i}" for i in range(1, DEPARTMENTS + 1)]
+    })
+
+    # Every aisle belongs to one department & products are spread over aisles
+    aisle_department = rng.integers(1, DEPARTMENTS + 1, AISLES)
+    product_aisle = rng.integers(1, AISLES + 1, products)
+    products_df = pd.DataFrame({
+        "product_id": np.arange(1, products + 1),
+        "product_name": [f"product {i}" for i in range(1, products + 1)],
+        "aisle_id": product_aisle,
+        "department_id": aisle_department[product_aisle - 1],
+    })
+
+    # Users place between 4 & 100 orders (~16.6 on average, most users only a few), the last one is their train or test order
+    orders_per_user = np.minimum(3 + rng.geometric(1 / 13.6, users), 100)
+    order_count = int(orders_per_user.sum())
+    user_id = np.repeat(np.arange(1, users + 1), orders_per_user)
+    first_order = np.repeat(np.cumsum(orders_per_user) - orders_per_user, orders_per_user)
+    order_number = np.arange(order_count) - first_order + 1
+
+    eval_set = np.full(order_count, "prior", dtype = object)
+    last_order = np.cumsum(orders_per_user) - 1
+    eval_set[last_order] = np.where(rng.random(users) < 0.65, "train", "test")
+
+    days_since_prior_order = rng.integers(0, 31, order_count).astype("float64")
+    days_since_prior_order[order_number == 1] = np.nan
+
+    orders_df = pd.DataFrame({
+        "order_id": rng.permutation(order_count) + 1,
+        "user_id": user_id,
+        "eval_set": eval_set,
+        "order_number": order_number,
+        "order_dow": rng.integers(0, 7, order_count),
+        "order_hour_of_day": np.clip(rng.normal(13.5, 4, order_count).round(), 0, 23).astype("int64"),
+        "days_since_prior_order": days_since_prior_order,
+    })
+
+    # Baskets of geometric size, products drawn with a zipf-like popularity
+    popularity = 1.0 / np.arange(1, products + 1) ** 0.9
+    popularity /= popularity.sum()
+
+    def order_products(mask: np.ndarray) -> pd.DataFrame:
+        basket_orders = orders_df["order_id"].to_numpy()[mask]
+        basket_size = rng.geometric(1.0 / mean_basket, len(basket_orders))
+        order_id = np.repeat(basket_orders, basket_size)
+        starts = np.repeat(np.cumsum(basket_size) - basket_size, basket_size)
+        reordered = (rng.random(len(order_id)) < 0.6) & np.repeat(order_number[mask] > 1, basket_size)
+        return pd.DataFrame({
+            "order_id": order_id,
+            "product_id": rng.choice(products, len(order_id), p = popularity) + 1,
+            "add_to_cart_order": np.arange(len(order_id)) - starts + 1,
+            "reordered": reordered.astype("int64"),
+        })
+
+    return {
+        "aisles": aisles,
+        "departments": departments,
+        "products": products_df,
+        "orders": orders_df,
+        "order_products__prior": order_products(eval_set == "prior"),
+        "order_products__train": order_products(eval_set == "train"),
+    }
+
+
+def write_dataset(data_dir: str, scale: float = 1, users: int = None, products: int = None, seed: int = 0) -> dict:
+    """
+    Function to write a synthetic dataset as the Instacart csv files of data_dir, returns the row count of every file
+    """
+    os.makedirs(data_dir, exist_ok = True)
+    tables = generate_tables(**scaled_sizes(scale, users, products), seed = seed)
+    for name, df in tables.items():
+        df.to_csv(os.path.join(data_dir, f"{name}.csv"), index = False)
+    return {name: len(df) for name, df in tables.items()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data_dir")
+    parser.add_argument("--scale", type = float, default = 1)
+    parser.add_argument("--users", type = int)
+    parser.add_argument("--products", type = int)
+    parser.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args()
+
+    for name, rows in write_dataset(args.data_dir, args.scale, args.users, args.products, args.seed).items():
+        print(f"{name}: {rows} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Shared loading of the Instacart csv files.
+
+Each csv is converted once into a typed columnar cache (parquet) living next to the source files.
+Later loads read only the requested columns from the cache, and the cache is rebuilt whenever the
+source csv changes (detected from its mtime & size).
+"""
+import json
+import os
+
+import pandas as pd
+
+from metrics import span
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - pyarrow is optional, fall back to typed csv reads
+    pa = None
+    pq = None
+
+
+DATA_DIR = os.environ.get("INSTACART_DATA_DIR", "instacart-market-basket-analysis")
+CACHE_DIR = os.path.join(DATA_DIR, ".cache")
+
+# Bump when the dtypes below change so existing caches are rebuilt
+CACHE_FORMAT_VERSION = 1
+
+# Row group size of the parquet cache, also the unit of work for partitioned reads
+ROW_GROUP_SIZE = 1_000_000
+
+# Default number of rows held in memory at once by chunked reads
+CHUNK_SIZE = 1_000_000
+
+# Downcast dtypes for every Instacart table (int64/object by default in pandas)
+TABLE_DTYPES = {
+    "orders": {
+        "order_id": "int32",
+        "user_id": "int32",
+        "eval_set": "category",
+        "order_number": "int16",
+        "order_dow": "int8",
+        "order_hour_of_day": "int8",
+        "days_since_prior_order": "float32",
+    },
+    "order_products__prior": {
+        "order_id": "int32",
+        "product_id": "int32",
+        "add_to_cart_order": "int16",
+        "reordered": "int8",
+    },
+    "order_products__train": {
+        "order_id": "int32",
+        "product_id": "int32",
+        "add_to_cart_order": "int16",
+        "reordered": "int8",
+    },
+    "products": {
+        "product_id": "int32",
+        "product_name": "object",
+        "aisle_id": "int16",
+        "department_id": "int16",
+    },
+    "aisles": {
+        "aisle_id": "int16",
+        "aisle": "category",
+    },
+    "departments": {
+        "department_id": "int16",
+        "department": "category",
+    },
+}
+
+
+def csv_path(name: str) -> str:
+    return os.path.join(DATA_DIR, f"{name}.csv")
+
+
+def cache_path(name: str) -> str:
+    return os.path.join(CACHE_DIR, f"{name}.parquet")
+
+
+def source_signature(name: str) -> dict:
+    """
+    Function to describe the current state of a source csv, used to detect a stale cache
+    """
+    stat = os.stat(csv_path(name))
+    return {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "format_version": CACHE_FORMAT_VERSION,
+    }
+
+
+def _signature_path(name: str) -> str:
+    return os.path.join(CACHE_DIR, f"{name}.json")
+
+
+def is_cache_fresh(name: str) -> bool:
+    """
+    Function to check whether the parquet cache of a table matches its source csv
+    """
+    if not os.path.exists(cache_path(name)) or not os.path.exists(_signature_path(name)):
+        return False
+
+    with open(_signature_path(name)) as f:
+        cached_signature = json.load(f)
+
+    return cached_signature == source_signature(name)
+
+
+def read_csv_typed(name: str, columns: list = None, **kwargs) -> pd.DataFrame:
+    """
+    Function to read a source csv with the downcast dtypes of its table
+    """
+    dtypes = TABLE_DTYPES[name]
+    if columns is not None:
+        dtypes = {column: dtypes[column] for column in columns}
+
+    return pd.read_csv(csv_path(name), usecols = columns, dtype = dtypes, **kwargs)
+
+
+def build_cache(name: str) -> None:
+    """
+    Function to convert a source csv into its typed parquet cache, one row group at a time
+    """
+    os.makedirs(CACHE_DIR, exist_ok = True)
+    signature = source_signature(name)
+
+    # Write to temporary files & rename so concurrent workers never read a half written cache
+    tmp_cache = f"{cache_path(name)}.{os.getpid()}.tmp"
+    writer = None
+    try:
+        with span("load.build_cache", table = name, memory = True):
+            for chunk in read_csv_typed(name, chunksize = ROW_GROUP_SIZE):
+                if writer is None:
+                    table = pa.Table.from_pandas(chunk, preserve_index = False)
+                    writer = pq.ParquetWriter(tmp_cache, table.schema)
+                else:
+                    table = pa.Table.from_pandas(chunk, schema = writer.schema, preserve_index = False)
+                writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        # Header only csv, keep its typed (empty) schema
+        read_csv_typed(name, nrows = 0).to_parquet(tmp_cache, engine = "pyarrow", index = False)
+    os.replace(tmp_cache, cache_path(name))
+
+    tmp_signature = f"{_signature_path(name)}.{os.getpid()}.tmp"
+    with open(tmp_signature, "w") as f:
+        json.dump(signature, f)
+    os.replace(tmp_signature, _signature_path(name))
+
+
+def ensure_cache(name: str) -> bool:
+    """
+    Function to (re)build the cache of a table if needed, returns whether a usable cache exists
+    """
+    if pq is None:
+        return False
+    if not is_cache_fresh(name):
+        build_cache(name)
+    return True
+
+
+def load_table(name: str, columns: list = None) -> pd.DataFrame:
+    """
+    Function to load a typed Instacart table, restricted to the given columns
+    """
+    if not ensure_cache(name):
+        with span("load.csv", table = name, memory = True):
+            return read_csv_typed(name, columns)
+
+    with span("load.table", table = name, memory = True):
+        return pd.read_parquet(cache_path(name), engine = "pyarrow", columns = columns)
+
+
+def count_row_groups(name: str) -> int:
+    """
+    Function to return the number of row groups of a cached table (the partitions of parallel reads), 0 without a cache
+    """
+    if not ensure_cache(name):
+        return 0
+    return pq.ParquetFile(cache_path(name)).num_row_groups
+
+
+def iter_table(name: str, columns: list = None, chunk_size: int = CHUNK_SIZE, row_groups: list = None):
+    """
+    Generator to read a typed Instacart table in chunks of at most chunk_size rows, optionally only the given row groups
+    """
+    if not ensure_cache(name):
+        if row_groups is not None:
+            raise ValueError(f"Reading row groups of {name} requires its parquet cache (pyarrow)")
+        yield from read_csv_typed(name, columns, chunksize = chunk_size)
+        return
+
+    parquet_file = pq.ParquetFile(cache_path(name))
+    batches = parquet_file.iter_batches(batch_size = chunk_size, row_groups = row_groups, columns = columns)
+    while True:
+        # Only the read & conversion of a chunk is timed, not the consumer's work between chunks
+        with span("load.chunk", table = name):
+            batch = next(batches, None)
+            chunk = batch.to_pandas() if batch is not None else None
+        if chunk is None:
+            return
+        yield chunk
@@ -0,0 +1,67 @@
+#############################################################################################
+# Parser for templated Trello card descriptions.
+#
+# A templated description alternates '###'-delimited keys & values, anything from 'Attachment' on
+# is ignored. Free text descriptions (without '###') are returned unchanged.
+#############################################################################################
+
+from typing import Union
+
+import pandas as pd
+
+
+SECTION_DELIMITER = "###"
+
+# Everything from the first 'Attachment' on is not part of the template
+ATTACHMENT_MARKER = "Attachment"
+
+# Template keys exported as columns, with their column names
+DESCRIPTION_FIELDS = {
+    'Reporting Team': 'reporting_team',
+    'Requestor email': 'requestor_email',
+    'Reporting manager email': 'reporting_manager_email',
+    'Type of requirement': 'type_of_requirement',
+}
+
+
+def parse_description(description: str) -> Union[dict, str]:
+    """
+    Function to parse a templated description into a key / value dict in a single pass, without printing.
+    A key without a value (odd number of sections) is dropped.
+    """
+    if SECTION_DELIMITER not in description:
+        return description
+
+    # Newlines never split a delimiter, so they are dropped once for the whole body rather than per section
+    body = description.partition(ATTACHMENT_MARKER)[0].replace("\n", "")
+    pieces = [piece for piece in map(str.strip, body.split(SECTION_DELIMITER)) if piece]
+    return dict(zip(pieces[0::2], pieces[1::2]))
+
+
+def parse_descriptions(descriptions: list, missing: str = 'N/A') -> pd.DataFrame:
+    """
+    Function to parse a batch of descriptions into typed columns: one string column per DESCRIPTION_FIELDS key
+    (missing when absent from a templated description, null for free text), the untouched free text in
+    description_pre_standardise & whether the description was templated in is_structured
+    """
+    columns = {column: [] for column in DESCRIPTION_FIELDS.values()}
+    description_pre_standardise = []
+    is_structured = []
+
+    for description in descriptions:
+        parsed = parse_description(description)
+        if type(parsed) == dict:
+            for key, column in DESCRIPTION_FIELDS.items():
+                columns[column].append(parsed.get(key, missing))
+            description_pre_standardise.append(None)
+            is_structured.append(True)
+        else:
+            for column in columns.values():
+                column.append(None)
+            description_pre_standardise.append(parsed)
+            is_structured.append(False)
+
+    df = pd.DataFrame(columns, dtype = "string")
+    df['description_pre_standardise'] = pd.array(description_pre_standardise, dtype = "string")
+    df['is_structured'] = pd.array(is_structured, dtype = "bool")
+    return df
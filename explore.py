@@ -2,160 +2,305 @@
 
 """
 Try and explore the basic information about the dataset given. The goal of the competition is to predict which products will be in a user's next order.
-"""
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-color = sns.color_palette()
-pd.options.mode.chained_assignment = None
-pd.options.display.max_columns = 10
-
 
-"""
-Read all the files.
-"""
-order_products_train_df = pd.read_csv("instacart-market-basket-analysis/order_products__train.csv")
-order_products_prior_df = pd.read_csv("instacart-market-basket-analysis/order_products__prior.csv")
-orders_df = pd.read_csv("instacart-market-basket-analysis/orders.csv")
-products_df = pd.read_csv("instacart-market-basket-analysis/products.csv")
-aisles_df = pd.read_csv("instacart-market-basket-analysis/aisles.csv")
-departments_df = pd.read_csv("instacart-market-basket-analysis/departments.csv")
+Every analysis is a registered task drawing one plot from the aggregate store (the counts are computed once, from a
+single streamed, typed load of the order tables). Run interactively, each plot is shown in turn:
 
-print(orders_df.head(5))
-print(orders_df.tail(5))
+    python explore.py
 
+or headless, as a static html report. Plots are rendered in a process pool with the Agg backend & cached by a hash
+of their input aggregates and code, so a nightly report only redraws the sections whose data changed:
 
+    python explore.py --report report/ --workers 4
 """
-eval_set column here specifies which of the 3 dataset (prior, train or test) the given row goes to.
-"""
-print(f"orders columns: {list(orders_df.columns.values)} \n")
-
+import argparse
+import hashlib
+import html
+import inspect
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-"""
-In this dataset, 4 to 100 orders of a customer are given, will need to predict the products that will be re-ordered.
-So, the last order of the customer has been taken out and divided into train and test sets.
-Prior order informations are in 'order_products_prior_df'.
-"""
-print(f"order_products_prior columns: {list(order_products_prior_df.columns.values)} \n")
-print(f"order_products_train_df columns: {list(order_products_train_df.columns.values)} \n")
+import pandas as pd
 
+from aggregates import POOL_CONTEXT, load_aggregates
+from data_loader import CACHE_DIR
 
-"""
-Let's get the count of rows in each of the 3 sets.
-Series: Only contain single list with index.
-Dataframe: Can be made of more than 1 series, a collection of series that can be used to analyse the data.
-"""
-print(orders_df.eval_set)
-print(orders_df.loc[:,'eval_set'])
+pd.options.mode.chained_assignment = None
+pd.options.display.max_columns = 10
 
-## This is a series
-count_of_rows = orders_df.eval_set.value_counts(ascending=True)
-print(count_of_rows)
+REPORT_CACHE_DIR = os.path.join(CACHE_DIR, "report")
 
-plt.figure(figsize=(12, 8))
-sns.barplot(count_of_rows.index, count_of_rows.values, alpha=0.8, color=color[1])
+# Bump when the report layout changes so every cached section is redrawn
+REPORT_FORMAT_VERSION = 1
 
-plt.ylabel('Number of Occurrences', fontsize = 12)
-plt.xlabel('Eval set type', fontsize = 12)
-plt.title('Count of rows in each dataset', fontsize = 15)
-plt.xticks(rotation = 'vertical')
-plt.show()
+day_names = ['Sat', 'Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri']
 
+# Name -> (function, title, aggregates it reads, figure size)
+TASKS = {}
 
-"""
-There are 206,209 customers in total.
-The last purchase of 131,209 customers are given as the train set.
-We need to predict for the rest 75,000 customers.
-"""
-def get_unique_count(x):
-    return len(np.unique(x))
 
-unique_count_of_customers = orders_df.groupby("eval_set")["user_id"].aggregate(get_unique_count)
+def task(name: str, title: str, inputs: list, figsize: tuple = (12, 8)):
+    """
+    Decorator registering an analysis: a function drawing on a matplotlib Axes from the given aggregates, which may
+    return a summary data frame shown under its plot
+    """
+    def register(function):
+        TASKS[name] = (function, title, inputs, figsize)
+        return function
+    return register
 
-print(orders_df.groupby("eval_set").first())
-print(orders_df.groupby("eval_set")["user_id"])
-print(unique_count_of_customers)
 
+# Tasks ####################################################################################################################
 
-"""
-Now let us validate the claim that 4 to 100 orders of a customer are given.
-"""
-## Groupby user_id, take max order_number for each user_id (max num of orders for user_id)
-max_orders_each_user = orders_df.groupby("user_id")["order_number"].aggregate(np.max).reset_index()
+@task("eval_set_counts", "Count of rows in each dataset", ["eval_set_counts"])
+def plot_eval_set_counts(tables: dict, ax, color: list):
+    """
+    eval_set column here specifies which of the 3 dataset (prior, train or test) the given row goes to.
+    There are 206,209 customers in total. The last purchase of 131,209 customers are given as the train set.
+    We need to predict for the rest 75,000 customers.
+    """
+    import seaborn as sns
 
-## Number of times all user orders
-order_number_count = max_orders_each_user.order_number.value_counts()
+    count_of_rows = tables["eval_set_counts"].sort_values("count")
+    sns.barplot(x = count_of_rows["eval_set"], y = count_of_rows["count"], alpha = 0.8, color = color[1], ax = ax)
 
-plt.figure(figsize=(12,8))
-sns.barplot(order_number_count.index, order_number_count.values, alpha=0.8, color=color[2])
+    ax.set_ylabel('Number of Occurrences', fontsize = 12)
+    ax.set_xlabel('Eval set type', fontsize = 12)
+    ax.tick_params(axis = 'x', labelrotation = 90)
+    return count_of_rows.rename(columns = {"count": "orders", "user_count": "customers"})
 
-plt.ylabel('Number of occurrences:', fontsize=12)
-plt.xlabel('Max order number', fontsize=12)
-plt.xticks(rotation='vertical')
-plt.show()
 
-print(orders_df.head(10))
-print('\n', orders_df.groupby("user_id")["order_number"].agg(np.max))
-print('\n', order_number_count.order_number.value_counts())
+@task("max_order_number", "Number of customers per maximum order number", ["max_order_number_counts"])
+def plot_max_order_number(tables: dict, ax, color: list):
+    """
+    Now let us validate the claim that 4 to 100 orders of a customer are given.
+    """
+    import seaborn as sns
 
+    order_number_count = tables["max_order_number_counts"].sort_values("order_number")
+    sns.barplot(x = order_number_count["order_number"], y = order_number_count["count"], alpha = 0.8, color = color[2], ax = ax)
 
-"""
-See how the ordering habit changes with day of week.
-0 = Saturday
-1 = Sunday
-..
-"""
-plt.figure(figsize=(12,8))
-sns.countplot(x="order_dow", data=orders_df, color=color[0])
+    ax.set_ylabel('Number of occurrences', fontsize = 12)
+    ax.set_xlabel('Max order number', fontsize = 12)
+    ax.tick_params(axis = 'x', labelrotation = 90, labelsize = 7)
+    return pd.DataFrame({
+        "customers": [int(order_number_count["count"].sum())],
+        "min_orders": [int(order_number_count["order_number"].min())],
+        "max_orders": [int(order_number_count["order_number"].max())],
+    })
 
-plt.ylabel('Count', fontsize=12)
-plt.xlabel('Day of week', fontsize=12)
-plt.xticks(rotation='vertical')
-plt.title('Frequency of order by week day', fontsize=15)
-plt.show()
 
+@task("orders_by_dow", "Frequency of order by week day", ["dow_counts"])
+def plot_orders_by_dow(tables: dict, ax, color: list):
+    """
+    See how the ordering habit changes with day of week (0 = Saturday, 1 = Sunday, ..).
+    """
+    import seaborn as sns
 
-"""
-See how the distribution is w.r.t. time of the day.
-So most orders are done through the day.
-"""
-plt.figure(figsize=(12,8))
-sns.countplot(x="order_hour_of_day", data=orders_df, color=color[1])
+    dow_counts = tables["dow_counts"].sort_values("order_dow")
+    sns.barplot(x = [day_names[dow] for dow in dow_counts["order_dow"]], y = dow_counts["count"], color = color[0], ax = ax)
 
-plt.ylabel('Count', fontsize=12)
-plt.xlabel('Hour of day', fontsize=12)
-plt.xticks(rotation='vertical')
-plt.title('Frequency of order by hour of day', fontsize=15)
-plt.show()
+    ax.set_ylabel('Count', fontsize = 12)
+    ax.set_xlabel('Day of week', fontsize = 12)
 
 
-"""
-Combine the day of week and hour of day to see the distribution.
-Seems like Saturday evenings and Sunday mornings are the prime time for orders.
-"""
-grouped_df = orders_df.groupby(["order_dow", "order_hour_of_day"])["order_number"].agg("count").reset_index()
-print(orders_df[["order_dow", "order_hour_of_day", "order_number"]].groupby(["order_dow", "order_hour_of_day"]).agg("count").reset_index())
-print(f"grouped_order_num: \n {grouped_df}")
+@task("orders_by_hour", "Frequency of order by hour of day", ["hour_counts"])
+def plot_orders_by_hour(tables: dict, ax, color: list):
+    """
+    See how the distribution is w.r.t. time of the day. So most orders are done through the day.
+    """
+    import seaborn as sns
 
-grouped_pivot_df = grouped_df.pivot('order_dow', 'order_hour_of_day', 'order_number')
-print(f"pivot: \n {grouped_pivot_df}")
+    hour_counts = tables["hour_counts"].sort_values("order_hour_of_day")
+    sns.barplot(x = hour_counts["order_hour_of_day"], y = hour_counts["count"], color = color[1], ax = ax)
 
-plt.figure(figsize=(12, 6))
-sns.heatmap(grouped_pivot_df)
-plt.title("Frequency of Day of week vs Hour of day")
-plt.show()
+    ax.set_ylabel('Count', fontsize = 12)
+    ax.set_xlabel('Hour of day', fontsize = 12)
+    ax.tick_params(axis = 'x', labelrotation = 90)
 
 
-"""
-Now let's check the time interval between the orders.
-"""
-plt.figure(figsize=(12,8))
-sns.countplot(x="days_since_prior_order", data=orders_df, color=color[3])
-
-plt.ylabel('Count', fontsize=12)
-plt.xlabel('Days since prior order', fontsize=12)
-plt.xticks(rotation='vertical')
-plt.title('Frequency distribution by days since prior order', fontsize=15)
-plt.show()
\ No newline at end of file
+@task("dow_hour_heatmap", "Frequency of Day of week vs Hour of day", ["dow_hour_counts"], figsize = (12, 6))
+def plot_dow_hour_heatmap(tables: dict, ax, color: list):
+    """
+    Combine the day of week and hour of day to see the distribution.
+    Seems like Saturday evenings and Sunday mornings are the prime time for orders.
+    """
+    import seaborn as sns
+
+    grouped_pivot_df = tables["dow_hour_counts"].pivot(index = 'order_dow', columns = 'order_hour_of_day', values = 'count')
+    sns.heatmap(grouped_pivot_df.rename(index = dict(enumerate(day_names))), ax = ax)
+
+    ax.set_ylabel('Day of week', fontsize = 12)
+    ax.set_xlabel('Hour of day', fontsize = 12)
+
+
+@task("days_since_prior_order", "Frequency distribution by days since prior order", ["days_since_prior_counts"])
+def plot_days_since_prior_order(tables: dict, ax, color: list):
+    """
+    Now let's check the time interval between the orders. First orders have no prior order & are left out.
+    """
+    import seaborn as sns
+
+    days_since_prior_counts = tables["days_since_prior_counts"]
+    intervals = days_since_prior_counts.dropna(subset = ["days_since_prior_order"]).sort_values("days_since_prior_order")
+    sns.barplot(x = intervals["days_since_prior_order"].astype(int), y = intervals["count"], color = color[3], ax = ax)
+
+    ax.set_ylabel('Count', fontsize = 12)
+    ax.set_xlabel('Days since prior order', fontsize = 12)
+    ax.tick_params(axis = 'x', labelrotation = 90)
+    return pd.DataFrame({
+        "first_orders": [int(days_since_prior_counts.loc[days_since_prior_counts["days_since_prior_order"].isna(), "count"].sum())],
+        "repeat_orders": [int(intervals["count"].sum())],
+    })
+
+
+# Rendering ################################################################################################################
+
+def task_inputs(name: str, aggregates: dict) -> dict:
+    return {input_name: aggregates[input_name] for input_name in TASKS[name][2]}
+
+
+def task_hash(name: str, inputs: dict) -> str:
+    """
+    Function to return the cache key of a task: a hash of its input aggregates (content & columns) and of its code
+    """
+    function, title, _, figsize = TASKS[name]
+    digest = hashlib.sha1(f"{REPORT_FORMAT_VERSION}|{name}|{title}|{figsize}|{inspect.getsource(function)}".encode())
+    for input_name, df in sorted(inputs.items()):
+        digest.update(f"{input_name}|{list(df.columns)}|{list(df.dtypes.astype(str))}".encode())
+        digest.update(pd.util.hash_pandas_object(df, index = False).to_numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def _cache_paths(name: str, input_hash: str) -> tuple:
+    base = os.path.join(REPORT_CACHE_DIR, f"{name}-{input_hash}")
+    return f"{base}.png", f"{base}.html"
+
+
+def _init_worker() -> None:
+    # Headless rendering, set before pyplot is imported by the tasks
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def render_task(name: str, inputs: dict, input_hash: str) -> float:
+    """
+    Function to draw a task into its cached png & summary html, returns the render time
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    start = time.perf_counter()
+    function, title, _, figsize = TASKS[name]
+    png_path, html_path = _cache_paths(name, input_hash)
+
+    fig, ax = plt.subplots(figsize = figsize)
+    summary = function(inputs, ax, sns.color_palette())
+    ax.set_title(title, fontsize = 15)
+    fig.tight_layout()
+
+    # Written to temporary files & renamed, an interrupted run never leaves a truncated section in the cache
+    fig.savefig(f"{png_path}.{os.getpid()}.tmp", format = "png", dpi = 100)
+    plt.close(fig)
+    with open(f"{html_path}.{os.getpid()}.tmp", "w") as f:
+        f.write(summary.to_html(index = False, border = 0) if summary is not None else "")
+    os.replace(f"{png_path}.{os.getpid()}.tmp", png_path)
+    os.replace(f"{html_path}.{os.getpid()}.tmp", html_path)
+    return time.perf_counter() - start
+
+
+def write_report(report_dir: str, workers: int = None, force: bool = False, tasks: list = None) -> dict:
+    """
+    Function to write the html / png report of the given tasks (all by default) into report_dir, redrawing only the
+    sections whose inputs or code changed. Returns the status of every task ("cached" or its render seconds).
+    """
+    tasks = tasks or list(TASKS)
+    os.makedirs(report_dir, exist_ok = True)
+    os.makedirs(REPORT_CACHE_DIR, exist_ok = True)
+
+    aggregates = load_aggregates()
+    inputs = {name: task_inputs(name, aggregates) for name in tasks}
+    hashes = {name: task_hash(name, inputs[name]) for name in tasks}
+    stale = [name for name in tasks if force or not all(os.path.exists(path) for path in _cache_paths(name, hashes[name]))]
+
+    status = {name: "cached" for name in tasks if name not in stale}
+    if stale:
+        workers = workers or min(len(stale), os.cpu_count() or 1)
+        if workers > 1 and len(stale) > 1:
+            # Spawned like the aggregation pool, the aggregates were just loaded by (multi-threaded) pyarrow
+            with ProcessPoolExecutor(max_workers = workers, mp_context = POOL_CONTEXT, initializer = _init_worker) as executor:
+                seconds = executor.map(render_task, stale, [inputs[name] for name in stale], [hashes[name] for name in stale])
+                status.update(zip(stale, seconds))
+        else:
+            _init_worker()
+            status.update((name, render_task(name, inputs[name], hashes[name])) for name in stale)
+
+    # Sections cached for older inputs of the rendered tasks are dropped
+    current = {os.path.basename(path) for name in tasks for path in _cache_paths(name, hashes[name])}
+    for file_name in os.listdir(REPORT_CACHE_DIR):
+        if file_name.rsplit("-", 1)[0] in tasks and file_name not in current:
+            os.remove(os.path.join(REPORT_CACHE_DIR, file_name))
+
+    sections = []
+    for name in tasks:
+        png_path, html_path = _cache_paths(name, hashes[name])
+        shutil.copyfile(png_path, os.path.join(report_dir, f"{name}.png"))
+        with open(html_path) as f:
+            summary_html = f.read()
+        function, title = TASKS[name][:2]
+        description = html.escape(inspect.cleandoc(function.__doc__ or ""))
+        sections.append(
+            f'<section id="{name}"><h2>{html.escape(title)}</h2><p>{description}</p>'
+            f'<img src="{name}.png" alt="{html.escape(title)}">{summary_html}</section>'
+        )
+
+    index_html = (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Instacart exploration</title>"
+        "<style>body{font-family:sans-serif;max-width:1240px;margin:auto}img{max-width:100%}"
+        "table{border-collapse:collapse}td,th{padding:2px 12px;text-align:right}</style></head><body>"
+        f"<h1>Instacart exploration</h1><p>Generated {time.strftime('%Y-%m-%d %H:%M:%S')}</p>"
+        + "".join(sections) + "</body></html>"
+    )
+    tmp_path = os.path.join(report_dir, f"index.html.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(index_html)
+    os.replace(tmp_path, os.path.join(report_dir, "index.html"))
+    return status
+
+
+def show_tasks(tasks: list = None) -> None:
+    """
+    Function to show every plot in turn (blocking, like the original notebook) & print its summary
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    aggregates = load_aggregates()
+    for name in tasks or list(TASKS):
+        function, title, _, figsize = TASKS[name]
+        print(inspect.cleandoc(function.__doc__ or ""))
+        fig, ax = plt.subplots(figsize = figsize)
+        summary = function(task_inputs(name, aggregates), ax, sns.color_palette())
+        ax.set_title(title, fontsize = 15)
+        if summary is not None:
+            print(summary.to_string(index = False), "\n")
+        plt.show()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--report", metavar = "DIR", help = "write a headless html / png report into DIR instead of showing the plots")
+    parser.add_argument("--workers", type = int, help = "processes rendering the report sections (default: one per stale section, up to the cpu count)")
+    parser.add_argument("--force", action = "store_true", help = "redraw every section even if cached")
+    parser.add_argument("--tasks", nargs = "+", choices = list(TASKS), help = "analyses to run (default: all)")
+    args = parser.parse_args()
+
+    if args.report is None:
+        show_tasks(args.tasks)
+    else:
+        start = time.perf_counter()
+        for name, status in write_report(args.report, args.workers, args.force, args.tasks).items():
+            print(f"{name}: {status if status == 'cached' else f'rendered in {status:.2f}s'}")
+        print(f"Report written to {os.path.join(args.report, 'index.html')} in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,134 @@
+#############################################################################################
+# Batched writer for the tickets export.
+#
+# Rows are buffered & appended to the output (csv or parquet, picked from the file extension) every
+# batch_size rows, so memory stays constant & the export grows on disk while a board is processed.
+# Every file has the same columns, covering both structured & free text card descriptions.
+#############################################################################################
+
+import os
+
+import pandas as pd
+
+from metrics import span
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - pyarrow is only needed for parquet exports
+    pa = None
+    pq = None
+
+
+EXPORT_COLUMNS = [
+    'created_date',
+    'current_list',
+    'card_name',
+    'card_label',
+    'member_name',
+    'reporting_team',
+    'requestor_email',
+    'reporting_manager_email',
+    'type_of_requirement',
+    'list_from',
+    'list_to',
+    'transaction_date',
+    'description_pre_standardise',
+]
+
+
+def export_columns(include_card_id: bool = False) -> list:
+    return ['card_id'] + EXPORT_COLUMNS if include_card_id else list(EXPORT_COLUMNS)
+
+
+def is_parquet(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in ('.parquet', '.pq')
+
+
+def iter_export(path: str, batch_size: int = 10000):
+    """
+    Generator to read an existing export in batches of rows, every value as text (None when empty)
+    """
+    if is_parquet(path):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size = batch_size):
+            yield batch.to_pandas()
+        return
+
+    try:
+        for chunk in pd.read_csv(path, dtype = str, keep_default_na = False, chunksize = batch_size):
+            yield chunk.replace('', None)
+    except pd.errors.EmptyDataError:
+        return
+
+
+class ExportWriter:
+    def __init__(self, path: str, columns: list = EXPORT_COLUMNS, batch_size: int = 1000) -> None:
+        self.path = path
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.row_count = 0
+
+        self._buffer = []
+        self._csv_file = None
+        self._parquet_writer = None
+
+        if is_parquet(path):
+            if pq is None:
+                raise ImportError("Writing a parquet export requires pyarrow")
+            self._schema = pa.schema([(column, pa.string()) for column in self.columns])
+            self._parquet_writer = pq.ParquetWriter(path, self._schema)
+        else:
+            self._csv_file = open(path, 'w', newline = '')
+            pd.DataFrame(columns = self.columns).to_csv(self._csv_file, index = False)
+            self._csv_file.flush()
+
+    def write(self, row: dict) -> None:
+        self._buffer.append(row)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def write_rows(self, rows) -> None:
+        for row in rows:
+            self.write(row)
+
+    def write_frame(self, df: pd.DataFrame) -> None:
+        """
+        Function to append a frame of rows (e.g. rows read back from a previous export), batch_size rows at a time
+        """
+        self.flush()
+        df = df.reindex(columns = self.columns)
+        for start in range(0, len(df), self.batch_size):
+            self._write_batch(df.iloc[start:start + self.batch_size])
+
+    def flush(self) -> None:
+        if len(self._buffer) == 0:
+            return
+        with span("export.write", stage = "frame"):
+            df = pd.DataFrame.from_records(self._buffer, columns = self.columns)
+        self._buffer = []
+        self._write_batch(df)
+
+    def _write_batch(self, df: pd.DataFrame) -> None:
+        self.row_count += len(df)
+        with span("export.write", stage = "parquet" if self._parquet_writer is not None else "csv"):
+            if self._parquet_writer is not None:
+                # Fixed all text schema, missing fields stay null
+                df = df.astype(object).where(df.notna(), None)
+                df = df.apply(lambda column: column.map(lambda value: value if value is None else str(value)))
+                self._parquet_writer.write_table(pa.Table.from_pandas(df, schema = self._schema, preserve_index = False))
+            else:
+                df.to_csv(self._csv_file, header = False, index = False)
+                self._csv_file.flush()
+
+    def close(self) -> None:
+        self.flush()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        if self._csv_file is not None:
+            self._csv_file.close()
+
+    def __enter__(self) -> "ExportWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
@@ -0,0 +1,350 @@
+"""
+Feature store for reorder prediction: user, product & user x product features of the prior orders.
+
+Only two tables are primary, the per user order statistics (from orders) & the per user x product sufficient
+statistics (counts, sums, first / last order, from the prior order products, reduced in one sorted pass). Every
+product & user basket feature is derived from them with bincounts, so new orders are folded in incrementally by
+merging their statistics instead of rebuilding from the raw csv files. Columns are stored as int32 / float32
+.npy files, loaded memory mapped, in a generation directory swapped in through meta.json.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from aggregates import dataset_signature, dataset_version, grow_array
+from data_loader import CACHE_DIR, CHUNK_SIZE, iter_table, load_table
+from metrics import timed
+from store import create_generation, publish_meta, read_meta
+
+
+FEATURE_DIR = os.path.join(CACHE_DIR, "features")
+
+# Bump when the tables below change so existing stores are rebuilt
+FEATURE_FORMAT_VERSION = 1
+
+FEATURE_ORDER_COLUMNS = ["order_id", "user_id", "eval_set", "order_number", "days_since_prior_order"]
+FEATURE_ORDER_PRODUCT_COLUMNS = ["order_id", "product_id", "add_to_cart_order", "reordered"]
+
+# Primary statistics, the other columns of each table are derived from them
+USER_ORDER_COLUMNS = ["order_count", "days_since_prior_sum", "days_since_prior_count", "last_order_number", "last_day"]
+USER_PRODUCT_COLUMNS = ["order_count", "reorder_sum", "add_to_cart_sum", "first_order_number", "last_order_number", "last_day"]
+
+# Reduction of each user x product statistic when the same pair is seen again
+USER_PRODUCT_REDUCTIONS = {
+    "order_count": np.add,
+    "reorder_sum": np.add,
+    "add_to_cart_sum": np.add,
+    "first_order_number": np.minimum,
+    "last_order_number": np.maximum,
+    "last_day": np.maximum,
+}
+
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """
+    Function to divide as float32, NaN where the denominator is 0
+    """
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        return np.where(denominator > 0, numerator / np.maximum(denominator, 1), np.nan).astype(np.float32)
+
+
+def _pair_keys(user_ids: np.ndarray, product_ids: np.ndarray) -> np.ndarray:
+    return (user_ids.astype(np.int64) << 32) | product_ids.astype(np.int64)
+
+
+def _reduce_by_key(keys: np.ndarray, columns: dict) -> tuple:
+    """
+    Function to reduce the columns of rows sharing a key (with USER_PRODUCT_REDUCTIONS), returns the sorted unique keys
+    & reduced columns. Concatenations of sorted runs are merged in linear time by the stable (tim)sort.
+    """
+    order = np.argsort(keys, kind = "stable")
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]])) if len(keys) else np.zeros(0, dtype = np.int64)
+    reduced = {name: USER_PRODUCT_REDUCTIONS[name].reduceat(values[order], starts) if len(keys) else values[:0] for name, values in columns.items()}
+    return keys[starts], reduced
+
+
+class OrderContext:
+    """
+    Dense lookups by order_id of the user, order number & day (cumulative days since the user's first order) of orders
+    """
+    def __init__(self, orders_df: pd.DataFrame, user_last_day: np.ndarray = None) -> None:
+        orders_df = orders_df.sort_values(["user_id", "order_number"], kind = "stable")
+        self.order_ids = orders_df["order_id"].to_numpy()
+        self.user_ids = orders_df["user_id"].to_numpy().astype(np.int32)
+        self.order_numbers = orders_df["order_number"].to_numpy().astype(np.int32)
+        self.days_since_prior = orders_df["days_since_prior_order"].to_numpy().astype(np.float32)
+
+        # Running sum of the gaps per user, continuing from the user's last known day when orders are appended
+        gaps = np.nan_to_num(self.days_since_prior).astype(np.float64)
+        running = np.cumsum(gaps)
+        user_start = np.concatenate([[True], self.user_ids[1:] != self.user_ids[:-1]]) if len(gaps) else np.zeros(0, dtype = bool)
+        run_start = np.maximum.accumulate(np.where(user_start, np.arange(len(gaps)), 0)) if len(gaps) else np.zeros(0, dtype = np.int64)
+        self.days = (running - running[run_start] + gaps[run_start]).astype(np.float32)
+        if user_last_day is not None:
+            known = self.user_ids < len(user_last_day)
+            self.days[known] += user_last_day[self.user_ids[known]]
+
+        size = int(self.order_ids.max()) + 1 if len(self.order_ids) else 0
+        self.order_position = np.full(size, -1, dtype = np.int64)
+        self.order_position[self.order_ids] = np.arange(len(self.order_ids))
+
+    def user_order_statistics(self) -> dict:
+        """
+        Function to return the order statistics of the users of these orders, dense by user_id
+        """
+        n_users = int(self.user_ids.max()) + 1 if len(self.user_ids) else 0
+        has_prior = ~np.isnan(self.days_since_prior)
+        last_order = np.zeros(n_users, dtype = np.int32)
+        last_day = np.zeros(n_users, dtype = np.float32)
+        # Orders are sorted by user & order number, the last write per user wins
+        last_order[self.user_ids] = self.order_numbers
+        last_day[self.user_ids] = self.days
+
+        return {
+            "order_count": np.bincount(self.user_ids, minlength = n_users).astype(np.int32),
+            "days_since_prior_sum": np.bincount(self.user_ids, weights = np.nan_to_num(self.days_since_prior), minlength = n_users).astype(np.float32),
+            "days_since_prior_count": np.bincount(self.user_ids, weights = has_prior, minlength = n_users).astype(np.int32),
+            "last_order_number": last_order,
+            "last_day": last_day,
+        }
+
+    def user_product_statistics(self, order_products_df: pd.DataFrame) -> tuple:
+        """
+        Function to return the sorted user x product keys & statistics of a chunk of order products of these orders
+        """
+        order_ids = order_products_df["order_id"].to_numpy()
+        known = order_ids < len(self.order_position)
+        position = np.full(len(order_ids), -1, dtype = np.int64)
+        position[known] = self.order_position[order_ids[known]]
+        known = position >= 0
+        position = position[known]
+
+        order_numbers = self.order_numbers[position]
+        return _reduce_by_key(_pair_keys(self.user_ids[position], order_products_df["product_id"].to_numpy()[known]), {
+            "order_count": np.ones(len(position), dtype = np.int32),
+            "reorder_sum": order_products_df["reordered"].to_numpy()[known].astype(np.int32),
+            "add_to_cart_sum": order_products_df["add_to_cart_order"].to_numpy()[known].astype(np.int32),
+            "first_order_number": order_numbers,
+            "last_order_number": order_numbers,
+            "last_day": self.days[position],
+        })
+
+
+class FeatureStore:
+    """
+    User, product & user x product feature tables (dicts of numpy columns, possibly memory mapped)
+    """
+    def __init__(self, user_orders: dict, user_product_keys: np.ndarray, user_products: dict) -> None:
+        self.user_orders = user_orders
+        self.user_product_keys = user_product_keys
+        self.user_products_stats = user_products
+        self.derive()
+
+    @classmethod
+    @timed("features.build", memory = True)
+    def build(cls, chunk_size: int = CHUNK_SIZE) -> "FeatureStore":
+        """
+        Function to compute the store from the prior orders, streaming the order products chunk_size rows at a time
+        """
+        orders_df = load_table("orders", columns = FEATURE_ORDER_COLUMNS)
+        context = OrderContext(orders_df[orders_df["eval_set"] == "prior"])
+
+        keys = np.zeros(0, dtype = np.int64)
+        stats = {name: np.zeros(0, dtype = np.float32 if name == "last_day" else np.int32) for name in USER_PRODUCT_COLUMNS}
+        for order_products_df in iter_table("order_products__prior", FEATURE_ORDER_PRODUCT_COLUMNS, chunk_size):
+            chunk_keys, chunk_stats = context.user_product_statistics(order_products_df)
+            keys, stats = _reduce_by_key(
+                np.concatenate([keys, chunk_keys]),
+                {name: np.concatenate([stats[name], chunk_stats[name]]) for name in USER_PRODUCT_COLUMNS}
+            )
+        return cls(context.user_order_statistics(), keys, stats)
+
+    @timed("features.update", memory = True)
+    def update(self, orders_df: pd.DataFrame, order_products_df: pd.DataFrame) -> None:
+        """
+        Function to fold new prior orders (orders table columns) & their order products into the store
+        """
+        context = OrderContext(orders_df, self.user_orders["last_day"])
+        new_orders = context.user_order_statistics()
+
+        n_users = max(len(self.user_orders["order_count"]), len(new_orders["order_count"]))
+        user_orders = {name: grow_array(np.array(values), n_users) for name, values in self.user_orders.items()}
+        for name in ["order_count", "days_since_prior_sum", "days_since_prior_count"]:
+            user_orders[name][:len(new_orders[name])] += new_orders[name]
+        for name in ["last_order_number", "last_day"]:
+            user_orders[name][:len(new_orders[name])] = np.maximum(user_orders[name][:len(new_orders[name])], new_orders[name])
+        self.user_orders = {name: values[:n_users] for name, values in user_orders.items()}
+
+        new_keys, new_stats = context.user_product_statistics(order_products_df)
+        self.user_product_keys, self.user_products_stats = _reduce_by_key(
+            np.concatenate([self.user_product_keys, new_keys]),
+            {name: np.concatenate([self.user_products_stats[name], new_stats[name]]) for name in USER_PRODUCT_COLUMNS}
+        )
+        self.derive()
+
+    def derive(self) -> None:
+        """
+        Function to (re)compute the user, product & user x product features from the primary statistics
+        """
+        user_orders = self.user_orders
+        stats = self.user_products_stats
+        user_ids = (self.user_product_keys >> 32).astype(np.int32)
+        product_ids = (self.user_product_keys & 0xFFFFFFFF).astype(np.int32)
+        n_users = len(user_orders["order_count"])
+        n_products = int(product_ids.max()) + 1 if len(product_ids) else 0
+
+        item_count = np.bincount(user_ids, weights = stats["order_count"], minlength = n_users)
+        user_reorder_sum = np.bincount(user_ids, weights = stats["reorder_sum"], minlength = n_users)
+        self.users = {
+            "user_id": np.arange(n_users, dtype = np.int32),
+            **user_orders,
+            "item_count": item_count.astype(np.int32),
+            "distinct_product_count": np.bincount(user_ids, minlength = n_users).astype(np.int32),
+            "reorder_rate": _ratio(user_reorder_sum, item_count),
+            "mean_basket_size": _ratio(item_count, user_orders["order_count"]),
+            "mean_days_since_prior": _ratio(user_orders["days_since_prior_sum"], user_orders["days_since_prior_count"]),
+        }
+
+        product_order_count = np.bincount(product_ids, weights = stats["order_count"], minlength = n_products)
+        self.products = {
+            "product_id": np.arange(n_products, dtype = np.int32),
+            "order_count": product_order_count.astype(np.int32),
+            "user_count": np.bincount(product_ids, minlength = n_products).astype(np.int32),
+            "reorder_rate": _ratio(np.bincount(product_ids, weights = stats["reorder_sum"], minlength = n_products), product_order_count),
+            "mean_add_to_cart_order": _ratio(np.bincount(product_ids, weights = stats["add_to_cart_sum"], minlength = n_products), product_order_count),
+        }
+        # Share of the product's buyers who bought it again
+        self.products["repeat_user_rate"] = _ratio(
+            np.bincount(product_ids, weights = stats["order_count"] > 1, minlength = n_products),
+            self.products["user_count"]
+        )
+
+        self.user_products = {
+            "user_id": user_ids,
+            "product_id": product_ids,
+            **stats,
+            "order_rate": _ratio(stats["order_count"], user_orders["order_count"][user_ids]),
+            "orders_since_last": (user_orders["last_order_number"][user_ids] - stats["last_order_number"]).astype(np.int32),
+            "days_since_last": (user_orders["last_day"][user_ids] - stats["last_day"]).astype(np.float32),
+            "mean_add_to_cart_order": _ratio(stats["add_to_cart_sum"], stats["order_count"]),
+        }
+        # Rows of user u are user_products[user_offsets[u]:user_offsets[u + 1]]
+        self.user_offsets = np.searchsorted(user_ids, np.arange(n_users + 1)).astype(np.int64)
+
+    def user_features(self, user_id: int) -> dict:
+        return {name: values[user_id] for name, values in self.users.items()}
+
+    def user_product_features(self, user_id: int) -> pd.DataFrame:
+        """
+        Function to return the candidate products of a user (every product previously ordered) with their user x
+        product, product & user features, ready for scoring
+        """
+        start, end = self.user_offsets[user_id], self.user_offsets[user_id + 1]
+        candidates = pd.DataFrame({name: np.asarray(values[start:end]) for name, values in self.user_products.items()})
+        product_ids = candidates["product_id"].to_numpy()
+        for name, values in self.products.items():
+            if name != "product_id":
+                candidates[f"product_{name}"] = np.asarray(values)[product_ids]
+        for name, values in self.users.items():
+            if name != "user_id":
+                candidates[f"user_{name}"] = values[user_id]
+        return candidates
+
+    def frame(self, table: str) -> pd.DataFrame:
+        """
+        Function to return a feature table ('users', 'products' or 'user_products') as a data frame
+        """
+        df = pd.DataFrame({name: np.asarray(values) for name, values in getattr(self, table).items()})
+        if table == "user_products":
+            return df
+        # Users & products are dense by id, drop the ids without any order
+        return df[df["order_count"] > 0].reset_index(drop = True)
+
+
+# Store ##################################################################################################################
+def read_feature_meta() -> dict:
+    """
+    Function to read the meta data of the persisted store, empty if there is none
+    """
+    return read_meta(FEATURE_DIR)
+
+
+def save_features(store: FeatureStore, signature: dict, updates: int = 0) -> None:
+    """
+    Function to write the primary statistics into a new generation directory, then point meta.json at it
+    (readers keep their memory mapped generation until they reload) & remove the older generations
+    """
+    os.makedirs(FEATURE_DIR, exist_ok = True)
+    generation, generation_dir = create_generation(FEATURE_DIR)
+
+    columns = {f"user_orders.{name}": values for name, values in store.user_orders.items()}
+    columns.update({f"user_products.{name}": values for name, values in store.user_products_stats.items()})
+    columns["user_products.key"] = store.user_product_keys
+    for name, values in columns.items():
+        np.save(os.path.join(generation_dir, f"{name}.npy"), np.ascontiguousarray(values))
+
+    meta = {
+        "version": dataset_version(signature),
+        "format_version": FEATURE_FORMAT_VERSION,
+        "signature": signature,
+        "generation": generation,
+        "updates": updates,
+        "user_count": int((store.user_orders["order_count"] > 0).sum()),
+        "user_product_count": len(store.user_product_keys),
+    }
+    publish_meta(FEATURE_DIR, meta, keep_generations = 2)
+
+
+@timed("features.open", memory = True)
+def open_features(meta: dict, mmap: bool = True) -> FeatureStore:
+    generation_dir = os.path.join(FEATURE_DIR, meta["generation"])
+
+    def column(name: str) -> np.ndarray:
+        return np.load(os.path.join(generation_dir, f"{name}.npy"), mmap_mode = "r" if mmap else None)
+
+    return FeatureStore(
+        {name: column(f"user_orders.{name}") for name in USER_ORDER_COLUMNS},
+        column("user_products.key"),
+        {name: column(f"user_products.{name}") for name in USER_PRODUCT_COLUMNS},
+    )
+
+
+def load_features(chunk_size: int = CHUNK_SIZE, mmap: bool = True) -> FeatureStore:
+    """
+    Function to load the feature store, (re)building it when missing or when the source csv files changed
+    """
+    signature = dataset_signature()
+    meta = read_feature_meta()
+    if meta.get("signature") != signature or meta.get("format_version") != FEATURE_FORMAT_VERSION:
+        save_features(FeatureStore.build(chunk_size), signature)
+        meta = read_feature_meta()
+    return open_features(meta, mmap)
+
+
+def update_features(orders_df: pd.DataFrame, order_products_df: pd.DataFrame) -> FeatureStore:
+    """
+    Function to fold new prior orders & their products into the persisted store, returns the updated store
+    """
+    store = load_features()
+    store.update(orders_df, order_products_df)
+    meta = read_feature_meta()
+    save_features(store, meta["signature"], meta["updates"] + 1)
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Build or update the reorder prediction feature store")
+    parser.add_argument("--chunk-size", type = int, default = CHUNK_SIZE, help = "rows of order products held in memory at once")
+    parser.add_argument("--orders", help = "csv of new prior orders to fold into the store (orders.csv columns)")
+    parser.add_argument("--order-products", help = "csv of the new orders' products (order_products__prior.csv columns)")
+    args = parser.parse_args()
+
+    if args.orders is not None:
+        update_features(pd.read_csv(args.orders), pd.read_csv(args.order_products))
+    else:
+        save_features(FeatureStore.build(args.chunk_size), dataset_signature())
+    meta = read_feature_meta()
+    print(f"Feature store: {FEATURE_DIR} ({meta['user_count']} users, {meta['user_product_count']} user x product pairs, {meta['updates']} updates)")
@@ -0,0 +1,116 @@
+"""
+Memoizing cache of serialized dashboard figures.
+
+Figures are keyed by figure name plus dataset version, kept in a size bounded in-memory LRU and
+optionally written to a directory shared between gunicorn workers (itself bounded to max_disk_entries
+files, least recently used first), so each figure is only built & serialized once per dataset version.
+Figures are serialized by the given serializer (plotly json by default). Dash callbacks cannot return raw
+json, so the dashboard decodes the cached figure & Dash encodes it again for every response; the cache
+saves the figure build & compaction, not that encoding.
+"""
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable
+
+import plotly.graph_objects as go
+
+
+class FigureCache:
+    def __init__(self, max_entries: int = 32, cache_dir: str = None, serializer: Callable[[go.Figure], str] = None,
+                 max_disk_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.serializer = serializer if serializer is not None else go.Figure.to_json
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok = True)
+
+    def _disk_path(self, name: str, version: str) -> str:
+        return os.path.join(self.cache_dir, f"{name}-{version}.json")
+
+    def _remember(self, key: tuple, figure_json: str) -> None:
+        with self._lock:
+            self._entries[key] = figure_json
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def get(self, name: str, version: str) -> str:
+        """
+        Function to return the serialized figure from memory or the shared directory, None if not cached
+        """
+        key = (name, version)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if self.cache_dir is not None:
+            try:
+                with open(self._disk_path(name, version)) as f:
+                    figure_json = f.read()
+            except FileNotFoundError:
+                return None
+            # Disk entries are evicted by modification time, a hit marks the file as recently used
+            try:
+                os.utime(self._disk_path(name, version))
+            except FileNotFoundError:
+                pass
+            self._remember(key, figure_json)
+            return figure_json
+
+        return None
+
+    def put(self, name: str, version: str, figure: go.Figure) -> str:
+        """
+        Function to serialize & store a figure, returns its json
+        """
+        figure_json = self.serializer(figure)
+        self._remember((name, version), figure_json)
+
+        if self.cache_dir is not None:
+            # Write to a temporary file & rename so other workers never read a partial figure
+            tmp_path = f"{self._disk_path(name, version)}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(figure_json)
+            os.replace(tmp_path, self._disk_path(name, version))
+            self.prune_disk()
+
+        return figure_json
+
+    def get_or_build(self, name: str, version: str, builder: Callable[[], go.Figure]) -> str:
+        """
+        Function to return the serialized figure, building it only on a cache miss
+        """
+        figure_json = self.get(name, version)
+        if figure_json is None:
+            figure_json = self.put(name, version, builder())
+        return figure_json
+
+    def prune_disk(self) -> None:
+        """
+        Function to evict the least recently used disk entries above max_disk_entries (figures of older dataset
+        versions stop being read & go first)
+        """
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".json")]
+        if len(paths) <= self.max_disk_entries:
+            return
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except FileNotFoundError:
+                pass
+        for path in sorted(mtimes, key = mtimes.get)[:len(mtimes) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
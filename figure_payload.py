@@ -0,0 +1,216 @@
+"""
+Compact serialization of dashboard figures & compression of the dashboard responses.
+
+Numeric arrays are shipped as plotly typed arrays (base64 "bdata", ints already downcast by plotly, floats
+downcast to float32 here), the default template is pruned to the trace types a figure uses, and traces
+longer than MAX_POINTS are downsampled server side: lines keep the min & max of every bucket so peaks
+survive, bars keep their largest values. A figure still over FIGURE_SIZE_BUDGET bytes is downsampled
+further, down to MIN_POINTS. Figures are compacted in place & the pruned templates are built once, so compacting
+costs about as much as a plain to_json on the (per request) filtered figures.
+"""
+import gzip
+import os
+import warnings
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+import plotly.graph_objects as go
+import plotly.io as pio
+from flask import Flask, request
+from plotly.io.json import to_json_plotly
+
+from metrics import timed
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional, responses are gzipped without it
+    brotli = None
+
+
+MAX_POINTS = int(os.environ.get("FIGURE_MAX_POINTS", 2000))
+MIN_POINTS = 100
+FIGURE_SIZE_BUDGET = int(os.environ.get("FIGURE_SIZE_BUDGET", 200_000))
+
+# Trace attributes holding one value per point, sliced together when a trace is downsampled
+POINT_ATTRIBUTES = ["x", "y", "text", "hovertext", "customdata", "ids"]
+MARKER_POINT_ATTRIBUTES = ["color", "size", "opacity"]
+LINE_TRACE_TYPES = {"scatter", "scattergl"}
+
+# Default template as a plain dict, pruned per set of drawn trace types (validating a Template object costs ~5ms)
+DEFAULT_TEMPLATE = pio.templates[pio.templates.default].to_plotly_json()
+_pruned_templates = {}
+
+COMPRESSED_MIMETYPES = {"application/json", "application/javascript", "text/javascript", "text/html", "text/css", "text/plain"}
+
+
+# Figures ####################################################################################################################
+
+def _pruned_template(template: dict, trace_types: set) -> dict:
+    """
+    Function to drop the template defaults of the trace types a figure does not draw (~60% of a small figure), the
+    pruned default template is built once per set of trace types
+    """
+    if template is None:
+        return None
+    key = frozenset(trace_types)
+    if template == DEFAULT_TEMPLATE and key in _pruned_templates:
+        return _pruned_templates[key]
+
+    template_data = template.get("data", {})
+    pruned = {"layout": template.get("layout", {}), "data": {trace_type: template_data[trace_type] for trace_type in sorted(key) if template_data.get(trace_type)}}
+    if template == DEFAULT_TEMPLATE:
+        _pruned_templates[key] = pruned
+    return pruned
+
+
+def _downcast_trace(trace) -> None:
+    # Float64 point values are drawn identically from float32, which halves their payload. Only float64 arrays are
+    # reassigned, each assignment is validated by plotly
+    for name in ("x", "y", "z", "customdata"):
+        if name in trace and isinstance(trace[name], np.ndarray) and trace[name].dtype == np.float64:
+            trace[name] = trace[name].astype(np.float32)
+    if "marker" in trace and "color" in trace.marker:
+        color = trace.marker.color
+        if isinstance(color, np.ndarray) and color.dtype == np.float64:
+            trace.marker.color = color.astype(np.float32)
+
+
+def _point_count(trace) -> int:
+    return max((len(values) for values in (trace["x"], trace["y"]) if values is not None and not isinstance(values, str)), default = 0)
+
+
+def min_max_indices(values: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Function to return the sorted indices of the minimum & maximum of max_points / 2 equal buckets, plus the end points
+    """
+    values = np.asarray(values, dtype = np.float64)
+    bucket_count = max(1, max_points // 2)
+    starts = np.linspace(0, len(values), bucket_count, endpoint = False).astype(np.int64)
+    buckets = np.repeat(np.arange(bucket_count), np.diff(np.append(starts, len(values))))
+
+    indices = [np.array([0, len(values) - 1])]
+    for extremes in (np.minimum.reduceat(values, starts), np.maximum.reduceat(values, starts)):
+        is_extreme = values == extremes[buckets]
+        # First index of every bucket reaching its extreme (buckets of NaNs have none & are dropped)
+        indices.append(np.flatnonzero(is_extreme)[np.unique(buckets[is_extreme], return_index = True)[1]])
+    return np.unique(np.concatenate(indices))
+
+
+def largest_indices(values: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Function to return the sorted indices of the max_points largest absolute values
+    """
+    magnitudes = np.nan_to_num(np.abs(np.asarray(values, dtype = np.float64)), nan = -1)
+    return np.sort(np.argpartition(-magnitudes, max_points - 1)[:max_points])
+
+
+def downsample_trace(trace, max_points: int) -> bool:
+    """
+    Function to downsample a 1-D trace in place, returns whether it was downsampled
+    """
+    point_count = _point_count(trace)
+    if point_count <= max_points or trace.type not in LINE_TRACE_TYPES | {"bar"}:
+        return False
+
+    value_axis = "x" if getattr(trace, "orientation", None) == "h" else "y"
+    values = trace[value_axis]
+    if values is None or len(values) != point_count or not np.issubdtype(np.asarray(values).dtype, np.number):
+        return False
+
+    if trace.type == "bar":
+        indices = largest_indices(values, max_points)
+    else:
+        indices = min_max_indices(values, max_points)
+
+    updates = {}
+    for name in POINT_ATTRIBUTES:
+        if trace[name] is not None and not isinstance(trace[name], str) and len(trace[name]) == point_count:
+            updates[name] = np.asarray(trace[name])[indices]
+    for name in MARKER_POINT_ATTRIBUTES:
+        marker_values = trace.marker[name] if name in trace.marker else None
+        if marker_values is not None and not isinstance(marker_values, (str, int, float)) and len(marker_values) == point_count:
+            updates[f"marker.{name}"] = np.asarray(marker_values)[indices]
+    trace.update(updates)
+    return True
+
+
+@timed("figure.compact")
+def compact_figure(figure: go.Figure, max_points: int = MAX_POINTS, size_budget: int = FIGURE_SIZE_BUDGET) -> str:
+    """
+    Function to serialize a figure compactly, downsampling its long traces until it fits the size budget. The
+    figure is modified in place, pass a copy to keep the original.
+    """
+    for trace in figure.data:
+        _downcast_trace(trace)
+    trace_types = {trace.type for trace in figure.data}
+
+    while True:
+        # Short traces (nearly every dashboard figure) are left as they are
+        for trace in figure.data:
+            if _point_count(trace) > max_points:
+                downsample_trace(trace, max_points)
+        figure_dict = figure.to_plotly_json()
+        figure_dict["layout"]["template"] = _pruned_template(figure_dict["layout"].get("template"), trace_types)
+        figure_json = to_json_plotly(figure_dict)
+        if len(figure_json) <= size_budget or max_points <= MIN_POINTS:
+            break
+        max_points = max(MIN_POINTS, max_points // 2)
+
+    if len(figure_json) > size_budget:
+        title = figure.layout.title.text if figure.layout.title is not None else None
+        warnings.warn(f"Figure {title!r} is {len(figure_json)} bytes, over its {size_budget} bytes budget")
+    return figure_json
+
+
+# Responses ####################################################################################################################
+
+def _compress(data: bytes, encoding: str, level: int) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality = min(level, 11))
+    return gzip.compress(data, compresslevel = level, mtime = 0)
+
+
+def compress_responses(server: Flask, min_size: int = 500, level: int = 6, cache_size: int = 64) -> None:
+    """
+    Function to compress the json / javascript / html responses of a flask server, brotli first when the
+    client & server support it, gzip otherwise. Bodies of cacheable responses (ETag or max-age, such as the
+    dash javascript bundles) are only compressed once.
+    """
+    compressed_bodies = OrderedDict()
+    lock = Lock()
+
+    @server.after_request
+    def compress_response(response):
+        accepted = request.headers.get("Accept-Encoding", "").lower()
+        encoding = "br" if brotli is not None and "br" in accepted else "gzip" if "gzip" in accepted else None
+        if (
+            encoding is None
+            or response.status_code != 200
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSED_MIMETYPES
+        ):
+            return response
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        etag = response.headers.get("ETag")
+        cacheable = etag is not None or bool(response.cache_control.max_age)
+        key = (request.path, etag, encoding)
+        with lock:
+            compressed = compressed_bodies.get(key) if cacheable else None
+        if compressed is None:
+            compressed = _compress(data, encoding, level)
+            if cacheable:
+                with lock:
+                    compressed_bodies[key] = compressed
+                    while len(compressed_bodies) > cache_size:
+                        compressed_bodies.popitem(last = False)
+
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
@@ -0,0 +1,115 @@
+#############################################################################################
+# Columnar flattening of card list movements into export rows.
+#
+# Movements of every card are collected into flat arrays, list names are cleaned through a memoized
+# table (boards only have a handful of list names), transaction dates are formatted in one vectorized
+# pass & card attributes are joined to their movements by position instead of being copied per row.
+#############################################################################################
+
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from description_parser import parse_descriptions
+
+
+TRANSACTION_DATE_FORMAT = '%d/%m/%Y, %H:%M:%S'
+
+
+@lru_cache(maxsize = None)
+def clean_list_name(name: str) -> str:
+    """
+    Function to keep only the letters of a list name, memoized as list names repeat constantly
+    """
+    return "".join(filter(str.isalpha, name))
+
+
+def movements_frame(actions: list) -> pd.DataFrame:
+    """
+    Function to flatten updateCard:idList actions (newest first) into card_id / list_from / list_to / transaction_date
+    columns, oldest first
+    """
+    card_ids = []
+    sources = []
+    destinations = []
+    dates = []
+    for action in reversed(actions):
+        data = action['data']
+        if 'listBefore' not in data or 'listAfter' not in data:
+            continue
+        card_ids.append(data['card']['id'])
+        sources.append(data['listBefore']['name'])
+        destinations.append(data['listAfter']['name'])
+        dates.append(action['date'])
+
+    return pd.DataFrame({
+        'card_id': card_ids,
+        'list_from': [clean_list_name(name) for name in sources],
+        'list_to': [clean_list_name(name) for name in destinations],
+        'transaction_date': format_transaction_dates(dates),
+    })
+
+
+def format_transaction_dates(iso_dates: list) -> np.ndarray:
+    """
+    Function to format Trello's ISO 8601 (UTC) action dates like pretty_format_list_movements, in one pass
+    """
+    if len(iso_dates) == 0:
+        return np.array([], dtype = object)
+
+    # Trello dates are fixed width UTC (2022-07-01T09:30:00.000Z), re-slicing them skips parsing entirely
+    if all(len(iso_date) == 24 and iso_date[-1] == 'Z' for iso_date in iso_dates):
+        return np.array([f"{d[8:10]}/{d[5:7]}/{d[0:4]}, {d[11:19]}" for d in iso_dates], dtype = object)
+    return pd.to_datetime(pd.Series(iso_dates), utc = True, format = 'ISO8601').dt.strftime(TRANSACTION_DATE_FORMAT).to_numpy()
+
+
+def cards_frame(cards: list, lists: dict, member_dict: dict, created_dates: list, card_labels: list) -> pd.DataFrame:
+    """
+    Function to build one row of export attributes per card (REST API json), descriptions parsed in batch.
+    Creation dates are rendered to text once per card, rather than once per movement when the export is written.
+    """
+    descriptions = parse_descriptions([card['desc'] for card in cards])
+
+    df = pd.DataFrame({
+        'card_id': [card['id'] for card in cards],
+        'created_date': [str(created_date) for created_date in created_dates],
+        'current_list': [clean_list_name(lists[card['idList']]['name']) for card in cards],
+        'card_name': [card['name'] for card in cards],
+        'card_label': card_labels,
+        'member_name': [", ".join(str(member_dict[member_id]) for member_id in card['idMembers']) for card in cards],
+    })
+    for column in ['reporting_team', 'requestor_email', 'reporting_manager_email', 'type_of_requirement', 'description_pre_standardise']:
+        df[column] = descriptions[column].astype(object).where(descriptions[column].notna(), None).to_numpy()
+    return df
+
+
+def group_actions_by_card(actions: list, card_ids: list) -> tuple:
+    """
+    Function to group board actions by card without copying them: returns the indices of the actions of known cards
+    sorted by card position (original order kept within a card) & the offset of the first action of every card (plus
+    the total), so the actions of any run of cards are one contiguous slice of the indices
+    """
+    # A dict lookup per action, an Index would first copy every action's card id into a string array
+    position = {card_id: i for i, card_id in enumerate(card_ids)}
+    card_position = np.fromiter((position.get(action['data'].get('card', {}).get('id'), -1) for action in actions), dtype = np.intp, count = len(actions))
+    known = np.flatnonzero(card_position >= 0)
+    order = known[np.argsort(card_position[known], kind = 'stable')]
+    offsets = np.searchsorted(card_position[order], np.arange(len(card_ids) + 1))
+    return order, offsets
+
+
+def join_movements(cards_df: pd.DataFrame, movements_df: pd.DataFrame, columns: list) -> pd.DataFrame:
+    """
+    Function to join card attributes to their movements by position, one row per movement, grouped by card in
+    card order (cards without movements have no row, like the row by row export)
+    """
+    card_position = pd.Index(cards_df['card_id']).get_indexer(movements_df['card_id'])
+    known = card_position >= 0
+    order = np.argsort(card_position[known], kind = 'stable')
+    card_position = card_position[known][order]
+
+    export_df = cards_df.take(card_position).reset_index(drop = True)
+    for column in ['list_from', 'list_to', 'transaction_date']:
+        export_df[column] = movements_df[column].to_numpy()[known][order]
+    return export_df.reindex(columns = columns)
@@ -0,0 +1,289 @@
+"""
+In-process instrumentation: timing / memory spans, counters & latency histograms.
+
+Spans time a block of code and are aggregated per name & labels, a span costs two clock reads plus a lock. Coarse
+spans (loads, aggregations, whole exports) opt in to also measure the growth of the resident memory with
+memory=True, which reads /proc/self/statm twice (~40us, too much for per card / per chunk spans).
+Everything is recorded in the process wide METRICS registry, which the dashboard serves in the Prometheus text
+format on /metrics (register_metrics_endpoint) and batch runs write as a json report (write_report, or
+automatically at exit with METRICS_REPORT=path). METRICS_LOG=1 also logs every span as a json line on stderr.
+
+The registry is per process: under gunicorn every worker counts its own requests & a scrape of /metrics is
+answered by whichever worker accepts it. Every exported series carries a pid label, so Prometheus keeps the
+workers apart (sum over pid for totals), but a scrape only samples one worker; run a single worker when every
+request must be counted.
+"""
+import atexit
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+try:
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError):  # pragma: no cover - windows has no sysconf, spans then skip memory
+    PAGE_SIZE = None
+
+
+def rss_mb() -> float:
+    """
+    Function to return the resident memory of the process in MB, None where /proc is not available
+    """
+    if PAGE_SIZE is None:
+        return None
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE / 2 ** 20
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels: tuple, **extra) -> str:
+    pairs = list(labels) + [(name, str(value)) for name, value in extra.items()]
+    if not pairs:
+        return ""
+    escaped = ((name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Histogram:
+    """
+    Cumulative count of observations per bucket, plus their count & sum
+    """
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict:
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        return {"count": self.count, "sum": round(self.sum, 6), "buckets": dict(zip(bounds, self.bucket_counts))}
+
+
+class SpanStats:
+    """
+    Aggregated timings & memory growth of every run of a span
+    """
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.max_rss_growth_mb = 0.0
+        self.histogram = Histogram()
+
+    def add(self, seconds: float, rss_growth_mb: float = None) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        if rss_growth_mb is not None:
+            self.max_rss_growth_mb = max(self.max_rss_growth_mb, rss_growth_mb)
+        self.histogram.observe(seconds)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "seconds": round(self.seconds, 6),
+            "mean_seconds": round(self.seconds / self.count, 6) if self.count else 0.0,
+            "max_seconds": round(self.max_seconds, 6),
+            "max_rss_growth_mb": round(self.max_rss_growth_mb, 3),
+        }
+
+
+class Metrics:
+    """
+    Thread safe registry of spans, counters & histograms, each keyed by name & labels
+    """
+    def __init__(self, log: bool = False) -> None:
+        self.log = log
+        self.started = time.time()
+        self._spans = {}
+        self._counters = {}
+        self._histograms = {}
+        self._lock = Lock()
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def record_span(self, name: str, seconds: float, rss_growth_mb: float = None, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key not in self._spans:
+                self._spans[key] = SpanStats()
+            self._spans[key].add(seconds, rss_growth_mb)
+
+        if self.log:
+            record = {"span": name, "labels": labels, "seconds": round(seconds, 6), "rss_growth_mb": rss_growth_mb}
+            print(json.dumps(record, default = str), file = sys.stderr)
+
+    @contextmanager
+    def span(self, name: str, memory: bool = False, **labels):
+        """
+        Context manager timing its block as a run of the span name (with labels), failed runs included. With memory,
+        the growth of the resident memory over the block is recorded too.
+        """
+        rss_before = rss_mb() if memory else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            rss_after = rss_mb() if memory else None
+            rss_growth = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+            self.record_span(name, seconds, rss_growth, **labels)
+
+    def timed(self, name: str, memory: bool = False, **labels):
+        """
+        Decorator timing every call of a function as a run of the span name
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name, memory, **labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self) -> None:
+        with self._lock:
+            self._spans.clear()
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> dict:
+        """
+        Function to return every metric as json serializable lists of {name, labels, ..} records
+        """
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "rss_mb": rss_mb(),
+                "spans": [{"name": name, "labels": dict(labels), **stats.to_dict()} for (name, labels), stats in sorted(self._spans.items())],
+                "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self._counters.items())],
+                "histograms": [{"name": name, "labels": dict(labels), **histogram.to_dict()} for (name, labels), histogram in sorted(self._histograms.items())],
+            }
+
+    def to_prometheus(self) -> str:
+        """
+        Function to render every metric in the Prometheus text exposition format, labelled with the pid of the process
+        """
+        lines = []
+        pid = str(os.getpid())
+
+        def histogram_lines(name: str, labels: tuple, histogram: Histogram) -> None:
+            cumulative = 0
+            for bound, bucket_count in zip(list(histogram.buckets) + ["+Inf"], histogram.bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels, pid = pid, le = bound)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels, pid = pid)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(labels, pid = pid)} {histogram.count}")
+
+        with self._lock:
+            lines.append("# TYPE process_resident_memory_mb gauge")
+            lines.append(f"process_resident_memory_mb{_format_labels((), pid = pid)} {rss_mb() or 0}")
+
+            if self._spans:
+                lines.append("# TYPE span_seconds histogram")
+                for (name, labels), stats in sorted(self._spans.items()):
+                    histogram_lines("span_seconds", (("span", name),) + labels, stats.histogram)
+                lines.append("# TYPE span_max_rss_growth_mb gauge")
+                for (name, labels), stats in sorted(self._spans.items()):
+                    lines.append(f"span_max_rss_growth_mb{_format_labels((('span', name),) + labels, pid = pid)} {stats.max_rss_growth_mb}")
+
+            for metric_name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {metric_name} counter")
+                for (name, labels), value in sorted(self._counters.items()):
+                    if name == metric_name:
+                        lines.append(f"{name}{_format_labels(labels, pid = pid)} {value}")
+
+            for metric_name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {metric_name} histogram")
+                for (name, labels), histogram in sorted(self._histograms.items()):
+                    if name == metric_name:
+                        histogram_lines(name, labels, histogram)
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics(log = os.environ.get("METRICS_LOG") == "1")
+
+span = METRICS.span
+timed = METRICS.timed
+increment = METRICS.increment
+observe = METRICS.observe
+
+
+def write_report(path: str, **extra) -> dict:
+    """
+    Function to write the metrics of the process as a json report (with any extra fields, e.g. the run arguments)
+    """
+    report = dict(extra, command = " ".join(sys.argv), **METRICS.snapshot())
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent = 2, default = str)
+    os.replace(tmp_path, path)
+    return report
+
+
+if os.environ.get("METRICS_REPORT"):
+    atexit.register(write_report, os.environ["METRICS_REPORT"])
+
+
+def register_metrics_endpoint(server, path: str = "/metrics") -> None:
+    """
+    Function to time every request of a flask server (per route, & per output for dash callbacks) and serve the
+    metrics on path, as Prometheus text or as json with ?format=json
+    """
+    # Imported here so batch runs recording metrics don't need flask
+    from flask import Response, request
+
+    @server.before_request
+    def start_timer():
+        request.environ["metrics.start"] = time.perf_counter()
+
+    @server.after_request
+    def record_request(response):
+        start = request.environ.get("metrics.start")
+        if start is None or request.path == path:
+            return response
+        # Route templates rather than paths, so javascript bundles & callbacks don't explode the label space
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        labels = {"route": route}
+        if route.endswith("_dash-update-component"):
+            labels["output"] = (request.get_json(silent = True) or {}).get("output", "")
+        METRICS.observe("http_request_seconds", time.perf_counter() - start, **labels)
+        METRICS.increment("http_requests_total", status = response.status_code, **labels)
+        return response
+
+    @server.route(path)
+    def metrics_endpoint():
+        if request.args.get("format") == "json":
+            return Response(json.dumps(METRICS.snapshot(), default = str), mimetype = "application/json")
+        return Response(METRICS.to_prometheus(), mimetype = "text/plain; version=0.0.4")
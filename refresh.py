@@ -0,0 +1,117 @@
+"""
+Hot reload of the dashboard stores.
+
+A refresh rebuilds the aggregate store & the association index when the source csv files changed, off the
+request path: in a background thread of every dashboard worker, or in a separate process (--watch). Refreshes
+hold an exclusive file lock, so only one process parses the new extract while the others keep serving the
+current generation. Each store is published by atomically replacing its meta.json, and workers open the new
+(memory mapped) generation on their next request.
+
+    python refresh.py --watch 60
+"""
+import argparse
+import os
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - without fcntl (windows) concurrent refreshes are not serialized
+    fcntl = None
+
+from aggregates import refresh_aggregates
+from associations import refresh_associations
+from data_loader import CACHE_DIR
+from metrics import span
+
+
+REFRESH_INTERVAL = float(os.environ.get("DATASET_REFRESH_INTERVAL", 30))
+LOCK_PATH = os.path.join(CACHE_DIR, "refresh.lock")
+
+# Background refresh thread of the current process, restarted in forked workers
+_refresh_thread = {}
+
+
+@contextmanager
+def refresh_lock(blocking: bool = True):
+    """
+    Context manager holding the exclusive refresh lock, yields False when not blocking & another process holds it
+    """
+    os.makedirs(CACHE_DIR, exist_ok = True)
+    with open(LOCK_PATH, "a") as lock_file:
+        if fcntl is None:
+            yield True
+            return
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def refresh_stores(blocking: bool = True) -> bool:
+    """
+    Function to rebuild the stale stores under the refresh lock, returns whether any store was rebuilt. Without
+    blocking, nothing is done while another process is refreshing.
+    """
+    with refresh_lock(blocking) as acquired:
+        if not acquired:
+            return False
+        with span("refresh", memory = True):
+            # Both stores are checked (& rebuilt) before returning
+            return any([refresh_aggregates(), refresh_associations()])
+
+
+class StoreRefresher(threading.Thread):
+    """
+    Daemon thread refreshing the stores every interval seconds
+    """
+    def __init__(self, interval: float = REFRESH_INTERVAL) -> None:
+        super().__init__(name = "store-refresher", daemon = True)
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                refresh_stores(blocking = False)
+            except Exception:
+                # A broken extract must not stop the refresher, the current generation keeps being served
+                traceback.print_exc()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+def start_background_refresh(interval: float = REFRESH_INTERVAL) -> StoreRefresher:
+    """
+    Function to start the background refresh thread of the current process once (threads do not survive a fork,
+    so gunicorn workers forked from a preloaded app start their own), None when disabled by a non positive interval
+    """
+    if interval <= 0:
+        return None
+    if _refresh_thread.get("pid") != os.getpid():
+        refresher = StoreRefresher(interval)
+        refresher.start()
+        _refresh_thread.update(pid = os.getpid(), refresher = refresher)
+    return _refresh_thread["refresher"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--watch", type = float, help = "keep refreshing every WATCH seconds instead of once")
+    args = parser.parse_args()
+
+    while True:
+        start = time.perf_counter()
+        if refresh_stores():
+            print(f"Stores refreshed in {time.perf_counter() - start:.1f}s")
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
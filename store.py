@@ -0,0 +1,54 @@
+"""
+Versioned generations of the derived stores (aggregates, associations, features).
+
+Every build of a store is written to a new generation directory, then published by atomically replacing the
+store's meta.json, which names the current generation. Readers follow meta.json, so a worker reading the
+previous generation can finish while a new one is published (see refresh.py); older generations are pruned.
+"""
+import json
+import os
+import shutil
+
+
+def read_meta(store_dir: str) -> dict:
+    """
+    Function to read the meta.json of a derived store (aggregates, associations, features), empty if there is none
+    """
+    meta_path = os.path.join(store_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def create_generation(store_dir: str) -> tuple:
+    """
+    Function to create the next generation directory of a store, returns its name & path
+    """
+    generation_number = read_meta(store_dir).get("generation_number", 0) + 1
+    generation = f"generation-{generation_number:06d}-{os.getpid()}"
+    generation_dir = os.path.join(store_dir, generation)
+    os.makedirs(generation_dir, exist_ok = True)
+    return generation, generation_dir
+
+
+def publish_meta(store_dir: str, meta: dict, keep_generations: int = 2) -> None:
+    """
+    Function to atomically point a store at a new generation through its meta.json, then remove all but the
+    keep_generations most recent generations, the new one included (with 2, readers of the previous one can
+    still finish their reads)
+    """
+    meta = dict(meta, generation_number = int(meta["generation"].split("-")[1]))
+    meta_path = os.path.join(store_dir, "meta.json")
+    tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+    # Generations numbered like the new one may still be written by a concurrent build, they are left alone
+    older = sorted(
+        name for name in os.listdir(store_dir)
+        if name.startswith("generation-") and int(name.split("-")[1]) < meta["generation_number"]
+    )
+    for name in older[:max(0, len(older) - keep_generations + 1)]:
+        shutil.rmtree(os.path.join(store_dir, name), ignore_errors = True)
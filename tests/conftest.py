@@ -0,0 +1,9 @@
+"""
+Shared setup of the test suite: the repository modules & the benchmark helpers (synthetic data, fake Trello server)
+are imported as top level modules, like the scripts themselves do.
+"""
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, "benchmarks")]
@@ -0,0 +1,61 @@
+"""
+Incremental updates of the feature store give the same tables as a full rebuild.
+"""
+import os
+
+import pandas as pd
+import pytest
+
+import data_loader
+import features
+from synthetic_instacart import generate_tables
+
+# Prior orders of every user held out of the base build & folded in by update
+HELD_OUT_ORDERS = 2
+
+
+def write_tables(data_dir: str, tables: dict) -> None:
+    os.makedirs(data_dir, exist_ok = True)
+    for name, df in tables.items():
+        df.to_csv(os.path.join(data_dir, f"{name}.csv"), index = False)
+
+
+def use_dataset(monkeypatch, data_dir: str) -> None:
+    # data_loader resolves its paths at call time, point it at another dataset
+    monkeypatch.setattr(data_loader, "DATA_DIR", data_dir)
+    monkeypatch.setattr(data_loader, "CACHE_DIR", os.path.join(data_dir, ".cache"))
+
+
+@pytest.fixture(scope = "module")
+def tables() -> dict:
+    return generate_tables(users = 300, products = 600, seed = 1)
+
+
+def test_update_matches_full_build(tables, tmp_path, monkeypatch):
+    orders = tables["orders"]
+    prior = orders[orders["eval_set"] == "prior"]
+    last_prior = prior.groupby("user_id")["order_number"].transform("max")
+    held_out_ids = prior.loc[prior["order_number"] > last_prior - HELD_OUT_ORDERS, "order_id"]
+
+    full_dir = str(tmp_path / "full")
+    write_tables(full_dir, tables)
+    base_tables = dict(tables)
+    base_tables["orders"] = orders[~orders["order_id"].isin(held_out_ids)]
+    base_tables["order_products__prior"] = tables["order_products__prior"][~tables["order_products__prior"]["order_id"].isin(held_out_ids)]
+    write_tables(str(tmp_path / "base"), base_tables)
+
+    use_dataset(monkeypatch, full_dir)
+    full = features.FeatureStore.build(chunk_size = 5000)
+    # The held out rows, typed like the loader reads them
+    new_orders = data_loader.load_table("orders", columns = features.FEATURE_ORDER_COLUMNS)
+    new_orders = new_orders[new_orders["order_id"].isin(held_out_ids)]
+    new_order_products = data_loader.load_table("order_products__prior", columns = features.FEATURE_ORDER_PRODUCT_COLUMNS)
+    new_order_products = new_order_products[new_order_products["order_id"].isin(held_out_ids)]
+
+    use_dataset(monkeypatch, str(tmp_path / "base"))
+    updated = features.FeatureStore.build(chunk_size = 5000)
+    assert len(updated.frame("user_products")) < len(full.frame("user_products"))
+    updated.update(new_orders, new_order_products)
+
+    for table in ["users", "products", "user_products"]:
+        pd.testing.assert_frame_equal(updated.frame(table), full.frame(table))
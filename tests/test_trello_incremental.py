@@ -0,0 +1,50 @@
+"""
+Incremental board exports give the same rows as a full export, run against the fake Trello server.
+"""
+import pandas as pd
+import pytest
+
+from fake_trello import FakeBoard, FakeTrelloServer
+from trello_api import RateLimiter, TrelloApi
+from trello_playground import Helper
+
+
+@pytest.fixture
+def server():
+    server = FakeTrelloServer(FakeBoard(lists = 5, cards = 200, moves_per_card = 2.0, seed = 3)).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def create_api(server: FakeTrelloServer) -> TrelloApi:
+    return TrelloApi("test-key", "test-token", base_url = server.base_url, rate_limiter = RateLimiter(rate = 1e6), backoff = 0.05)
+
+
+def read_export(path: str) -> pd.DataFrame:
+    # Rows of a card keep their order, the cards' order differs between the full & the upserted export
+    df = pd.read_csv(path, dtype = str, keep_default_na = False)
+    return df.sort_values("card_id", kind = "stable").reset_index(drop = True)
+
+
+@pytest.mark.parametrize("moved_cards", [5, Helper.INCREMENTAL_BULK_THRESHOLD + 10], ids = ["per_card", "bulk"])
+def test_incremental_matches_full_export(server, tmp_path, moved_cards):
+    incremental_path = str(tmp_path / "incremental.csv")
+    full_path = str(tmp_path / "full.csv")
+
+    Helper.export_board_incremental(create_api(server), server.board.id, incremental_path)
+    server.board.move_cards(moved_cards)
+    Helper.export_board_incremental(create_api(server), server.board.id, incremental_path)
+    Helper.export_board_to_csv(create_api(server), server.board.id, full_path, include_card_id = True)
+
+    pd.testing.assert_frame_equal(read_export(incremental_path), read_export(full_path))
+
+
+def test_incremental_without_new_actions_keeps_export(server, tmp_path):
+    path = tmp_path / "incremental.csv"
+
+    Helper.export_board_incremental(create_api(server), server.board.id, str(path))
+    exported = path.read_bytes()
+    Helper.export_board_incremental(create_api(server), server.board.id, str(path))
+
+    assert path.read_bytes() == exported
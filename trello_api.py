@@ -0,0 +1,263 @@
+#############################################################################################
+# Thin client over the Trello REST API for board wide (bulk) reads.
+#
+# py-trello fetches labels / list movements card by card, the endpoints below return them for the
+# whole board in a handful of paginated requests over a single pooled session.
+# Trello REST API docs: https://developer.atlassian.com/cloud/trello/rest/api-group-boards/
+#############################################################################################
+
+import random
+import re
+import time
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import increment, observe
+from trello_cache import ResponseCache
+
+
+# Trello object ids (24 hex digits), replaced in endpoint names so every card / list shares one endpoint
+TRELLO_ID = re.compile(r"/[0-9a-f]{24}(?=/|$)")
+
+# Default (connect, read) timeout in seconds of Trello requests
+REQUEST_TIMEOUT = (5.0, 30.0)
+
+
+def endpoint_name(url: str) -> str:
+    """
+    Function to return the endpoint of a Trello url or path, e.g. https://api.trello.com/1/cards/5f..a1/actions -> /1/cards/{id}/actions
+    """
+    return TRELLO_ID.sub("/{id}", urlsplit(url).path)
+
+
+class InstrumentedSession(requests.Session):
+    """
+    requests session counting the Trello requests per endpoint & status and timing them in a latency histogram
+    (trello_requests_total & trello_request_seconds of the metrics registry). Also usable as py-trello's http_service,
+    whose requests then time out after REQUEST_TIMEOUT instead of waiting forever on a stalled connection.
+    """
+    def request(self, method, url, *args, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = REQUEST_TIMEOUT
+        endpoint = endpoint_name(url)
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.RequestException as e:
+            increment("trello_requests_total", endpoint = endpoint, method = method, status = type(e).__name__)
+            raise
+        finally:
+            observe("trello_request_seconds", time.perf_counter() - start, endpoint = endpoint)
+        increment("trello_requests_total", endpoint = endpoint, method = method, status = response.status_code)
+        return response
+
+
+class RateLimiter:
+    """
+    Thread safe token bucket, every request takes one token. Trello allows 100 requests per 10 seconds per token
+    (300 per 10 seconds per api key), share one limiter between clients using the same token.
+    """
+    def __init__(self, rate: float = 10.0, capacity: int = 100) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        """
+        Function to block until a request may be sent
+        """
+        start = time.perf_counter()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+        observe("trello_rate_limit_wait_seconds", time.perf_counter() - start)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Function to hold back every request for the given time, e.g. after a 429 with Retry-After
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+class TrelloApi:
+    BASE_URL = "https://api.trello.com/1"
+
+    # Largest page size accepted by the actions endpoints
+    PAGE_LIMIT = 1000
+
+    # Responses worth retrying (rate limited or transient server errors)
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    # Transport errors worth retrying, a stalled connection times out instead of blocking its thread forever
+    RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+    def __init__(self, api_key: str, token: str, base_url: str = BASE_URL, pool_size: int = 10,
+                 rate_limiter: RateLimiter = None, max_retries: int = 5, backoff: float = 0.5, cache: ResponseCache = None,
+                 timeout: tuple = REQUEST_TIMEOUT) -> None:
+        self.api_key = api_key
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.cache = cache
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        # One keep-alive connection pool shared by every request of an export
+        self.session = InstrumentedSession()
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept": "application/json"})
+
+        self.request_count = 0
+        self._count_lock = Lock()
+
+    def _retry_delay(self, attempt: int, response: requests.Response = None) -> float:
+        """
+        Function to return how long to wait before retrying, Retry-After when given else exponential backoff with jitter
+        """
+        if response is not None and response.headers.get("Retry-After"):
+            try:
+                return float(response.headers["Retry-After"])
+            except ValueError:
+                pass
+        return self.backoff * (2 ** attempt) * (1 + random.random())
+
+    def get(self, path: str, params: dict = None):
+        """
+        Function to GET an API path & return its decoded json, rate limited & retried on 429 / 5xx / connection errors
+        & timeouts.
+        With a cache, fresh responses are served locally & stale ones carrying an ETag are revalidated.
+        """
+        query = {"key": self.api_key, "token": self.token}
+        query.update(params or {})
+
+        headers = {}
+        entry = None
+        if self.cache is not None:
+            cache_key = self.cache.key(path, params, self.token)
+            entry = self.cache.lookup(cache_key)
+            if entry is not None and self.cache.is_fresh(entry, path):
+                increment("trello_cache_hits_total", endpoint = endpoint_name(f"{self.base_url}{path}"))
+                return entry["body"]
+            if entry is not None and entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            with self._count_lock:
+                self.request_count += 1
+
+            try:
+                response = self.session.get(f"{self.base_url}{path}", params = query, headers = headers, timeout = self.timeout)
+            except self.RETRY_EXCEPTIONS:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                continue
+
+            if response.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                delay = self._retry_delay(attempt, response)
+                if response.status_code == 429:
+                    self.rate_limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+                continue
+
+            if response.status_code == 304 and entry is not None:
+                self.cache.touch(cache_key, entry)
+                return entry["body"]
+
+            response.raise_for_status()
+            body = response.json()
+            if self.cache is not None:
+                self.cache.store(cache_key, body, response.headers.get("ETag"))
+            return body
+
+    def get_paginated(self, path: str, params: dict = None) -> list:
+        """
+        Function to GET every page of a newest first collection (e.g. actions), paging backwards with 'before'
+        """
+        params = dict(params or {}, limit = self.PAGE_LIMIT)
+        results = []
+        while True:
+            page = self.get(path, params)
+            results.extend(page)
+            if len(page) < self.PAGE_LIMIT:
+                return results
+            params["before"] = page[-1]["id"]
+
+    def get_board_lists(self, board_id: str) -> list:
+        return self.get(f"/boards/{board_id}/lists", {"filter": "all", "fields": "name,closed"})
+
+    def get_board_cards(self, board_id: str, card_filter: str = "open") -> list:
+        """
+        Function to return the cards of a board, labels included
+        """
+        return self.get(f"/boards/{board_id}/cards/{card_filter}", {"fields": "name,desc,idList,idMembers,labels,closed"})
+
+    def get_board_members(self, board_id: str) -> list:
+        return self.get(f"/boards/{board_id}/members", {"fields": "fullName"})
+
+    def get_list_cards(self, list_id: str, card_filter: str = "open") -> list:
+        return self.get(f"/lists/{list_id}/cards", {"filter": card_filter, "fields": "name,desc,idList,idMembers,labels,closed"})
+
+    def get_card_labels(self, card_id: str) -> list:
+        return self.get(f"/cards/{card_id}", {"fields": "labels"})["labels"]
+
+    def get_card_list_movements(self, card_id: str) -> list:
+        """
+        Function to return the moves of a card between lists (updateCard:idList actions), newest first
+        """
+        return self.get_paginated(f"/cards/{card_id}/actions", {"filter": "updateCard:idList"})
+
+    def get_card(self, card_id: str) -> dict:
+        """
+        Function to return a single card, None if it was deleted
+        """
+        try:
+            return self.get(f"/cards/{card_id}", {"fields": "name,desc,idList,idMembers,labels,closed,idBoard"})
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+
+    def get_board_actions(self, board_id: str, action_filter: str, since: str = None) -> list:
+        """
+        Function to return the actions of a board matching the filter, newest first, optionally only those after
+        the given action id / date
+        """
+        params = {"filter": action_filter}
+        if since is not None:
+            params["since"] = since
+        return self.get_paginated(f"/boards/{board_id}/actions", params)
+
+    def get_latest_board_action_id(self, board_id: str) -> str:
+        """
+        Function to return the id of the most recent action of a board, None for a board without actions
+        """
+        actions = self.get(f"/boards/{board_id}/actions", {"limit": 1})
+        return actions[0]["id"] if actions else None
+
+    def get_board_list_movements(self, board_id: str, since: str = None) -> list:
+        """
+        Function to return every card move between lists of a board (updateCard:idList actions), newest first
+        """
+        return self.get_board_actions(board_id, "updateCard:idList", since)
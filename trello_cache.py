@@ -0,0 +1,167 @@
+#############################################################################################
+# Local cache of Trello API responses.
+#
+# Responses are kept in a size bounded in-memory LRU and optionally on disk, keyed by endpoint &
+# query parameters, each resource type with its own time to live. Stale entries carrying an ETag
+# are revalidated with a conditional request by TrelloApi instead of being downloaded again.
+#############################################################################################
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from trello import TrelloClient
+
+
+class ResponseCache:
+    # Seconds a response stays fresh, per resource type (last named segment of the endpoint)
+    DEFAULT_TTLS = {
+        "boards": 3600,
+        "members": 3600,
+        "lists": 600,
+        "labels": 600,
+        "cards": 300,
+        "actions": 60,
+    }
+    DEFAULT_TTL = 60
+
+    # Query parameters which authenticate rather than select data
+    AUTH_PARAMS = ("key", "token")
+
+    def __init__(self, cache_dir: str = None, max_entries: int = 1024, max_disk_entries: int = 10000, ttls: dict = None) -> None:
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttls = dict(self.DEFAULT_TTLS, **(ttls or {}))
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._disk_writes = 0
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok = True)
+
+    @staticmethod
+    def resource_type(path: str) -> str:
+        """
+        Function to return the resource type of an endpoint, e.g. /boards/{id}/cards/open -> cards, /cards/{id} -> cards
+        """
+        segments = path.strip("/").split("/")
+        return segments[-1] if len(segments) % 2 == 1 else segments[-2]
+
+    def ttl(self, path: str) -> float:
+        return self.ttls.get(self.resource_type(path), self.DEFAULT_TTL)
+
+    def key(self, path: str, params: dict = None, token: str = None) -> str:
+        """
+        Function to return the cache key of a request, responses differ per token so it is part of the key (hashed)
+        """
+        selection = {name: value for name, value in (params or {}).items() if name not in self.AUTH_PARAMS}
+        raw_key = json.dumps(["/" + path.strip("/"), sorted(selection.items()), token], default = str)
+        return hashlib.sha1(raw_key.encode()).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _remember(self, key: str, entry: dict) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def lookup(self, key: str) -> dict:
+        """
+        Function to return the cached entry ({'fetched_at', 'etag', 'body'}) of a key, fresh or not, None if missing
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is None and self.cache_dir is not None and os.path.exists(self._disk_path(key)):
+            try:
+                with open(self._disk_path(key)) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self._remember(key, entry)
+
+        if entry is not None and self.cache_dir is not None:
+            self._mark_used(key)
+        return entry
+
+    def _mark_used(self, key: str) -> None:
+        # Disk entries are evicted by modification time, every hit (memory ones included) marks the file as recently used
+        try:
+            os.utime(self._disk_path(key))
+        except FileNotFoundError:
+            pass
+
+    def is_fresh(self, entry: dict, path: str) -> bool:
+        return time.time() - entry["fetched_at"] < self.ttl(path)
+
+    def store(self, key: str, body, etag: str = None) -> None:
+        entry = {"fetched_at": time.time(), "etag": etag, "body": body}
+        self._remember(key, entry)
+
+        if self.cache_dir is not None:
+            tmp_path = f"{self._disk_path(key)}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._disk_path(key))
+
+            self._disk_writes += 1
+            if self._disk_writes % 100 == 0:
+                self.prune_disk()
+
+    def touch(self, key: str, entry: dict) -> None:
+        """
+        Function to mark an entry fresh again, after the server confirmed it is unchanged (304)
+        """
+        self.store(key, entry["body"], entry["etag"])
+
+    def prune_disk(self) -> None:
+        """
+        Function to evict the least recently used disk entries above max_disk_entries
+        """
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".json")]
+        if len(paths) <= self.max_disk_entries:
+            return
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except FileNotFoundError:
+                pass
+        for path in sorted(mtimes, key = mtimes.get)[:len(mtimes) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class CachedTrelloClient(TrelloClient):
+    """
+    py-trello client serving GET requests (list_boards, all_members, list_cards, ..) from a ResponseCache
+    """
+    def __init__(self, *args, cache: ResponseCache, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+
+    def fetch_json(self, uri_path, http_method = 'GET', headers = None, query_params = None, post_args = None, files = None):
+        if http_method != 'GET':
+            return super().fetch_json(uri_path, http_method, headers, query_params, post_args, files)
+
+        # py-trello shares (and mutates) default query dicts, key on a copy
+        cache_key = self.cache.key(uri_path, dict(query_params or {}), self.resource_owner_key)
+        entry = self.cache.lookup(cache_key)
+        if entry is not None and self.cache.is_fresh(entry, uri_path):
+            return entry["body"]
+
+        body = super().fetch_json(uri_path, http_method, headers, query_params, post_args, files)
+        self.cache.store(cache_key, body)
+        return body
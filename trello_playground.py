@@ -7,11 +7,19 @@
 #############################################################################################
 
 from trello import TrelloClient, Card, Board, Member
-from datetime import datetime
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
-import pandas as pd
 import requests
 import json
+import os
+
+from description_parser import DESCRIPTION_FIELDS, parse_description
+from export_writer import ExportWriter, export_columns, iter_export
+from list_movements import cards_frame, clean_list_name, group_actions_by_card, join_movements, movements_frame
+from metrics import span, timed
+from trello_api import InstrumentedSession, TrelloApi
+from trello_cache import CachedTrelloClient, ResponseCache
 
 
 class Client:
@@ -20,14 +28,34 @@ class Client:
         self.api_secret = api_secret
         self.token = token
 
-    def create_client(self) -> TrelloClient:
+    def create_client(self, cache: ResponseCache = None) -> TrelloClient:
         """
-        Function to return a TrelloClient API
+        Function to return a TrelloClient API, serving repeated GET requests from the cache when given
         """
+        if cache is not None:
+            return CachedTrelloClient(
+                api_key = self.api_key,
+                api_secret = self.api_secret,
+                token = self.token,
+                cache = cache,
+                http_service = InstrumentedSession()
+            )
+
         return TrelloClient(
             api_key = self.api_key,
             api_secret = self.api_secret,
-            token = self.token
+            token = self.token,
+            http_service = InstrumentedSession()
+        )
+
+    def create_api(self, cache: ResponseCache = None) -> TrelloApi:
+        """
+        Function to return a pooled REST client for board wide (bulk) requests
+        """
+        return TrelloApi(
+            api_key = self.api_key,
+            token = self.token,
+            cache = cache
         )
 
 class Board:
@@ -67,6 +95,15 @@ class Member:
         return member_dict
 
 class Helper:
+    # Board actions which can change a card's export rows, used by the incremental export
+    CARD_ACTION_TYPES = (
+        "createCard,updateCard,deleteCard,copyCard,moveCardToBoard,moveCardFromBoard,convertToCardFromCheckItem,"
+        "addLabelToCard,removeLabelFromCard,addMemberToCard,removeMemberFromCard,updateList"
+    )
+
+    # Above this many changed cards the incremental export refetches them with board wide requests
+    INCREMENTAL_BULK_THRESHOLD = 50
+
     @staticmethod
     def pretty_format_list_movements(test_card: Card) -> list:
         """
@@ -76,14 +113,21 @@ class Helper:
         list_movements = test_card.list_movements()
 
         for movement in reversed(list_movements):
-            source = "".join(filter(str.isalpha, movement['source']['name']))
-            destination = "".join(filter(str.isalpha, movement['destination']['name']))
-            datetime = movement['datetime'].strftime('%d/%m/%Y, %H:%M:%S')
-
-            movement_collection_list.append({'source': source, 'destination': destination, 'datetime': datetime})
+            movement_collection_list.append(Helper.format_list_movement(movement['source']['name'], movement['destination']['name'], movement['datetime']))
 
         return movement_collection_list
 
+    @staticmethod
+    def format_list_movement(source_name: str, destination_name: str, movement_datetime: datetime) -> dict:
+        """
+        Function to pretty format a single list movement
+        """
+        source = clean_list_name(source_name)
+        destination = clean_list_name(destination_name)
+        datetime = movement_datetime.strftime('%d/%m/%Y, %H:%M:%S')
+
+        return {'source': source, 'destination': destination, 'datetime': datetime}
+
     @staticmethod
     def convert_member_id_to_name(member_id_list: list, member_dict: dict) -> str:
         """
@@ -104,44 +148,19 @@ class Helper:
     @staticmethod
     def process_description(description: str) -> Union[dict, str]:
         """
-        Function to process description gibberish into meaningful columns.
+        Function to process description gibberish into meaningful columns (see description_parser.parse_description)
         """
-        if description.find("###") != -1:
-            description_basic = description.split("Attachment", 1)
-            description_basic = description_basic[0]
-
-            data_arr = description_basic.split("###")
-            for i in range(len(data_arr)):
-                data_arr[i] = data_arr[i].replace("\n", "")
-                data_arr[i] = data_arr[i].strip()
-
-            # Using list comprehension to perform empty string removal
-            data_arr = [string for string in data_arr if string]
-
-            # Split the data into even and odd fashion to process into key value pair
-            keys = []
-            values = []
-            for i in range(len(data_arr)):
-                if i % 2 == 0:
-                    keys.append(data_arr[i])
-                else:
-                    values.append(data_arr[i])
-            
-            data_dict = {}
-            for i in range(len(keys)):
-                data_dict[keys[i]] = values[i]
-
-            print(data_dict)
-            return data_dict 
-        else:
-            print(description)
-            return description
+        return parse_description(description)
 
     @staticmethod
-    def get_card_label(card_id: str) -> str:
+    def get_card_label(card_id: str, api: TrelloApi = None) -> str:
         """
         Because PyTrello is not able to extract card label, call Trello's API directly
+        (through the given, possibly cached, TrelloApi)
         """
+        if api is not None:
+            return Helper.format_card_labels(api.get_card_labels(card_id))
+
         url = f"https://api.trello.com/1/cards/{card_id}"
 
         headers = {
@@ -164,8 +183,13 @@ class Helper:
         # json.dumps(json.loads(response.text), sort_keys = True, indent = 4, separators = (",", ": ")))
 
         data = json.loads(response.text)
-        labels = data['labels']
+        return Helper.format_card_labels(data['labels'])
 
+    @staticmethod
+    def format_card_labels(labels: list) -> str:
+        """
+        Function to join the names of a card's labels
+        """
         final_string = ""
         if len(labels) > 0:
             for i in range(len(labels)):
@@ -179,62 +203,279 @@ class Helper:
         return final_string
 
     @staticmethod
-    def export_cards_to_csv(board: Board, member: Member) -> None:
+    def build_card_rows(created_date: datetime, current_list: str, card_name: str, card_label: str, member_name: str,
+                        raw_description: str, list_movements: list, card_id: str = None) -> list:
+        """
+        Function to build the export rows of a card, one row per list movement (keyed by card_id when given)
+        """
+        rows = []
+        description = parse_description(raw_description)
+
+        if type(description) == dict:
+            reporting_team, requestor_email, reporting_manager_email, type_of_requirement = (
+                description.get(key, 'N/A') for key in DESCRIPTION_FIELDS
+            )
+
+            for movement in list_movements:
+                rows.append({
+                    'created_date': created_date,
+                    'current_list': current_list,
+                    'card_name': card_name,
+                    'card_label': card_label,
+                    'member_name': member_name,
+                    'reporting_team': reporting_team,
+                    'requestor_email': requestor_email,
+                    'reporting_manager_email': reporting_manager_email, 
+                    'type_of_requirement': type_of_requirement,
+                    'list_from': movement['source'],
+                    'list_to': movement['destination'],
+                    'transaction_date': movement['datetime']
+                    })
+            
+        else:
+            for movement in list_movements:
+                rows.append({
+                    'created_date': created_date,
+                    'current_list': current_list,
+                    'card_name': card_name,
+                    'card_label': card_label,
+                    'member_name': member_name,
+                    'description_pre_standardise': raw_description,
+                    'list_from': movement['source'],
+                    'list_to': movement['destination'],
+                    'transaction_date': movement['datetime']
+                })
+
+        if card_id is not None:
+            rows = [{'card_id': card_id, **row} for row in rows]
+        return rows
+
+    @staticmethod
+    def iter_card_rows(board: Board, member: Member, api: TrelloApi = None):
+        """
+        Generator to yield the export rows of every card of given board, card by card through py-trello
         """
-        Function to export all cards from given board to csv (archive cards included)
-        """    
-        result = []
         member_dict = member.bind_member_id_and_name()
 
         for list in board.list_lists():
             for card in list.list_cards():
-
-                created_date = card.created_date
-                current_list = "".join(filter(str.isalpha, list.name))
-                card_name = card.name
-                card_label = Helper.get_card_label(card.id)
-                member_name =  Helper.convert_member_id_to_name(card.member_id, member_dict)
-                description = Helper.process_description(card.description)
+                # The label & list movement requests are timed by the http session, the row building here
+                card_label = Helper.get_card_label(card.id, api)
                 list_movements = Helper.pretty_format_list_movements(card)
 
-                if type(description) == dict:
-                    reporting_team = description['Reporting Team'] if "Reporting Team" in description else 'N/A'
-                    requestor_email = description['Requestor email'] if "Requestor email" in description else 'N/A'
-                    reporting_manager_email =  description['Reporting manager email'] if "Reporting manager email" in description else 'N/A'
-                    type_of_requirement = description['Type of requirement'] if "Type of requirement" in description else 'N/A'
-
-                    for movement in list_movements:
-                        result.append({
-                            'created_date': created_date,
-                            'current_list': current_list,
-                            'card_name': card_name,
-                            'card_label': card_label,
-                            'member_name': member_name,
-                            'reporting_team': reporting_team,
-                            'requestor_email': requestor_email,
-                            'reporting_manager_email': reporting_manager_email, 
-                            'type_of_requirement': type_of_requirement,
-                            'list_from': movement['source'],
-                            'list_to': movement['destination'],
-                            'transaction_date': movement['datetime']
-                            })
-                    
-                else:
-                    for movement in list_movements:
-                        result.append({
-                            'created_date': created_date,
-                            'current_list': current_list,
-                            'card_name': card_name,
-                            'card_label': card_label,
-                            'member_name': member_name,
-                            'description_pre_standardise': card.description,
-                            'list_from': movement['source'],
-                            'list_to': movement['destination'],
-                            'transaction_date': movement['datetime']
-                        })
-        
-        df = pd.DataFrame.from_records(result)
-        df.to_csv('tickets_export.csv', index = False)
+                with span("export.build_rows", exporter = "per_card"):
+                    rows = Helper.build_card_rows(
+                        created_date = card.created_date,
+                        current_list = clean_list_name(list.name),
+                        card_name = card.name,
+                        card_label = card_label,
+                        member_name = Helper.convert_member_id_to_name(card.member_id, member_dict),
+                        raw_description = card.description,
+                        list_movements = list_movements
+                    )
+                yield from rows
+
+    @staticmethod
+    def write_export(rows, path: str, include_card_id: bool = False) -> int:
+        """
+        Function to stream export rows into a csv or parquet file (by extension) in batches, returns the number of rows
+        """
+        with ExportWriter(path, export_columns(include_card_id)) as writer:
+            writer.write_rows(rows)
+        return writer.row_count
+
+    @staticmethod
+    @timed("export", exporter = "per_card", memory = True)
+    def export_cards_to_csv(board: Board, member: Member, api: TrelloApi = None, path: str = 'tickets_export.csv') -> None:
+        """
+        Function to export all cards from given board to csv (archive cards included)
+        """    
+        Helper.write_export(Helper.iter_card_rows(board, member, api), path)
+
+    @staticmethod
+    def card_created_date(card_id: str) -> datetime:
+        """
+        Function to return a card's creation date, encoded in the first 8 hex digits of its id (same as py-trello's Card.created_date)
+        """
+        return datetime.fromtimestamp(int(card_id[0:8], 16)).replace(tzinfo = timezone.utc)
+
+    @staticmethod
+    def iter_board_export_frames(api: TrelloApi, board_id: str, include_card_id: bool = False, chunk_size: int = 500):
+        """
+        Generator to yield the export rows of every card of given board, chunk_size cards per frame, from a few board
+        wide requests (instead of per card label & list movement requests), flattened column by column
+        """
+        lists = {trello_list['id']: trello_list for trello_list in api.get_board_lists(board_id)}
+        member_dict = {member['id']: member['fullName'] for member in api.get_board_members(board_id)}
+        cards = api.get_board_cards(board_id)
+        actions = api.get_board_list_movements(board_id)
+        columns = export_columns(include_card_id)
+
+        # Only the fetched json is held for the whole board, the movements & export rows are built a chunk at a time
+        with span("export.build_rows", exporter = "board_wide"):
+            action_order, offsets = group_actions_by_card(actions, [card['id'] for card in cards])
+
+        for start in range(0, len(cards), chunk_size):
+            chunk_cards = cards[start:start + chunk_size]
+            with span("export.build_rows", exporter = "board_wide"):
+                cards_df = cards_frame(
+                    chunk_cards,
+                    lists,
+                    member_dict,
+                    created_dates = [Helper.card_created_date(card['id']) for card in chunk_cards],
+                    card_labels = [Helper.format_card_labels(card['labels']) for card in chunk_cards]
+                )
+                chunk_actions = [actions[index] for index in action_order[offsets[start]:offsets[start + len(chunk_cards)]]]
+                export_df = join_movements(cards_df, movements_frame(chunk_actions), columns)
+            yield export_df
+
+    @staticmethod
+    @timed("export", exporter = "board_wide", memory = True)
+    def export_board_to_csv(api: TrelloApi, board_id: str, path: str = 'tickets_export.csv', include_card_id: bool = False) -> None:
+        """
+        Function to export all cards from given board to csv (or parquet) with a few board wide requests, streamed
+        to the file a chunk of cards at a time
+        """
+        with ExportWriter(path, export_columns(include_card_id)) as writer:
+            for export_df in Helper.iter_board_export_frames(api, board_id, include_card_id):
+                writer.write_frame(export_df)
+
+    @staticmethod
+    def iter_board_rows_concurrent(api: TrelloApi, board_id: str, max_workers: int = 8, window: int = 500):
+        """
+        Generator to yield the export rows of every card of given board with per list & per card requests (like
+        export_cards_to_csv), issued concurrently by a bounded thread pool, window cards at a time.
+        The api's rate limiter keeps the pool within Trello's limits.
+        """
+        lists = {trello_list['id']: trello_list for trello_list in api.get_board_lists(board_id)}
+        member_dict = {member['id']: member['fullName'] for member in api.get_board_members(board_id)}
+
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            cards = [card for list_cards in executor.map(api.get_list_cards, lists) for card in list_cards]
+
+            for start in range(0, len(cards), window):
+                window_cards = cards[start:start + window]
+                card_ids = [card['id'] for card in window_cards]
+                labels = executor.map(api.get_card_labels, card_ids)
+                movements = executor.map(api.get_card_list_movements, card_ids)
+
+                for card, card_labels, card_actions in zip(window_cards, labels, movements):
+                    list_movements = Helper.group_list_movements(card_actions).get(card['id'], [])
+                    yield from Helper.build_json_card_rows(card, lists, member_dict, card_labels, list_movements)
+
+    @staticmethod
+    @timed("export", exporter = "concurrent", memory = True)
+    def export_board_to_csv_concurrent(api: TrelloApi, board_id: str, max_workers: int = 8, path: str = 'tickets_export.csv') -> None:
+        """
+        Function to export all cards from given board to csv (or parquet) with concurrent per list & per card requests
+        """
+        Helper.write_export(Helper.iter_board_rows_concurrent(api, board_id, max_workers), path)
+
+    @staticmethod
+    def group_list_movements(actions: list) -> dict:
+        """
+        Function to group updateCard:idList actions (newest first) into pretty formatted movements per card id,
+        oldest first like pretty_format_list_movements
+        """
+        movements_by_card = {}
+        for action in reversed(actions):
+            data = action['data']
+            if 'listBefore' not in data or 'listAfter' not in data:
+                continue
+            movements_by_card.setdefault(data['card']['id'], []).append(Helper.format_list_movement(
+                data['listBefore']['name'],
+                data['listAfter']['name'],
+                datetime.strptime(action['date'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo = timezone.utc)
+            ))
+        return movements_by_card
+
+    @staticmethod
+    @timed("export.build_rows", exporter = "json_cards")
+    def build_json_card_rows(card: dict, lists: dict, member_dict: dict, labels: list, list_movements: list,
+                             include_card_id: bool = False) -> list:
+        """
+        Function to build the export rows of a card returned by the REST API
+        """
+        return Helper.build_card_rows(
+            created_date = Helper.card_created_date(card['id']),
+            current_list = clean_list_name(lists[card['idList']]['name']),
+            card_name = card['name'],
+            card_label = Helper.format_card_labels(labels),
+            member_name = Helper.convert_member_id_to_name(card['idMembers'], member_dict),
+            raw_description = card['desc'],
+            list_movements = list_movements,
+            card_id = card['id'] if include_card_id else None
+        )
+
+    @staticmethod
+    def read_checkpoint(checkpoint_path: str) -> dict:
+        """
+        Function to read the incremental export checkpoint, None if there is none
+        """
+        if not os.path.exists(checkpoint_path):
+            return None
+        with open(checkpoint_path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def write_checkpoint(checkpoint_path: str, board_id: str, last_action_id: str) -> None:
+        tmp_path = f"{checkpoint_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'board_id': board_id, 'last_action_id': last_action_id, 'updated_at': datetime.now(timezone.utc).isoformat()}, f)
+        os.replace(tmp_path, checkpoint_path)
+
+    @staticmethod
+    @timed("export", exporter = "incremental", memory = True)
+    def export_board_incremental(api: TrelloApi, board_id: str, path: str = 'tickets_export.csv', checkpoint_path: str = None) -> None:
+        """
+        Function to keep a board export up to date: the first run exports the whole board, later runs only fetch the
+        board actions since the checkpointed one & upsert the rows of the cards they touched
+        """
+        checkpoint_path = checkpoint_path or f"{os.path.splitext(path)[0]}.checkpoint.json"
+        checkpoint = Helper.read_checkpoint(checkpoint_path)
+
+        if checkpoint is None or checkpoint['board_id'] != board_id or checkpoint['last_action_id'] is None or not os.path.exists(path):
+            # Checkpoint before exporting, actions made during the export are replayed (idempotently) on the next run
+            last_action_id = api.get_latest_board_action_id(board_id)
+            Helper.export_board_to_csv(api, board_id, path, include_card_id = True)
+            Helper.write_checkpoint(checkpoint_path, board_id, last_action_id)
+            return
+
+        actions = api.get_board_actions(board_id, Helper.CARD_ACTION_TYPES, since = checkpoint['last_action_id'])
+        if len(actions) == 0:
+            return
+
+        # A renamed list changes the current_list of every card in it, export the whole board again
+        if any(action['type'] == 'updateList' for action in actions):
+            Helper.export_board_to_csv(api, board_id, path, include_card_id = True)
+            Helper.write_checkpoint(checkpoint_path, board_id, actions[0]['id'])
+            return
+
+        card_ids = {action['data']['card']['id'] for action in actions if 'card' in action['data']}
+        lists = {trello_list['id']: trello_list for trello_list in api.get_board_lists(board_id)}
+        member_dict = {member['id']: member['fullName'] for member in api.get_board_members(board_id)}
+
+        if len(card_ids) > Helper.INCREMENTAL_BULK_THRESHOLD:
+            cards = [card for card in api.get_board_cards(board_id) if card['id'] in card_ids]
+            movements_by_card = Helper.group_list_movements(api.get_board_list_movements(board_id))
+        else:
+            # Deleted, archived or moved away cards drop out of the export like in a full export
+            cards = [api.get_card(card_id) for card_id in card_ids]
+            cards = [card for card in cards if card is not None and not card['closed'] and card['idBoard'] == board_id]
+            movements_by_card = {}
+            for card in cards:
+                movements_by_card.update(Helper.group_list_movements(api.get_card_list_movements(card['id'])))
+
+        # Stream the untouched rows of the previous export & the refreshed cards' rows into a new file
+        root, extension = os.path.splitext(path)
+        tmp_path = f"{root}.tmp{extension}"
+        with ExportWriter(tmp_path, export_columns(include_card_id = True)) as writer:
+            for existing_df in iter_export(path):
+                writer.write_frame(existing_df[~existing_df['card_id'].isin(card_ids)])
+            for card in cards:
+                writer.write_rows(Helper.build_json_card_rows(card, lists, member_dict, card['labels'], movements_by_card.get(card['id'], []), include_card_id = True))
+        os.replace(tmp_path, path)
+        Helper.write_checkpoint(checkpoint_path, board_id, actions[0]['id'])
 
 
 def list_all_cards_in_ad_hoc_board(client: TrelloClient) -> None:
@@ -258,15 +499,16 @@ def main() -> None:
         api_secret = 'Get Your Own Key',
         token = 'Get Your Own Key' 
     )
-    trello_client = c1.create_client()
+    # Boards, members, lists & cards barely change between runs, serve them from a local cache
+    cache = ResponseCache(cache_dir = os.environ.get("TRELLO_CACHE_DIR", ".trello_cache"))
+    trello_client = c1.create_client(cache)
     
     # Instantiate Board object
     b1 = Board(trello_client)
     ad_hoc_board = b1.get_ad_hoc_board()
     
-    # Instantiate Member object
-    m1 = Member(ad_hoc_board)
-    Helper.export_cards_to_csv(ad_hoc_board, m1)
+    # Export with board wide requests (Helper.export_cards_to_csv(ad_hoc_board, Member(ad_hoc_board)) for per card requests)
+    Helper.export_board_to_csv(c1.create_api(), ad_hoc_board.id)
 
 
 if __name__ == "__main__":